@@ -1,4 +1,5 @@
 from bazel_external_data.backends.mock import MockBackend
+from bazel_external_data.backends.fs import FsBackend
 from bazel_external_data.backends.girder import GirderHashsumBackend
 from bazel_external_data.backends.http import HttpBackend
 
@@ -7,6 +8,7 @@ def get_default_backends():
     """ Get all available backends provided via `bazel_external_data`. """
     backends = {
         "mock": MockBackend,
+        "fs": FsBackend,
         "girder_hashsum": GirderHashsumBackend,
         "http": HttpBackend,
     }
@@ -0,0 +1,169 @@
+import errno
+import os
+import shutil
+import stat
+import uuid
+
+from bazel_external_data import util, hashes
+from bazel_external_data.core import Backend
+
+
+# Errors of `os.link` meaning that hard links are not supported.
+_LINK_UNSUPPORTED_ERRNOS = (errno.EPERM, errno.EOPNOTSUPP, errno.EXDEV)
+
+
+class FsBackend(Backend):
+    """ Stores files by hash in a directory on a local or network (e.g. NFS)
+    filesystem, at `{path}/{algo}/{xx}/{yy}/{hash}` (the same layout as the
+    user's cache).
+
+    Checks are a single `stat` per file. Downloads are materialized using
+    the `materialize` strategies (@see util.materialize_file). "hardlink" is
+    opt-in, as outputs then share the stored file's inode (and mode), and
+    each new link changes its ctime (invalidating records keyed on it); it is
+    only used for files owned by the user.
+
+    Uploads are written to a temporary file next to their destination, then
+    linked into place, so that readers never see partial files and
+    concurrent writers of the same file do not conflict. Stored files are
+    read-only. """
+    # Checks are lookups in a local directory.
+    remember_checks = False
+
+    def __init__(self, config, project_root, user):
+        Backend.__init__(self, config, project_root, user)
+        self._path = os.path.join(
+            project_root, os.path.expanduser(config['path']))
+        self._disable_upload = config.get('disable_upload', False)
+        self._materialize_strategies = config.get(
+            'materialize', ["reflink", "copy_file_range", "copy"])
+        for strategy in self._materialize_strategies:
+            if strategy not in util.MATERIALIZE_STRATEGIES:
+                raise RuntimeError(
+                    "Invalid `materialize` strategy: {}".format(strategy))
+        # Whether to flush uploads to disk before they are linked into place.
+        self._fsync = config.get('fsync', True)
+
+    def _get_path(self, hash):
+        hash_value = hash.get_value()
+        return os.path.join(
+            self._path, hash.get_algo(), hash_value[0:2], hash_value[2:4],
+            hash_value)
+
+    def check_file(self, hash, project_relpath):
+        try:
+            return stat.S_ISREG(os.stat(self._get_path(hash)).st_mode)
+        except FileNotFoundError:
+            return False
+
+    def download_file(self, hash, project_relpath, output_file):
+        filepath = self._get_path(hash)
+        try:
+            st = os.stat(filepath)
+        except FileNotFoundError:
+            raise util.DownloadError("Unknown hash: {}".format(hash))
+        strategies = self._materialize_strategies
+        if st.st_uid != os.getuid():
+            # We could not change the mode of the shared inode.
+            strategies = [
+                strategy for strategy in strategies if strategy != "hardlink"]
+            strategies = strategies or ["copy"]
+        util.materialize_file(filepath, output_file, strategies)
+        # The caller verifies the output.
+        return None
+
+    def _store(self, tmp_file, dest):
+        # Makes `tmp_file` read-only and moves it to `dest`, unless it already
+        # exists.
+        mode_write_all = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+        os.chmod(tmp_file, os.stat(tmp_file).st_mode & ~mode_write_all)
+        if self._fsync:
+            fd = os.open(tmp_file, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        try:
+            # Unlike a rename, this does not replace a file stored
+            # concurrently (whose inode may already be linked elsewhere).
+            os.link(tmp_file, dest)
+        except FileExistsError:
+            pass
+        except OSError as e:
+            if e.errno not in _LINK_UNSUPPORTED_ERRNOS:
+                raise
+            # Hard links are not supported on all filesystems.
+            self._copy_exclusive(tmp_file, dest)
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        if self._fsync:
+            fd = os.open(os.path.dirname(dest), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _copy_exclusive(self, tmp_file, dest):
+        # Copies `tmp_file` to `dest`, unless it already exists. Readers may
+        # briefly see a partial file, which hard links avoid.
+        mode = stat.S_IMODE(os.stat(tmp_file).st_mode)
+        try:
+            fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+        except FileExistsError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as fdst, open(tmp_file, 'rb') as fsrc:
+                shutil.copyfileobj(fsrc, fdst)
+                fdst.flush()
+                if self._fsync:
+                    os.fsync(fdst.fileno())
+        except BaseException:
+            os.remove(dest)
+            raise
+
+    def _get_tmp_file(self, dest_dir):
+        # Hidden, so that partially written files are never mistaken for
+        # stored ones; stale files from interrupted uploads may be removed.
+        os.makedirs(dest_dir, exist_ok=True)
+        return os.path.join(dest_dir, ".{}.tmp".format(uuid.uuid4()))
+
+    def upload_file(self, hash, project_relpath, filepath):
+        if self._disable_upload:
+            raise RuntimeError("Upload disabled")
+        dest = self._get_path(hash)
+        if os.path.exists(dest):
+            return
+        tmp_file = self._get_tmp_file(os.path.dirname(dest))
+        try:
+            util.materialize_file(
+                filepath, tmp_file, ["reflink", "copy_file_range", "copy"])
+            self._store(tmp_file, dest)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def supports_single_pass_upload(self):
+        return not self._disable_upload
+
+    def upload_file_single_pass(self, hash_type, project_relpath, filepath,
+                                is_uploaded):
+        if self._disable_upload:
+            raise RuntimeError("Upload disabled")
+        # Hash while copying to a staging file in the store's root, from
+        # which it can be linked into place.
+        tmp_file = self._get_tmp_file(os.path.join(self._path, "staging"))
+        try:
+            with hashes.HashReader(hash_type, filepath) as reader, \
+                    open(tmp_file, 'wb') as f:
+                shutil.copyfileobj(reader, f)
+                hash = reader.get_hash()
+            shutil.copymode(filepath, tmp_file)
+            if not is_uploaded(hash):
+                dest = self._get_path(hash)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                self._store(tmp_file, dest)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return hash
+
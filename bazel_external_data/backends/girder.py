@@ -1,15 +1,24 @@
-from datetime import datetime
+from datetime import datetime, timezone
+import hashlib
 import json
 import os
+import threading
+import time
 
 import requests
 import yaml
 
-from bazel_external_data import util
+from bazel_external_data import hashes, transfer, util
+from bazel_external_data.backends import sessions
 from bazel_external_data.core import Backend
 
 # TODO(eric.cousineau): Start using `girder_client` rather than recreating.
 
+# Seconds before expiry at which a cached token is no longer used.
+token_expiry_margin = 300
+# Items and folders are listed this many at a time.
+listing_page_size = 1000
+
 
 def resource_lookup_or_none(client, path):
     try:
@@ -76,7 +85,23 @@ class GirderHashsumBackend(Backend):
         url_config_node = util.get_chain(user.config, ['girder', 'url', self._url])
         self._api_key = util.get_chain(url_config_node, ['api_key'])
         self._token = None
+        # Tokens are cached on disk (until shortly before they expire), so
+        # that each process need not exchange the API key for a new one.
+        self._token_cache_dir = os.path.join(user.state_dir, "girder_tokens")
+        self._token_is_cached = False
+        # Downloads are streamed to disk in chunks of this many bytes.
+        self._download_chunk_size = config.get('download_chunk_size', 1 << 20)
         self._girder_client = None
+        # Memoized lookups (@see `_find_file`).
+        self._lock = threading.RLock()
+        self._folder_id = None
+        self._folder_missing = False
+        self._folder_item_ids = None
+        self._files = {}
+        self._pool_config = sessions.get_pool_config(user, config)
+        self._pool_config["pool_maxsize"] = max(
+            self._pool_config["pool_maxsize"], self._check_jobs)
+        sessions.get_session(self._api_url, self._pool_config)
 
     def _request(self, endpoint, params={}, method="get", stream=False, test=False):
         def json_value(value):
@@ -87,9 +112,18 @@ class GirderHashsumBackend(Backend):
         headers = {}
         if self._token:
             headers = {"Girder-Token": self._token}
-        params = {key: json_value(value) for key, value in params.items()}
-        func = getattr(requests, method)
-        r = func(self._api_url + endpoint, params=params, headers=headers, stream=stream)
+        query = {key: json_value(value) for key, value in params.items()}
+        # Share kept-alive connections with other backends using this server.
+        session = sessions.get_session(self._api_url, self._pool_config)
+        func = getattr(session, method)
+        r = func(self._api_url + endpoint, params=query, headers=headers,
+                 stream=stream)
+        if r.status_code == 401 and self._token_is_cached:
+            # The cached token may have been revoked; get a new one.
+            r.close()
+            self._clear_cached_token()
+            self._authenticate_if_needed()
+            return self._request(endpoint, params, method, stream, test)
         if test:
             if r.status_code >= 400:
                 return None
@@ -97,11 +131,23 @@ class GirderHashsumBackend(Backend):
             r.raise_for_status()
         return r
 
-    def _get_folder_id(self):
+    def _get_folder_id(self, create=True):
+        # Resolved once per instance. If `create` is false and the folder
+        # does not exist, returns None (which is also remembered).
+        with self._lock:
+            if self._folder_id is None and (create or
+                                            not self._folder_missing):
+                self._folder_id = self._lookup_folder_id(create)
+                self._folder_missing = self._folder_id is None
+            return self._folder_id
+
+    def _lookup_folder_id(self, create):
         key_chain = ['url', self._url, 'folder_ids', self._folder_path]
         response = self._request('/resource/lookup', params={"path": self._folder_path}, test=True)
         if response:
             folder = response.json()
+        elif not create:
+            return None
         else:
             # See if we can create the folder
             if self._create_root_path:
@@ -116,34 +162,134 @@ class GirderHashsumBackend(Backend):
 
     def _authenticate_if_needed(self):
         if self._api_key is not None and self._token is None:
-            response = self._request("/api_key/token", method="post", params={"key": self._api_key}).json()
-            self._token = response["authToken"]["token"]
+            self._token = self._read_cached_token()
+            self._token_is_cached = self._token is not None
+            if self._token is None:
+                response = self._request(
+                    "/api_key/token", method="post",
+                    params={"key": self._api_key}).json()
+                self._token = response["authToken"]["token"]
+                self._write_cached_token(response["authToken"])
+
+    def _get_token_path(self):
+        # Keyed by both URL and API key, so that changing the key invalidates
+        # the token.
+        key = hashlib.sha1("{}\n{}".format(
+            self._url, self._api_key).encode("utf8")).hexdigest()
+        return os.path.join(self._token_cache_dir, key + ".json")
+
+    def _read_cached_token(self):
+        try:
+            with open(self._get_token_path()) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        expires = cached.get("expires")
+        if expires is not None and expires - token_expiry_margin < time.time():
+            return None
+        return cached.get("token")
 
-    def _is_part_of_folder(self, hash):
+    def _write_cached_token(self, auth_token):
+        expires = auth_token.get("expires")
+        if expires is not None:
+            expires = datetime.fromisoformat(expires)
+            if expires.tzinfo is None:
+                expires = expires.replace(tzinfo=timezone.utc)
+            expires = expires.timestamp()
+        os.makedirs(self._token_cache_dir, mode=0o700, exist_ok=True)
+        # Only readable by the user.
+        util.write_atomic(
+            self._get_token_path(),
+            json.dumps({"token": auth_token["token"], "expires": expires}),
+            mode=0o600)
+
+    def _clear_cached_token(self):
+        self._token = None
+        self._token_is_cached = False
+        try:
+            os.remove(self._get_token_path())
+        except FileNotFoundError:
+            pass
+
+    def _list(self, endpoint, params):
+        # Yields all results of a paged listing.
+        offset = 0
+        while True:
+            page = self._request(endpoint, params=dict(
+                params, limit=listing_page_size, offset=offset)).json()
+            for result in page:
+                yield result
+            if len(page) < listing_page_size:
+                return
+            offset += len(page)
+
+    def _get_folder_item_ids(self):
+        # Ids of the items within the folder (or its subfolders), listed once
+        # per instance.
+        with self._lock:
+            if self._folder_item_ids is None:
+                folder_id = self._get_folder_id(create=False)
+                if folder_id is None:
+                    return set()
+                item_ids = set()
+                folder_ids = [folder_id]
+                while folder_ids:
+                    parent_id = folder_ids.pop()
+                    item_ids.update(
+                        item["_id"] for item in self._list(
+                            "/item", {"folderId": parent_id}))
+                    folder_ids.extend(
+                        folder["_id"] for folder in self._list(
+                            "/folder", {"parentType": "folder",
+                                        "parentId": parent_id}))
+                self._folder_item_ids = item_ids
+            return self._folder_item_ids
+
+    def _find_file(self, hash):
+        """Returns a file with the given hashsum in the folder (or its
+        subfolders), or None. Results are memoized per instance, and
+        membership is checked against a listing of the folder, so that the
+        cost does not grow with the number of copies of a file elsewhere. """
+        if hash in self._files:
+            return self._files[hash]
         # Get files for the given hashsum.
-        files = self._request("/file/hashsum/{algo}/{hash}".format(algo=hash.get_algo(), hash=hash.get_value())).json()
-        for file in files:
-            id = file["_id"]
-            # Get path.
-            path = self._request("/resource/{id}/path".format(id=id), params={"type": "file"}).json()
-            if path.startswith(self._folder_path + "/"):
-                return True
-        return False
+        files = self._request("/file/hashsum/{algo}/{hash}".format(
+            algo=hash.get_algo(), hash=hash.get_value())).json()
+        found = None
+        if files:
+            item_ids = self._get_folder_item_ids()
+            found = next(
+                (file for file in files if file["itemId"] in item_ids), None)
+        self._files[hash] = found
+        return found
 
     def check_file(self, hash, project_relpath):
         # Ensure the file exists in the folder.
         self._authenticate_if_needed()
-        return self._is_part_of_folder(hash)
+        return self._find_file(hash) is not None
+
+    def check_files(self, hashes):
+        self._authenticate_if_needed()
+        hashes = list(hashes)
+        found = transfer.get_engine().map_sync(
+            self._find_file, hashes, jobs=self._check_jobs)
+        return {hash: file is not None for hash, file in zip(hashes, found)}
 
     def download_file(self, hash, project_relpath, output_file):
         self._authenticate_if_needed()
-        if not self.check_file(hash, project_relpath):
+        # Download the very file found in the folder (reusing the result of
+        # any prior check).
+        file = self._find_file(hash)
+        if file is None:
             raise util.DownloadError("File not available in Girder folder '{}': {} (hash: {})".format(self._folder_path, project_relpath, hash))
-        r = self._request("/file/hashsum/{algo}/{hash}/download"
-                          .format(algo=hash.get_algo(), hash=hash.get_value()))
-        with open(output_file, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                f.write(chunk)
+        r = self._request(
+            "/file/{id}/download".format(id=file["_id"]), stream=True)
+        with r, open(output_file, 'wb') as f, transfer.on_cancel(
+                lambda: sessions.shutdown_response(r)):
+            writer = hashes.HashWriter(hash.hash_type, f)
+            for chunk in r.iter_content(chunk_size=self._download_chunk_size):
+                writer.write(chunk)
+        return writer.get_hash(output_file)
 
     def _get_girder_client(self):
         # @note We import girder_client here, as only uploading requires it at present.
@@ -176,6 +322,10 @@ class GirderHashsumBackend(Backend):
         with open(filepath, 'rb') as fd:
             print("Uploading: {}".format(filepath))
             gc.uploadFile(folder_id, fd, name=item_name, size=size, parentType='folder', reference=ref)
+        # The folder listing is now stale.
+        with self._lock:
+            self._folder_item_ids = None
+        self._files.pop(hash, None)
 
 
 def get_backends():
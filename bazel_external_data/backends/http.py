@@ -1,13 +1,26 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import hashlib
 import os
+import shutil
+import threading
 import time
+import urllib.parse
+import uuid
+from xml.etree import ElementTree
 
 import requests
 import yaml
 
-from bazel_external_data import util
+from bazel_external_data import hashes, transfer, util
+from bazel_external_data.backends import retry, sessions
 from bazel_external_data.core import Backend
 
+# S3 accepts at most 5 GiB in a single PUT (or copy), and 10000 parts in a
+# multipart upload.
+_MAX_SINGLE_UPLOAD_SIZE = 5 << 30
+_MAX_PARTS = 10000
+
 
 class HttpBackend(Backend):
     """An HTTP PUT/GET server (like S3) with access gated by an API key.
@@ -20,6 +33,40 @@ class HttpBackend(Backend):
     a proxy such as cloudfront to enforce authentication and to avoid exposing
     too many details to the world.
 
+    If `single_pass_upload` is set, files whose hash is not yet known are
+    uploaded to a temporary key under `staging_path` while being hashed, then
+    moved into place with a server-side copy (S3's `x-amz-copy-source`) and
+    the temporary key deleted. This reads the file once rather than twice,
+    at the cost of transmitting files which turn out to already be present.
+    Large files are staged with the multipart protocol, and copied part by
+    part (S3's UploadPartCopy) if above `max_single_upload_size` (5 GiB, the
+    most S3 accepts in a single PUT or copy). The copy source is named as
+    `/{bucket}/{key}`: with path-style URLs (the default) `folder_path` starts
+    with the bucket, otherwise set `bucket`.
+
+    Downloads are kept as partial files in the user's cache directory (keyed
+    by hash and object URL) until complete. Interrupted downloads are resumed
+    with HTTP Range requests, within `download_retries` attempts, or by later
+    invocations. Resuming requires that the ETag (if any) and size of the
+    object are unchanged.
+
+    Objects of at least `parallel_download_min_size` bytes (if set) are
+    downloaded as `parallel_download_connections` concurrent Range requests,
+    each written at its offset into a preallocated file. Such downloads are
+    verified after the file is assembled rather than as they stream, and are
+    not resumed by later invocations.
+
+    If `multipart_upload` is set, files larger than `multipart_part_size` (and
+    in any case, files larger than `max_single_upload_size`) are uploaded
+    with the S3 multipart protocol: the upload is initiated, its
+    parts are PUT by `multipart_concurrency` concurrent requests (each retried
+    up to `multipart_part_retries` times), and it is then completed, or
+    aborted on failure.
+
+    Requests are retried according to the `retry` configuration (timeouts,
+    backoff, an overall deadline, a minimum throughput for downloads, and a
+    per-host circuit breaker); @see retry.RetryPolicy.
+
     Note that unlike other backends, this backend allows the API key to be
     stored in the repository configuration.  This may or may not be desirable
     depending on your repository's security configuration.  Storing the API
@@ -32,8 +79,43 @@ class HttpBackend(Backend):
         self._verbose = config.get('verbose', False)
         self._url = config['url']
         self._path_prefix = config['folder_path']
+        # Downloads are streamed to disk in chunks of this many bytes, so that
+        # memory usage does not depend on the size of the file.
+        self._download_chunk_size = config.get(
+            'download_chunk_size', 1 << 20)
+        # Number of times to resume an interrupted download.
+        self._download_retries = config.get('download_retries', 5)
+        self._cache = user.cache
+        self._retry_policy = retry.load_policy(config.get('retry'))
+        self._parallel_download_min_size = config.get(
+            'parallel_download_min_size')
+        if self._parallel_download_min_size is not None:
+            self._parallel_download_min_size = util.parse_size(
+                self._parallel_download_min_size)
+        self._parallel_download_connections = config.get(
+            'parallel_download_connections', 8)
+        self._multipart_upload = config.get('multipart_upload', False)
+        self._multipart_part_size = util.parse_size(
+            config.get('multipart_part_size', 64 << 20))
+        self._multipart_concurrency = config.get('multipart_concurrency', 4)
+        self._multipart_part_retries = config.get('multipart_part_retries', 3)
+        self._max_single_upload_size = util.parse_size(
+            config.get('max_single_upload_size', _MAX_SINGLE_UPLOAD_SIZE))
+        self._single_pass_upload = config.get('single_pass_upload', False)
+        self._bucket = config.get('bucket')
+        self._staging_path = config.get(
+            'staging_path', f"{self._path_prefix}/staging")
 
-        self._http = requests.Session()
+        # Connections are shared with other backends using the same host,
+        # with enough kept alive for our concurrent requests (bulk existence
+        # checks, parallel downloads, and multipart uploads).
+        self._pool_config = sessions.get_pool_config(user, config)
+        self._pool_config["pool_maxsize"] = max(
+            self._pool_config["pool_maxsize"], self._check_jobs,
+            self._parallel_download_connections, self._multipart_concurrency)
+        # Register the pool size up front, so that the shared session is not
+        # replaced once in use.
+        sessions.get_session(self._url, self._pool_config)
 
         # Get (optional) authentication information.
         if self._name in user.config:
@@ -43,65 +125,111 @@ class HttpBackend(Backend):
         else:
             self._api_key = config['api_key']
 
+    @property
+    def _http(self):
+        return sessions.get_session(self._url, self._pool_config)
+
     def _verbose_print(self, text):
         if self._verbose:
             print(text)
 
     def _send_request_once(self, request_type, path, data=None,
-                           extra_headers=None):
+                           extra_headers=None, stream=False, timeout=None):
         headers = (extra_headers or {}) | {'Authorization': self._api_key}
         self._verbose_print(f"request {request_type} {path}")
         self._verbose_print(f"with headers {headers}")
+        if hasattr(data, 'seek'):
+            # Resend the whole body if this is a retry.
+            data.seek(0)
         if request_type == 'PUT':
-            result = self._http.put(self._url + path,
-                                    data=data, headers=headers)
+            result = self._http.put(self._url + path, data=data,
+                                    headers=headers, timeout=timeout)
         elif request_type == 'GET':
-            result = self._http.get(self._url + path, headers=headers)
+            result = self._http.get(self._url + path, headers=headers,
+                                    stream=stream, timeout=timeout)
         elif request_type == 'HEAD':
-            result = self._http.head(self._url + path, headers=headers)
+            result = self._http.head(self._url + path, headers=headers,
+                                     timeout=timeout)
+        elif request_type == 'POST':
+            result = self._http.post(self._url + path, data=data,
+                                     headers=headers, timeout=timeout)
+        elif request_type == 'DELETE':
+            result = self._http.delete(self._url + path, headers=headers,
+                                       timeout=timeout)
         else:
             raise RuntimeError(f"Invalid operation {request_type}.")
         return result
 
     def _send_request(self, request_type, path, data=None,
-                      extra_headers=None):
+                      extra_headers=None, stream=False):
         # Naively one would use `requests.adapters.HTTPAdapter`'s retry
         # feature, but the underlying urllib call discards the failed
         # requests which makes debugging impossible.
         #
         # This logic was put in place to debug a complicated failure of
         # layered timeouts and should not be simplified without great care.
-        retry_statuses = {500, 502, 503, 504}
+        #
+        # Timeouts, delays and the overall deadline are set by the remote's
+        # retry policy (@see retry.RetryPolicy). Hosts which repeatedly fail
+        # to connect are skipped by a per-host circuit breaker, so that
+        # callers can fall back (e.g. to an overlay) without waiting.
+        policy = self._retry_policy
+        breaker = retry.get_circuit_breaker(self._url)
+        deadline = policy.start()
 
         # Sometimes retrying queries within the same session doesn't help, so
         # we also allow one retry of the whole session if all else fails.
-        session_retries = 3
+        session_retries = policy.session_retries
         response = None
+        error = None
         while session_retries >= 0:
-            # Try `retries` many times, starting with a delay of `delay` and
-            # increasing it by `backoff_multiplier` with each failure.
-            retries = 11
-            delay = 0.2
-            backoff_multiplier = 1.8
-            # Max delay: delay * multiplier ** (retries - 1)
+            # Try `retries` many times, with a delay that increases with each
+            # failure.
+            retries = policy.retries
+            failures = 0
             while retries >= 0:
-                response = self._send_request_once(
-                    request_type, path, data, extra_headers)
-                if response.status_code not in retry_statuses:
-                    return response  # Success or irrecoverable failure.
+                # Do not retry on behalf of a transfer which lost a race.
+                transfer.check_cancelled()
+                breaker.check(policy)
+                try:
+                    response = self._send_request_once(
+                        request_type, path, data, extra_headers, stream,
+                        timeout=policy.get_timeout(deadline))
+                    error = None
+                except (requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout) as e:
+                    # Includes connection refusals and hung sockets.
+                    breaker.record_failure(policy)
+                    response = None
+                    error = e
+                else:
+                    breaker.record_success()
+                    if not policy.is_retryable(response):
+                        return response  # Success or irrecoverable failure.
+                failures += 1
                 if retries > 0:
+                    delay = policy.get_delay(failures, deadline)
+                    if delay is None:
+                        self._verbose_print("Retry deadline exceeded.")
+                        session_retries = 0
+                        break
+                    reason = error
+                    if response is not None:
+                        # Release the connection of a streamed response.
+                        response.close()
+                        reason = response.status_code
                     self._verbose_print(
-                        f"Retrying after {response.status_code}; "
-                        f"{retries} tries remain.")
+                        f"Retrying after {reason}; {retries} tries remain.")
                     time.sleep(delay)
-                    delay *= backoff_multiplier
                 retries -= 1
-            if session_retries >= 0:
+            if session_retries > 0:
                 self._verbose_print(
                     "Too many retries; trying with a new http session.")
-                self._http = requests.Session()
+                sessions.reset_session(self._url)
             session_retries -= 1
         self._verbose_print("Retries exhausted")
+        if error is not None:
+            raise error
         return response  # Out of tries; return whatever we've got.
 
     def _handle_any_error(self, response, success_codes={200}):
@@ -137,39 +265,495 @@ class HttpBackend(Backend):
                      else f"{hash.get_algo()}/")
         return f"{self._path_prefix}{hash_path}/{hash.get_value()}"
 
-    def check_file(self, hash, _project_relpath):
+    def _head(self, hash):
         path = self._object_path(hash)
         response = self._send_request('HEAD', path)
         self._handle_any_error(response,
                                success_codes={200, 400, 403, 404})
-        return response.status_code == 200
+        return response
+
+    def check_file(self, hash, _project_relpath):
+        return self._head(hash).status_code == 200
+
+    # `check_files` uses the default implementation: concurrent HEAD
+    # requests over the shared, kept-alive connections of `self._http`.
+
+    def _use_parallel_download(self, head_response):
+        size = int(head_response.headers.get('Content-Length', 0))
+        return (self._parallel_download_min_size is not None
+                and size > 0 and size >= self._parallel_download_min_size
+                and self._parallel_download_connections > 1
+                and head_response.headers.get('Accept-Ranges') == 'bytes')
 
     def download_file(self, hash, project_relpath, output_file):
-        if not self.check_file(hash, project_relpath):
+        head_response = self._head(hash)
+        if head_response.status_code != 200:
             raise util.DownloadError(
                 f"File not available '{project_relpath}"
                 f" (hash: {hash.get_value()})")
+        source_key = self._get_partial_key(hash)
+        partial_file = self._cache.get_partial_path(hash, source_key)
+        lock = util.FileLock(partial_file + ".lock", timeout=0)
+        if not lock.acquire():
+            # Another process is downloading this file, and owns the partial
+            # file and its info; download independently.
+            self._verbose_print("Partial download in use; not resuming.")
+            partial_file = output_file
+            source_key = None
+        writer = None
+        try:
+            if self._use_parallel_download(head_response):
+                # The file is not written sequentially, so it must never be
+                # mistaken for a resumable prefix.
+                self._write_partial_info(hash, source_key, None)
+                self._download_parallel(
+                    hash, int(head_response.headers['Content-Length']),
+                    partial_file)
+            else:
+                writer = self._download_resumable(
+                    hash, partial_file, source_key)
+            if partial_file != output_file:
+                shutil.move(partial_file, output_file)
+                self._write_partial_info(hash, source_key, None)
+        finally:
+            lock.release()
+        self._verbose_print("File downloaded successfully!")
+        # Parallel downloads are written out of order, so they are hashed by
+        # the caller instead.
+        return writer and writer.get_hash(output_file)
+
+    def _get_partial_key(self, hash):
+        # Partial downloads are kept per object URL, so that other remotes
+        # (e.g. mirrors) holding the same hash do not share them.
+        return hashlib.sha1(
+            (self._url + self._object_path(hash)).encode("utf8")).hexdigest()
+
+    def _write_partial_info(self, hash, source_key, info):
+        # Partial info is only tracked for partial files we hold the lock of
+        # (i.e. if `source_key` is not None).
+        if source_key is not None:
+            self._cache.write_partial_info(hash, source_key, info)
+
+    def _download_parallel(self, hash, size, output_file):
         path = self._object_path(hash)
-        response = self._send_request('GET', path)
-        self._handle_any_error(response)
-        with open(output_file, 'wb') as file:
-            file.write(response.content)
-            self._verbose_print("File downloaded successfully!")
+        connections = self._parallel_download_connections
+        part_size = max(-(-size // connections), self._download_chunk_size)
+        parts = [(start, min(start + part_size, size))
+                 for start in range(0, size, part_size)]
+        self._verbose_print(
+            f"Downloading {size} bytes in {len(parts)} parallel parts")
+        stop = threading.Event()
+        # Parts are written on other threads.
+        progress = transfer.get_progress()
+        fd = os.open(output_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o666)
+        try:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError):
+                # Not supported on this platform or filesystem.
+                os.ftruncate(fd, size)
+            with ThreadPoolExecutor(len(parts)) as executor:
+                futures = [
+                    executor.submit(
+                        self._download_part, path, fd, start, end, stop,
+                        progress)
+                    for start, end in parts]
+                try:
+                    for future in futures:
+                        future.result()
+                finally:
+                    stop.set()
+        except BaseException:
+            os.close(fd)
+            os.remove(output_file)
+            raise
+        os.close(fd)
+
+    def _download_part(self, path, fd, start, end, stop, progress):
+        # Downloads bytes [start, end) of `path` into `fd`, resuming the
+        # range after interruptions.
+        offset = start
+        attempts = self._download_retries + 1
+        while offset < end and not stop.is_set():
+            attempts -= 1
+            try:
+                response = self._send_request(
+                    'GET', path,
+                    extra_headers={'Range': f"bytes={offset}-{end - 1}"},
+                    stream=True)
+                with response, transfer.on_cancel(
+                        lambda: sessions.shutdown_response(response),
+                        progress):
+                    self._handle_any_error(response, success_codes={206})
+                    for chunk in self._retry_policy.monitor(
+                            response.iter_content(
+                                chunk_size=self._download_chunk_size)):
+                        if stop.is_set():
+                            return
+                        if progress is not None:
+                            progress.update(len(chunk))
+                        if offset + len(chunk) > end:
+                            raise util.DownloadError(
+                                f"Received more than the requested range of "
+                                f"{path}")
+                        view = memoryview(chunk)
+                        while view:
+                            written = os.pwrite(fd, view, offset)
+                            view = view[written:]
+                            offset += written
+                if offset < end and not stop.is_set():
+                    # The response ended early without an error.
+                    if attempts <= 0:
+                        raise util.DownloadError(
+                            f"Download of bytes {offset}-{end - 1} of {path} "
+                            "ended early")
+                    self._verbose_print(
+                        f"Download of bytes {offset}-{end - 1} ended early; "
+                        f"resuming, {attempts} tries remain.")
+            except requests.exceptions.RequestException as e:
+                if attempts <= 0:
+                    raise util.DownloadError(
+                        f"Download of bytes {offset}-{end - 1} of {path} "
+                        f"failed ({e})")
+                self._verbose_print(
+                    f"Download of bytes {offset}-{end - 1} interrupted "
+                    f"({e}); resuming, {attempts} tries remain.")
+
+    def _download_resumable(self, hash, partial_file, source_key):
+        # Downloads to `partial_file`, resuming from any existing contents
+        # (recorded under `source_key`, unless None), and returns the
+        # `HashWriter` used.
+        path = self._object_path(hash)
+        attempts = self._download_retries + 1
+        while True:
+            attempts -= 1
+            try:
+                return self._download_range(
+                    hash, path, partial_file, source_key)
+            except requests.exceptions.RequestException as e:
+                if attempts <= 0:
+                    raise util.DownloadError(
+                        f"Download interrupted ({e}); partial file kept at "
+                        f"{partial_file}")
+                self._verbose_print(
+                    f"Download interrupted ({e}); resuming, {attempts} tries "
+                    "remain.")
+
+    def _download_range(self, hash, path, partial_file, source_key):
+        info = None
+        if source_key is not None:
+            info = self._cache.read_partial_info(hash, source_key)
+        offset = 0
+        if info is not None and os.path.exists(partial_file):
+            offset = os.path.getsize(partial_file)
+        headers = {}
+        if offset > 0:
+            headers['Range'] = f"bytes={offset}-"
+            if info.get('etag'):
+                headers['If-Range'] = info['etag']
+        response = self._send_request(
+            'GET', path, extra_headers=headers, stream=True)
+        with response, transfer.on_cancel(
+                lambda: sessions.shutdown_response(response)):
+            resumed = False
+            if offset > 0 and response.status_code == 206:
+                start, size = _parse_content_range(
+                    response.headers.get('Content-Range'))
+                resumed = (start == offset and size == info.get('size'))
+                if not resumed:
+                    self._write_partial_info(hash, source_key, None)
+                    raise requests.exceptions.RequestException(
+                        "Unexpected Content-Range; restarting")
+            elif offset > 0 and response.status_code == 416:
+                # Our partial file is no longer a prefix of the object.
+                self._write_partial_info(hash, source_key, None)
+                raise requests.exceptions.RequestException(
+                    "Range not satisfiable; restarting")
+            else:
+                self._handle_any_error(response)
+                size = response.headers.get('Content-Length')
+                info = {
+                    'etag': response.headers.get('ETag'),
+                    'size': size and int(size),
+                }
+                self._write_partial_info(hash, source_key, info)
+            if resumed:
+                self._verbose_print(f"Resuming download from byte {offset}")
+            with open(partial_file, resumed and 'ab' or 'wb') as file:
+                writer = hashes.HashWriter(hash.hash_type, file)
+                if resumed:
+                    writer.include_file(partial_file)
+                for chunk in self._retry_policy.monitor(
+                        response.iter_content(
+                            chunk_size=self._download_chunk_size)):
+                    writer.write(chunk)
+        return writer
+
+    def _metadata_headers(self, project_relpath, filepath):
+        # These extra headers have no effect on the backend but can aid in
+        # analysis and debugging by preserving some of the data used in the
+        # girder backend.
+        return {
+            'x-amz-meta-original-path': project_relpath,
+            'x-amz-meta-original-name': os.path.basename(filepath),
+            'x-amz-meta-original-time': datetime.utcnow().isoformat(),
+        }
 
     def upload_file(self, hash, project_relpath, filepath):
         if self._disable_upload:
             raise RuntimeError("Upload disabled")
-        with open(filepath, 'rb') as file:
-            path = self._object_path(hash)
+        path = self._object_path(hash)
+        if self._use_multipart(os.stat(filepath).st_size):
+            self._upload_multipart(path, project_relpath, filepath)
+        else:
+            with open(filepath, 'rb') as file:
+                response = self._send_request(
+                    'PUT', path, data=file,
+                    extra_headers=self._metadata_headers(
+                        project_relpath, filepath))
+                self._handle_any_error(response, success_codes={200, 201})
+        print("File uploaded successfully!")
+
+    def _use_multipart(self, size):
+        return (size > self._max_single_upload_size or
+                (self._multipart_upload and size > self._multipart_part_size))
+
+    def _get_part_size(self, size):
+        # Parts grow beyond `multipart_part_size` if there would be too many.
+        return max(self._multipart_part_size, -(-size // _MAX_PARTS))
+
+    def _upload_multipart(self, path, project_relpath, filepath, reader=None):
+        # Uploads `filepath` in parts. If `reader` is given, the parts are
+        # read from it in order instead (so that it sees the whole file).
+        size = os.stat(filepath).st_size
+        part_size = self._get_part_size(size)
+        parts = range(0, size, part_size)
+
+        def upload_parts(upload_id):
+            self._verbose_print(
+                f"Uploading {size} bytes in {len(parts)} parts "
+                f"(id {upload_id})")
+            if reader is not None:
+                return self._upload_parts_streamed(
+                    path, upload_id, reader, size, part_size)
+            with ThreadPoolExecutor(self._multipart_concurrency) as executor:
+                return list(executor.map(
+                    lambda start: self._upload_file_part(
+                        path, upload_id, start // part_size + 1, filepath,
+                        start, min(part_size, size - start)),
+                    parts))
+
+        self._multipart(
+            path, upload_parts,
+            extra_headers=self._metadata_headers(project_relpath, filepath))
+
+    def _multipart(self, path, upload_parts, extra_headers=None):
+        # Initiates a multipart upload to `path`, uploads its parts with
+        # `upload_parts(upload_id)` (which returns their ETags, in order), and
+        # completes it, or aborts it on failure.
+        response = self._send_request(
+            'POST', f"{path}?uploads", extra_headers=extra_headers)
+        self._handle_any_error(response)
+        upload_id = _parse_xml(response, 'UploadId')
+        try:
+            etags = upload_parts(upload_id)
+            body = "".join(
+                f"<Part><PartNumber>{number}</PartNumber>"
+                f"<ETag>{etag}</ETag></Part>"
+                for number, etag in enumerate(etags, start=1))
             response = self._send_request(
-                'PUT', path, data=file,
-                # These extra headers have no effect on the backend but
-                # can aid in analysis and debugging by preserving some of the
-                # data used in the girder backend.
-                extra_headers={
-                    'x-amz-meta-original-path': project_relpath,
-                    'x-amz-meta-original-name': os.path.basename(filepath),
-                    'x-amz-meta-original-time': datetime.utcnow().isoformat(),
-                })
+                'POST', f"{path}?uploadId={upload_id}",
+                data=("<CompleteMultipartUpload>{}</CompleteMultipartUpload>"
+                      .format(body)).encode("utf-8"))
+            self._handle_any_error(response)
+            # S3 may report errors in the body of a successful response.
+            if _parse_xml(response, 'Code', required=False) is not None:
+                raise RuntimeError(
+                    f"Failed to complete upload of {path}: {response.text}")
+        except BaseException:
+            # Abort the upload so that the server discards any stored parts,
+            # without masking the original error.
+            try:
+                response = self._send_request(
+                    'DELETE', f"{path}?uploadId={upload_id}")
+                self._handle_any_error(
+                    response, success_codes={200, 204, 404})
+            except (RuntimeError, requests.exceptions.RequestException) as e:
+                print(f"Failed to abort upload {upload_id}: {e}")
+            raise
+
+    def _upload_file_part(self, path, upload_id, number, filepath, start,
+                          length):
+        with _FileRange(filepath, start, length) as data:
+            return self._upload_part(path, upload_id, number, data=data)
+
+    def _upload_parts_streamed(self, path, upload_id, reader, size,
+                               part_size):
+        # Reads parts from `reader` in order, holding at most
+        # `multipart_concurrency` of them in memory while they are uploaded.
+        slots = threading.Semaphore(self._multipart_concurrency)
+        futures = []
+        with ThreadPoolExecutor(self._multipart_concurrency) as executor:
+            for number, start in enumerate(range(0, size, part_size), 1):
+                slots.acquire()
+                if any(future.done() and future.exception() is not None
+                       for future in futures):
+                    break
+                data = reader.read(min(part_size, size - start))
+                future = executor.submit(
+                    self._upload_part, path, upload_id, number, data=data)
+                future.add_done_callback(lambda _: slots.release())
+                futures.append(future)
+        return [future.result() for future in futures]
+
+    def _upload_part(self, path, upload_id, number, data=None,
+                     extra_headers=None):
+        # Uploads (or, with `x-amz-copy-source` headers, copies) one part,
+        # returning its ETag.
+        attempts = self._multipart_part_retries + 1
+        while True:
+            attempts -= 1
+            try:
+                response = self._send_request(
+                    'PUT', f"{path}?partNumber={number}&uploadId={upload_id}",
+                    data=data, extra_headers=extra_headers)
+                if response.status_code == 200 or attempts <= 0:
+                    self._handle_any_error(response)
+                    # Copied parts report their ETag in the body.
+                    return (response.headers.get('ETag') or
+                            _parse_xml(response, 'ETag'))
+                reason = response.status_code
+            except requests.exceptions.RequestException as e:
+                if attempts <= 0:
+                    raise
+                reason = e
+            self._verbose_print(
+                f"Retrying part {number} after {reason}; {attempts} "
+                "tries remain.")
+
+    def _copy_source(self, path):
+        # Names `path` as `/{bucket}/{key}` for `x-amz-copy-source`.
+        if self._bucket is not None:
+            path = f"/{self._bucket}/{path.lstrip('/')}"
+        return urllib.parse.quote(path)
+
+    def _copy_object(self, source_path, path, size):
+        # Copies an object of `size` bytes on the server.
+        headers = {'x-amz-copy-source': self._copy_source(source_path)}
+        if size <= self._max_single_upload_size:
+            response = self._send_request('PUT', path, extra_headers=headers)
             self._handle_any_error(response, success_codes={200, 201})
-            print("File uploaded successfully!")
+            # S3 may report errors in the body of a successful response.
+            if _parse_xml(response, 'Code', required=False) is not None:
+                raise RuntimeError(
+                    f"Failed to copy {source_path}: {response.text}")
+            return
+        part_size = self._get_part_size(size)
+
+        def copy_part(upload_id, start):
+            end = min(start + part_size, size) - 1
+            return self._upload_part(
+                path, upload_id, start // part_size + 1,
+                extra_headers=headers | {
+                    'x-amz-copy-source-range': f"bytes={start}-{end}"})
+
+        def copy_parts(upload_id):
+            with ThreadPoolExecutor(self._multipart_concurrency) as executor:
+                return list(executor.map(
+                    lambda start: copy_part(upload_id, start),
+                    range(0, size, part_size)))
+
+        self._multipart(path, copy_parts)
+
+    def supports_single_pass_upload(self):
+        return self._single_pass_upload and not self._disable_upload
+
+    def upload_file_single_pass(self, hash_type, project_relpath, filepath,
+                                is_uploaded):
+        if self._disable_upload:
+            raise RuntimeError("Upload disabled")
+        size = os.stat(filepath).st_size
+        multipart = self._use_multipart(size)
+        if multipart and self._get_part_size(size) > self._multipart_part_size:
+            # Staging would hold oversized parts in memory; hash the file
+            # first instead.
+            hash = hash_type.compute(filepath)
+            if not is_uploaded(hash):
+                self.upload_file(hash, project_relpath, filepath)
+            return hash
+        staging_path = f"{self._staging_path}/{uuid.uuid4()}"
+        with hashes.HashReader(hash_type, filepath) as reader:
+            if multipart:
+                self._upload_multipart(
+                    staging_path, project_relpath, filepath, reader=reader)
+            else:
+                response = self._send_request(
+                    'PUT', staging_path, data=reader,
+                    extra_headers=self._metadata_headers(
+                        project_relpath, filepath))
+                self._handle_any_error(response, success_codes={200, 201})
+            hash = reader.get_hash()
+        try:
+            if not is_uploaded(hash):
+                self._copy_object(staging_path, self._object_path(hash), size)
+                print("File uploaded successfully!")
+        finally:
+            response = self._send_request('DELETE', staging_path)
+            self._handle_any_error(response, success_codes={200, 204, 404})
+        return hash
+
+
+def _parse_content_range(value):
+    # Parses "bytes {start}-{end}/{size}", returning (start, size).
+    try:
+        unit, spec = value.split(" ", 1)
+        byte_range, size = spec.split("/")
+        start = int(byte_range.split("-")[0])
+        return start, (None if size == "*" else int(size))
+    except (AttributeError, ValueError):
+        return None, None
+
+
+def _parse_xml(response, tag, required=True):
+    # Returns the text of the first `tag` element of an S3 XML response.
+    try:
+        root = ElementTree.fromstring(response.content)
+        element = root.find(f".//{{*}}{tag}")
+    except ElementTree.ParseError:
+        element = None
+    if element is None:
+        if required:
+            raise RuntimeError(
+                f"Missing {tag} in response from {response.request.url}")
+        return None
+    return element.text
+
+
+class _FileRange(object):
+    """A readable view of `length` bytes of a file from `start`, to be
+    streamed as a request body. """
+    def __init__(self, filepath, start, length):
+        self._file = open(filepath, 'rb')
+        self._start = start
+        self._length = length
+        self.seek(0)
+
+    def read(self, size=-1):
+        remaining = self._start + self._length - self._file.tell()
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        return self._file.read(size)
+
+    def seek(self, offset):
+        assert offset == 0, "Can only rewind"
+        self._file.seek(self._start)
+
+    def __len__(self):
+        return self._length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._file.close()
@@ -1,29 +1,110 @@
-import shutil
+import hashlib
+import json
 import os
+import shutil
+import stat
+import threading
+import time
 
 from bazel_external_data import util, hashes
 from bazel_external_data.core import Backend
 
 
 class MockBackend(Backend):
-    """ A mock backend for testing. """
+    """ A mock backend for testing.
+
+    The hashes of the files in `dir` and `upload_dir` are indexed lazily, and
+    the index of each directory is persisted under `{state_dir}/mock_index`,
+    keyed on the stat data of the directory and its files. Loading an
+    unchanged directory thus only reads its index; files are re-hashed only
+    if they have changed. """
+    # Checks are lookups in a local directory.
+    remember_checks = False
+
     def __init__(self, config, project_root, user):
         Backend.__init__(self, config, project_root, user)
         self._dir = os.path.join(project_root, config['dir'])
         self._upload_dir = os.path.join(project_root, config['upload_dir'])
         self._hash_type = hashes.sha512
+        self._index_dir = os.path.join(user.state_dir, "mock_index")
+        self._lock = threading.Lock()
+        self._map = None
+        # Whether the stat data of every indexed file has been checked.
+        self._validated = False
+
+    def _get_index_path(self, cur_dir):
+        key = hashlib.sha1(
+            os.path.abspath(cur_dir).encode("utf8")).hexdigest()
+        return os.path.join(self._index_dir, key + ".json")
 
-        # Crawl through files and compute hashes.
-        self._map = {}
-        def crawl(cur_dir):
-            for file in os.listdir(cur_dir):
-                filepath = os.path.join(cur_dir, file)
-                if os.path.isfile(filepath):
-                    hash = self._hash_type.compute(filepath)
-                    self._map[hash] = filepath
-        crawl(self._dir)
-        if os.path.exists(self._upload_dir):
-            crawl(self._upload_dir)
+    def _crawl(self, cur_dir, index):
+        # Hashes the files directly in `cur_dir`, reusing the entries of
+        # `index` whose stat data is unchanged.
+        files = {}
+        for file in os.listdir(cur_dir):
+            filepath = os.path.join(cur_dir, file)
+            try:
+                st = os.stat(filepath)
+            except FileNotFoundError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            key = util.get_stat_key(st)
+            entry = index.get(file)
+            if entry is not None and entry[:-1] == key:
+                files[file] = entry
+            else:
+                hash = self._hash_type.compute(filepath)
+                files[file] = key + [hash.get_value()]
+        return files
+
+    def _load_dir(self, cur_dir, validate):
+        # Returns {name: stat key + [hash value]} for the files in `cur_dir`.
+        try:
+            dir_key = util.get_stat_key(os.stat(cur_dir))
+        except FileNotFoundError:
+            return {}
+        index_path = self._get_index_path(cur_dir)
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {"dir": None, "files": {}}
+        if index["dir"] == dir_key and not validate:
+            # No files were added or removed.
+            return index["files"]
+        files = self._crawl(cur_dir, index["files"])
+        # A directory changed within the timestamp granularity could change
+        # again without its mtime changing, so its listing is not trusted.
+        if time.time() - dir_key[1] / 1e9 < hashes.HashMemo.racy_window:
+            dir_key = None
+        if files != index["files"] or dir_key != index["dir"]:
+            util.write_atomic(
+                index_path, json.dumps({"dir": dir_key, "files": files}))
+        return files
+
+    def _get_map(self, validate=False):
+        # @param validate If true, ensure that the stat data of every file is
+        # unchanged (e.g. as files may be modified in place).
+        with self._lock:
+            if self._map is None or (validate and not self._validated):
+                self._map = {}
+                for cur_dir in [self._dir, self._upload_dir]:
+                    files = self._load_dir(cur_dir, validate)
+                    for file, entry in files.items():
+                        hash = self._hash_type.create(entry[-1])
+                        self._map[hash] = os.path.join(cur_dir, file)
+                self._validated = validate
+            return self._map
+
+    def _find(self, hash):
+        # Returns the path of a file with the given hash, or None.
+        filepath = self._get_map().get(hash)
+        if filepath is None or not hash.compare_file(
+                filepath, do_throw=False):
+            # Our index may be stale.
+            filepath = self._get_map(validate=True).get(hash)
+        return filepath
 
     def _check_hash_type(self, hash):
         if hash.hash_type != self._hash_type:
@@ -31,23 +112,33 @@ class MockBackend(Backend):
 
     def check_file(self, hash, project_relpath):
         self._check_hash_type(hash)
-        return hash in self._map
+        return self._find(hash) is not None
+
+    def check_files(self, hashes):
+        for hash in hashes:
+            self._check_hash_type(hash)
+        return {hash: self._find(hash) is not None for hash in hashes}
 
     def download_file(self, hash, project_relpath, output_file):
         self._check_hash_type(hash)
-        filepath = self._map.get(hash)
+        filepath = self._find(hash)
         if filepath is None:
             raise util.DownloadError("Unknown hash: {}".format(hash))
-        shutil.copy(filepath, output_file)
+        with open(filepath, 'rb') as fin, open(output_file, 'wb') as fout:
+            writer = hashes.HashWriter(self._hash_type, fout)
+            shutil.copyfileobj(fin, writer)
+        shutil.copymode(filepath, output_file)
+        return writer.get_hash(output_file)
 
     def upload_file(self, hash, project_relpath, filepath):
         self._check_hash_type(hash)
-        assert hash not in self._map
+        assert self._find(hash) is None
         dest = os.path.join(self._upload_dir, hash.get_value())
         assert not os.path.exists(dest)
         dest_dir = os.path.dirname(dest)
         os.makedirs(dest_dir, exist_ok=True)
         # Copy the file.
         shutil.copy(filepath, dest)
-        # Store the SHA.
-        self._map[hash] = dest
+        # Store the SHA; the persisted index is updated on the next load.
+        with self._lock:
+            self._map[hash] = dest
@@ -0,0 +1,173 @@
+"""
+Retry policies and per-host circuit breakers for HTTP backends.
+"""
+
+import importlib
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+
+from bazel_external_data import util
+
+
+class CircuitOpenError(util.DownloadError):
+    """Raised without contacting a host that is considered down, so that
+    callers (e.g. `Remote` falling back to its overlay) fail fast. """
+    pass
+
+
+class StalledError(requests.exceptions.RequestException):
+    """Raised when a streamed response falls below the minimum throughput;
+    like other request errors, the transfer may then be resumed. """
+    pass
+
+
+class RetryPolicy(object):
+    """Decides timeouts and when (and how long to wait before) retrying a
+    request. Configured per remote via its `retry` configuration; a remote
+    may substitute a subclass with `retry: {class: "package.module.Class"}`.
+    """
+    def __init__(self, config):
+        # Seconds to wait to connect, and between bytes received.
+        self.connect_timeout = config.get('connect_timeout', 10)
+        self.read_timeout = config.get('read_timeout', 60)
+        # Retries within one session, and retries of the whole session.
+        self.retries = config.get('retries', 11)
+        self.session_retries = config.get('session_retries', 3)
+        # The first delay, increased by `backoff_multiplier` with each
+        # failure up to `max_delay`, and randomly shortened by up to the
+        # `jitter` fraction so that clients do not retry in lockstep.
+        self.delay = config.get('delay', 0.2)
+        self.backoff_multiplier = config.get('backoff_multiplier', 1.8)
+        self.max_delay = config.get('max_delay', 30)
+        self.jitter = config.get('jitter', 0.5)
+        # Total seconds to spend obtaining a response, including all retries
+        # (None: unlimited).
+        self.deadline = config.get('deadline', 900)
+        self.retry_statuses = set(
+            config.get('retry_statuses', [500, 502, 503, 504]))
+        # Streamed responses which receive fewer than `min_throughput` bytes
+        # per second, averaged over `stall_window` seconds, are abandoned
+        # (None: never).
+        self.min_throughput = config.get('min_throughput', 1024)
+        self.stall_window = config.get('stall_window', 60)
+        # Consecutive connection failures after which a host is considered
+        # down, and for how many seconds.
+        self.circuit_failures = config.get('circuit_failures', 5)
+        self.circuit_reset_time = config.get('circuit_reset_time', 30)
+
+    def start(self):
+        """Returns the time at which retrying a new request must stop, or
+        None. """
+        if self.deadline is None:
+            return None
+        return time.monotonic() + self.deadline
+
+    def get_timeout(self, deadline):
+        """Returns the `requests` timeout for an attempt. """
+        read_timeout = self.read_timeout
+        if deadline is not None:
+            read_timeout = max(0.1, min(
+                read_timeout, deadline - time.monotonic()))
+        return (self.connect_timeout, read_timeout)
+
+    def get_delay(self, failures, deadline):
+        """Returns the seconds to wait after `failures` failed attempts, or
+        None if there is no time left to retry. """
+        delay = min(self.delay * self.backoff_multiplier ** (failures - 1),
+                    self.max_delay)
+        delay *= 1 - self.jitter * random.random()
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def is_retryable(self, response):
+        return response.status_code in self.retry_statuses
+
+    def monitor(self, chunks):
+        """Yields from an iterable of received chunks, raising
+        `StalledError` if the minimum throughput is not met. """
+        if self.min_throughput is None:
+            yield from chunks
+            return
+        window_start = time.monotonic()
+        window_bytes = 0
+        for chunk in chunks:
+            yield chunk
+            window_bytes += len(chunk)
+            elapsed = time.monotonic() - window_start
+            if elapsed >= self.stall_window:
+                if window_bytes < self.min_throughput * elapsed:
+                    raise StalledError(
+                        f"Transfer stalled: {window_bytes} bytes in "
+                        f"{elapsed:.0f}s")
+                window_start = time.monotonic()
+                window_bytes = 0
+
+
+def load_policy(config):
+    """Creates the retry policy for a remote's `retry` configuration. """
+    config = config or {}
+    policy_cls = RetryPolicy
+    class_name = config.get('class')
+    if class_name is not None:
+        module_name, cls_name = class_name.rsplit(".", 1)
+        policy_cls = getattr(importlib.import_module(module_name), cls_name)
+    return policy_cls(config)
+
+
+class CircuitBreaker(object):
+    """Tracks consecutive connection failures to a host. Once there are too
+    many, requests fail immediately until `reset_time` has passed, after
+    which one request at a time is let through to probe the host. """
+    def __init__(self, host):
+        self.host = host
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = None
+
+    def check(self, policy):
+        """Raises `CircuitOpenError` if the host is considered down. """
+        with self._lock:
+            if self._open_until is None:
+                return
+            now = time.monotonic()
+            if now < self._open_until:
+                raise CircuitOpenError(
+                    f"{self.host} appears to be down after "
+                    f"{self._failures} consecutive connection failures; "
+                    "not retrying for "
+                    f"{self._open_until - now:.0f}s")
+            # Half-open: allow this request, but fail fast until it succeeds.
+            self._open_until = now + policy.circuit_reset_time
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._open_until = None
+
+    def record_failure(self, policy):
+        with self._lock:
+            self._failures += 1
+            if (policy.circuit_failures is not None and
+                    self._failures >= policy.circuit_failures):
+                self._open_until = (
+                    time.monotonic() + policy.circuit_reset_time)
+
+
+_breakers_lock = threading.Lock()
+_breakers = {}
+
+
+def get_circuit_breaker(url):
+    """Returns the process-wide circuit breaker for the host of `url`. """
+    parts = urllib.parse.urlsplit(url)
+    host = "{}://{}".format(parts.scheme, parts.netloc)
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(host)
+        return breaker
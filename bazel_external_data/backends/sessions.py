@@ -0,0 +1,101 @@
+"""
+Process-wide registry of HTTP sessions, keyed by host, so that all backends
+(e.g. a remote and its overlays) talking to the same server share kept-alive
+connections rather than paying for a new TCP and TLS handshake per request.
+"""
+
+import threading
+import urllib.parse
+
+import requests
+
+# Defaults for the `http_pool` configuration, which may be set in the user's
+# `core` configuration and overridden per remote.
+POOL_CONFIG_DEFAULT = {
+    # Number of hosts whose connections are kept by an adapter.
+    "pool_connections": 10,
+    # Connections kept alive per host; the largest requested by any backend
+    # using the host is used.
+    "pool_maxsize": 16,
+    # Whether to block rather than open extra (discarded) connections when
+    # the pool is exhausted.
+    "pool_block": False,
+    # If false, connections are closed after each request.
+    "keep_alive": True,
+}
+
+_lock = threading.Lock()
+_sessions = {}  # {host: (session, pool_config)}
+
+
+def get_pool_config(user, config):
+    """Merges the `http_pool` settings of the user's `core` configuration
+    with those of a remote's configuration. """
+    pool_config = dict(POOL_CONFIG_DEFAULT)
+    pool_config.update(user.config['core'].get('http_pool') or {})
+    pool_config.update(config.get('http_pool') or {})
+    return pool_config
+
+
+def _get_host(url):
+    parts = urllib.parse.urlsplit(url)
+    return "{}://{}".format(parts.scheme, parts.netloc)
+
+
+def _new_adapter(pool_config):
+    return requests.adapters.HTTPAdapter(
+        pool_connections=pool_config["pool_connections"],
+        pool_maxsize=pool_config["pool_maxsize"],
+        pool_block=pool_config["pool_block"])
+
+
+def _new_session(host, pool_config):
+    session = requests.Session()
+    session.mount(host, _new_adapter(pool_config))
+    if not pool_config["keep_alive"]:
+        session.headers["Connection"] = "close"
+    return session
+
+
+def get_session(url, pool_config):
+    """Returns the shared session for the host of `url`.
+    @param pool_config
+        Pool settings, @see POOL_CONFIG_DEFAULT. If a session already exists
+        for the host, its pool is grown if `pool_maxsize` is larger. """
+    host = _get_host(url)
+    with _lock:
+        session, current = _sessions.get(host, (None, None))
+        if session is None:
+            session = _new_session(host, pool_config)
+            _sessions[host] = (session, pool_config)
+        elif pool_config["pool_maxsize"] > current["pool_maxsize"]:
+            # Replace the adapter of the session (which may be in use) rather
+            # than the session. Closing the old adapter closes its idle
+            # connections now, and those in use once released.
+            current = dict(current, pool_maxsize=pool_config["pool_maxsize"])
+            adapter = session.get_adapter(host)
+            session.mount(host, _new_adapter(current))
+            adapter.close()
+            _sessions[host] = (session, current)
+        return session
+
+
+def shutdown_response(response):
+    """Interrupts reads of a streamed `response` blocked on other threads
+    (e.g. once its transfer is cancelled, @see transfer.on_cancel), which
+    merely closing it does not. """
+    shutdown = getattr(response.raw, "shutdown", None)  # urllib3 >= 2.3.
+    if shutdown is not None:
+        shutdown()
+    else:
+        response.close()
+
+
+def reset_session(url):
+    """Replaces the shared session for the host of `url` (e.g. if retrying
+    within the same session does not help). """
+    host = _get_host(url)
+    with _lock:
+        session, pool_config = _sessions[host]
+        _sessions[host] = (_new_session(host, pool_config), pool_config)
+    session.close()
@@ -0,0 +1,142 @@
+import errno
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from bazel_external_data import core, hashes
+from bazel_external_data.backends.fs import FsBackend
+
+
+class FsBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(
+            dir=os.environ.get("TEST_TEMPDIR", None))
+        self.user = core.User({"core": {
+            "cache_dir": os.path.join(self.test_dir, "cache")}})
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _make_backend(self, config={}):
+        config = dict(config, path="store")
+        return FsBackend(config, self.test_dir, self.user)
+
+    def _make_file(self, contents):
+        filepath = os.path.join(self.test_dir, "input.txt")
+        with open(filepath, 'w') as f:
+            f.write(contents)
+        return filepath, hashes.sha512.compute(filepath, use_memo=False)
+
+    def test_lifecycle(self):
+        backend = self._make_backend()
+        filepath, hash = self._make_file("contents")
+        self.assertFalse(backend.check_file(hash, "input.txt"))
+        backend.upload_file(hash, "input.txt", filepath)
+        self.assertTrue(backend.check_file(hash, "input.txt"))
+        # Stored in the sharded layout, read-only, with no temporary files.
+        value = hash.get_value()
+        stored = os.path.join(
+            self.test_dir, "store", "sha512", value[0:2], value[2:4], value)
+        self.assertEqual(os.listdir(os.path.dirname(stored)), [value])
+        self.assertFalse(os.stat(stored).st_mode & stat.S_IWUSR)
+        # Uploading again is a no-op.
+        backend.upload_file(hash, "input.txt", filepath)
+
+        # Hard links are opt-in.
+        output_file = os.path.join(self.test_dir, "default")
+        self._make_backend().download_file(hash, "input.txt", output_file)
+        self.assertFalse(os.path.samefile(stored, output_file))
+
+        for strategy in ["hardlink", "copy"]:
+            backend = self._make_backend({"materialize": [strategy]})
+            output_file = os.path.join(self.test_dir, strategy)
+            self.assertIsNone(
+                backend.download_file(hash, "input.txt", output_file))
+            self.assertTrue(hash.compare_file(output_file, do_throw=False))
+            self.assertEqual(
+                os.path.samefile(stored, output_file), strategy == "hardlink")
+
+    def test_hardlink_cache(self):
+        # Files hard-linked into the cache are not modified.
+        backend = self._make_backend({"materialize": ["hardlink"]})
+        filepath, hash = self._make_file("linked")
+        backend.upload_file(hash, "input.txt", filepath)
+        remote = core.Remote(
+            {"backend": "fs"}, "fs", self.user.cache,
+            lambda *args: backend, None)
+        value = hash.get_value()
+        stored = os.path.join(
+            self.test_dir, "store", "sha512", value[0:2], value[2:4], value)
+        st = os.stat(stored)
+        output_file = os.path.join(self.test_dir, "output")
+        remote.download_file(hash, "input.txt", output_file)
+        self.assertTrue(os.path.samefile(
+            stored, self.user.cache.get_path(hash)))
+        self.assertEqual(os.stat(stored).st_mode, st.st_mode)
+        self.assertTrue(self.user.cache.is_verified(hash))
+
+    def test_single_pass_upload(self):
+        backend = self._make_backend()
+        filepath, hash = self._make_file("single pass")
+        self.assertTrue(backend.supports_single_pass_upload())
+        uploaded = backend.upload_file_single_pass(
+            hashes.sha512, "input.txt", filepath, lambda hash: False)
+        self.assertEqual(uploaded, hash)
+        self.assertTrue(backend.check_file(hash, "input.txt"))
+        self.assertEqual(
+            os.listdir(os.path.join(self.test_dir, "store", "staging")), [])
+
+    def test_no_hardlinks(self):
+        # Filesystems without hard links.
+        backend = self._make_backend()
+        filepath, hash = self._make_file("no links")
+        value = hash.get_value()
+        stored = os.path.join(
+            self.test_dir, "store", "sha512", value[0:2], value[2:4], value)
+        unsupported = OSError(errno.EOPNOTSUPP, "Not supported")
+        with mock.patch("os.link", side_effect=unsupported):
+            backend.upload_file(hash, "input.txt", filepath)
+            self.assertTrue(hash.compare_file(stored, do_throw=False))
+            self.assertFalse(os.stat(stored).st_mode & stat.S_IWUSR)
+            # A file stored concurrently is not replaced.
+            st = os.stat(stored)
+            tmp_file = backend._get_tmp_file(os.path.dirname(stored))
+            shutil.copy(filepath, tmp_file)
+            backend._store(tmp_file, stored)
+            self.assertEqual(os.stat(stored).st_ino, st.st_ino)
+            self.assertEqual(os.listdir(os.path.dirname(stored)), [value])
+        # Other errors are not mistaken for a lack of support.
+        other_file, other_hash = self._make_file("other")
+        with mock.patch("os.link", side_effect=OSError(errno.EIO, "I/O")):
+            with self.assertRaises(OSError):
+                backend.upload_file(other_hash, "input.txt", other_file)
+        self.assertFalse(backend.check_file(other_hash, "input.txt"))
+
+    def test_concurrent_upload(self):
+        backend = self._make_backend()
+        filepath, hash = self._make_file("x" * 100000)
+        errors = []
+
+        def upload():
+            try:
+                backend.upload_file(hash, "input.txt", filepath)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=upload) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        output_file = os.path.join(self.test_dir, "output")
+        backend.download_file(hash, "input.txt", output_file)
+        self.assertTrue(hash.compare_file(output_file, do_throw=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from bazel_external_data import core, hashes
+from bazel_external_data.backends import girder
+from bazel_external_data.backends.girder import GirderHashsumBackend
+
+
+class _Response(object):
+    def __init__(self, value):
+        self._value = value
+
+    def json(self):
+        return self._value
+
+
+class _MockGirder(object):
+    # Serves canned results for the endpoints used to find files, recording
+    # each request.
+    def __init__(self):
+        self.requests = []
+        self.folders = {"root": [], "sub": [], "other": []}
+        self.items = {"root": [], "sub": [], "other": []}
+        self.files = {}
+
+    def request(self, endpoint, params={}, method="get", stream=False,
+                test=False):
+        self.requests.append(endpoint)
+        if endpoint == "/resource/lookup":
+            return _Response({"_id": "root", "_modelType": "folder"})
+        if endpoint in ("/item", "/folder"):
+            if endpoint == "/item":
+                results = self.items[params["folderId"]]
+            else:
+                results = self.folders[params["parentId"]]
+            offset = params["offset"]
+            return _Response(results[offset:offset + params["limit"]])
+        # /file/hashsum/{algo}/{hash}
+        return _Response(self.files.get(endpoint.split("/")[-1], []))
+
+
+class GirderFolderTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(
+            dir=os.environ.get("TEST_TEMPDIR", None))
+        self.user = core.User({"core": {
+            "cache_dir": os.path.join(self.test_dir, "cache")}})
+        self.girder = _MockGirder()
+        patcher = mock.patch.object(
+            GirderHashsumBackend, "_request",
+            lambda backend, *args, **kwargs: self.girder.request(
+                *args, **kwargs))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _make_backend(self):
+        return GirderHashsumBackend(
+            {"url": "https://girder.example.com", "folder_path": "/files"},
+            self.test_dir, self.user)
+
+    def test_find_file(self):
+        girder_mock = self.girder
+        girder_mock.folders["root"] = [{"_id": "sub"}]
+        # A popular file, with many copies outside the folder, and one within
+        # a subfolder (beyond the first page of its listing).
+        popular = hashes.sha512.create("1" * 128)
+        girder_mock.items["other"] = [
+            {"_id": "other_{}".format(i)} for i in range(50)]
+        girder_mock.items["sub"] = [
+            {"_id": "sub_{}".format(i)} for i in range(5)]
+        girder_mock.files[popular.get_value()] = [
+            {"_id": "file_{}".format(i), "itemId": "other_{}".format(i)}
+            for i in range(50)] + [{"_id": "mine", "itemId": "sub_4"}]
+        elsewhere = hashes.sha512.create("2" * 128)
+        girder_mock.files[elsewhere.get_value()] = [
+            {"_id": "theirs", "itemId": "other_0"}]
+        absent = hashes.sha512.create("3" * 128)
+        with mock.patch.object(girder, "listing_page_size", 2):
+            backend = self._make_backend()
+            self.assertTrue(backend.check_file(popular, None))
+        # The folder is listed once, regardless of the number of copies.
+        self.assertEqual(
+            girder_mock.requests.count("/resource/lookup"), 1)
+        self.assertEqual(girder_mock.requests.count("/item"), 1 + 3)
+        self.assertEqual(girder_mock.requests.count("/folder"), 2)
+        self.assertEqual(len(girder_mock.requests), 8)
+        # Later checks only look up the hashsum, and downloads re-use the
+        # results of checks.
+        del girder_mock.requests[:]
+        self.assertEqual(
+            backend.check_files([popular, elsewhere, absent]),
+            {popular: True, elsewhere: False, absent: False})
+        self.assertEqual(len(girder_mock.requests), 2)
+        self.assertEqual(backend._find_file(popular)["_id"], "mine")
+        self.assertEqual(len(girder_mock.requests), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,21 @@
+import hashlib
 import http.server
 import json
 import os
+import re
 import requests
+import resource
+import socket
 import tempfile
 import threading
+import time
 import unittest
+from unittest import mock
+import urllib.parse
+import uuid
 
-from bazel_external_data import core, hashes
+from bazel_external_data import core, hashes, transfer, util
+from bazel_external_data.backends import retry
 from bazel_external_data.backends.http import HttpBackend
 
 
@@ -14,8 +23,26 @@ class MockHttp():
 
     class Server(http.server.ThreadingHTTPServer):
         data = {}
+        # Paths of large objects, mapped to their size, whose contents are
+        # generated on the fly (see `generate`) rather than stored.
+        generated = {}
         authorized = {"mock_auth_key"}
         fail_next_req = None  # Force the next API call to fail.
+        # Drop the connection after sending this many bytes of the next GET.
+        drop_next_get_after = None
+        # Stop sending after this many bytes of the next GET, until
+        # `release_stalled` is set.
+        stall_next_get_after = None
+        release_stalled = threading.Event()
+        served_ranges = []  # (start, end) of each partial GET served.
+        # Serve at most this many bytes of each Range request, as a complete
+        # (if short) response.
+        truncate_ranges = None
+        # Multipart uploads in progress, by id: (path, {part number: data}).
+        uploads = {}
+        # Part numbers whose next PUT should fail with the given status.
+        fail_next_part = {}
+        copied_parts = 0  # Parts copied with UploadPartCopy.
 
     class Handler(http.server.BaseHTTPRequestHandler):
         def _check_errors(self):
@@ -32,28 +59,195 @@ class MockHttp():
                 return False
             return True
 
+        def _split_query(self):
+            path, _, query = self.path.partition("?")
+            return path, urllib.parse.parse_qs(
+                query, keep_blank_values=True)
+
+        def _send_xml(self, text):
+            body = text.encode("utf-8")
+            self.send_response(200, "OK")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            # S3 multipart upload: initiate or complete.
+            if not self._check_errors():
+                return
+            path, query = self._split_query()
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+            if "uploads" in query:
+                upload_id = uuid.uuid4().hex
+                self.server.uploads[upload_id] = (path, {})
+                self._send_xml(
+                    "<InitiateMultipartUploadResult>"
+                    f"<UploadId>{upload_id}</UploadId>"
+                    "</InitiateMultipartUploadResult>")
+                return
+            upload_id = query["uploadId"][0]
+            if upload_id not in self.server.uploads:
+                self.send_error(404, "NoSuchUpload")
+                return
+            upload_path, parts = self.server.uploads.pop(upload_id)
+            numbers = [int(n) for n in re.findall(
+                rb"<PartNumber>(\d+)</PartNumber>", body)]
+            if numbers != list(range(1, len(parts) + 1)):
+                self._send_xml("<Error><Code>InvalidPart</Code></Error>")
+                return
+            self.server.data[upload_path] = b"".join(
+                parts[number] for number in numbers)
+            self._send_xml("<CompleteMultipartUploadResult/>")
+
         def do_PUT(self):
             if not self._check_errors():
                 return
-            path = self.path
+            path, query = self._split_query()
+            if "partNumber" in query:
+                self._put_part(query)
+                return
             length = int(self.headers['Content-Length'])
-            self.server.data[self.path] = self.rfile.read(length)
+            copy_source = self._get_copy_source()
+            if copy_source is not None:
+                # Server-side copy.
+                if copy_source not in self.server.data:
+                    self.send_error(404, "Missing")
+                    return
+                self.server.data[self.path] = self.server.data[copy_source]
+            else:
+                self.server.data[self.path] = self.rfile.read(length)
             self.send_response(201, "Created")
             self.end_headers()
 
+        def _get_copy_source(self):
+            # The bucket is the first component of our (path-style) paths.
+            copy_source = self.headers.get("x-amz-copy-source")
+            if copy_source is not None:
+                copy_source = urllib.parse.unquote(copy_source)
+            return copy_source
+
+        def _put_part(self, query):
+            number = int(query["partNumber"][0])
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            status = self.server.fail_next_part.pop(number, None)
+            if status is not None:
+                self.send_error(status, "Injected failure")
+                return
+            upload = self.server.uploads.get(query["uploadId"][0])
+            if upload is None:
+                self.send_error(404, "NoSuchUpload")
+                return
+            copy_source = self._get_copy_source()
+            if copy_source is not None:
+                # UploadPartCopy, which reports the ETag in the body.
+                start, end = re.fullmatch(
+                    r"bytes=(\d+)-(\d+)",
+                    self.headers["x-amz-copy-source-range"]).groups()
+                data = self.server.data[copy_source][int(start):int(end) + 1]
+                upload[1][number] = data
+                self.server.copied_parts += 1
+                self._send_xml(
+                    "<CopyPartResult><ETag>\"{}\"</ETag></CopyPartResult>"
+                    .format(hashlib.md5(data).hexdigest()))
+                return
+            upload[1][number] = data
+            self.send_response(200, "OK")
+            self.send_header(
+                "ETag", '"{}"'.format(hashlib.md5(data).hexdigest()))
+            self.end_headers()
+
+        def do_DELETE(self):
+            if not self._check_errors():
+                return
+            path, query = self._split_query()
+            if "uploadId" in query:
+                if self.server.uploads.pop(query["uploadId"][0], None) is None:
+                    self.send_error(404, "NoSuchUpload")
+                    return
+                self.send_response(204, "No Content")
+                self.end_headers()
+                return
+            if self.server.data.pop(self.path, None) is None:
+                self.send_error(404, "Missing")
+                return
+            self.send_response(204, "No Content")
+            self.end_headers()
+
         def do_GET(self):
             if not self._check_errors():
                 return
-            if self.path in self.server.data:
+            if self.path in self.server.generated:
+                size = self.server.generated[self.path]
                 self.send_response(200, "OK")
+                self.send_header("Content-Length", str(size))
                 self.end_headers()
-                self.wfile.write(self.server.data[self.path])
+                if self.command == "GET":
+                    for chunk in MockHttp.generate(size):
+                        self.wfile.write(chunk)
+            elif self.path in self.server.data:
+                self._send_data(self.server.data[self.path])
             else:
                 self.send_error(404, "Missing")
 
+        def _send_data(self, data):
+            # Supports (If-)Range requests, as used to resume downloads.
+            etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+            start, end = 0, len(data)
+            byte_range = self.headers.get("Range")
+            if_range = self.headers.get("If-Range")
+            if byte_range is not None and if_range in (None, etag):
+                first, last = byte_range[len("bytes="):].split("-")
+                start = int(first)
+                if last:
+                    end = min(int(last) + 1, end)
+                if start >= end:
+                    self.send_error(416, "Range Not Satisfiable")
+                    return
+                if self.server.truncate_ranges is not None:
+                    end = min(end, start + self.server.truncate_ranges)
+                self.send_response(206, "Partial Content")
+                self.send_header(
+                    "Content-Range", f"bytes {start}-{end - 1}/{len(data)}")
+                if self.command == "GET":
+                    self.server.served_ranges.append((start, end))
+            else:
+                self.send_response(200, "OK")
+            self.send_header("Content-Length", str(end - start))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.end_headers()
+            if self.command != "GET":
+                return
+            body = data[start:end]
+            drop_after = self.server.drop_next_get_after
+            if drop_after is not None:
+                self.server.drop_next_get_after = None
+                body = body[:drop_after]
+                self.close_connection = True
+            stall_after = self.server.stall_next_get_after
+            if stall_after is not None:
+                self.server.stall_next_get_after = None
+                self.wfile.write(body[:stall_after])
+                self.wfile.flush()
+                self.server.release_stalled.wait(10)
+                body = body[stall_after:]
+            try:
+                self.wfile.write(body)
+            except ConnectionError:
+                # The client gave up (e.g. while stalled).
+                pass
+
         def do_HEAD(self):
             return self.do_GET()
 
+    @staticmethod
+    def generate(size, chunk_size=1 << 16):
+        """Yields deterministic contents for a generated object. """
+        block = bytes(range(256)) * (chunk_size // 256)
+        for start in range(0, size, chunk_size):
+            yield block[:min(chunk_size, size - start)]
+
     def __init__(self):
         self.server = None
         self.server_thread = None
@@ -153,8 +347,345 @@ class HttpTest(unittest.TestCase):
         dut.upload_file(hashsum, file_in_project, local_file)
         self.assertTrue(dut.check_file(hashsum, file_in_project))
         os.remove(local_file)
-        dut.download_file(hashsum, file_in_project, local_file)
+        written_hash = dut.download_file(hashsum, file_in_project, local_file)
         self.assertTrue(os.path.exists(local_file))
+        # The download should be hashed as it is written.
+        self.assertEqual(written_hash, hashsum)
+
+    def _has_staged_files(self):
+        return any(path.startswith("/master/staging/")
+                   for path in self.server.server.data)
+
+    def test_single_pass_upload(self):
+        """Upload a file while hashing it, via a staging key."""
+        project_config = self._project_config()
+        project_config["remotes"]["unit_test_remote"][
+            "single_pass_upload"] = True
+        dut = self._make_dut(project_config=project_config)
+        self.assertTrue(dut.supports_single_pass_upload())
+        filename, local_file, file_in_project = self._make_filename()
+        with open(local_file, 'w') as test_data_file:
+            test_data_file.write(f"Test data: {filename}.\n")
+        expected = hashes.sha512.compute(local_file)
+        # If the file is already present, it should not be stored.
+        hashsum = dut.upload_file_single_pass(
+            hashes.sha512, file_in_project, local_file, lambda _: True)
+        self.assertEqual(hashsum, expected)
+        self.assertFalse(dut.check_file(hashsum, file_in_project))
+        self.assertFalse(self._has_staged_files())
+        # Otherwise, it should be moved into place.
+        hashsum = dut.upload_file_single_pass(
+            hashes.sha512, file_in_project, local_file, lambda _: False)
+        self.assertEqual(hashsum, expected)
+        self.assertTrue(dut.check_file(hashsum, file_in_project))
+        self.assertFalse(self._has_staged_files())
+        os.remove(local_file)
+        dut.download_file(hashsum, file_in_project, local_file)
+        self.assertEqual(hashes.sha512.compute(local_file), expected)
+
+    def test_single_pass_upload_large(self):
+        """Large files are staged in parts, and copied in parts if above the
+        single request limit."""
+        project_config = self._project_config()
+        remote_config = project_config["remotes"]["unit_test_remote"]
+        remote_config["single_pass_upload"] = True
+        remote_config["multipart_upload"] = True
+        remote_config["multipart_part_size"] = "256K"
+        remote_config["max_single_upload_size"] = "512K"
+        dut = self._make_dut(project_config=project_config)
+        filename, local_file, file_in_project = self._make_filename()
+        with open(local_file, 'wb') as test_data_file:
+            test_data_file.write(os.urandom((1 << 20) + 1000))
+        expected = hashes.sha512.compute(local_file)
+        self.server.server.copied_parts = 0
+        hashsum = dut.upload_file_single_pass(
+            hashes.sha512, file_in_project, local_file, lambda _: False)
+        self.assertEqual(hashsum, expected)
+        self.assertEqual(self.server.server.copied_parts, 5)
+        self.assertFalse(self._has_staged_files())
+        self.assertFalse(self.server.server.uploads)
+        os.remove(local_file)
+        dut.download_file(hashsum, file_in_project, local_file)
+        self.assertEqual(hashes.sha512.compute(local_file), expected)
+
+        # Files above the limit are uploaded in parts even without
+        # `multipart_upload`. If that would take too many parts, the file is
+        # hashed first and uploaded directly, rather than staged.
+        remote_config["multipart_upload"] = False
+        dut = self._make_dut(project_config=project_config)
+        other_file = f"{self.test_dir}/other.bin"
+        with open(other_file, 'wb') as test_data_file:
+            test_data_file.write(os.urandom(600 << 10))
+        other_hash = hashes.sha512.compute(other_file)
+        self.server.server.copied_parts = 0
+        with mock.patch(
+                "bazel_external_data.backends.http._MAX_PARTS", 2):
+            self.assertEqual(dut.upload_file_single_pass(
+                hashes.sha512, "/other.bin", other_file, lambda _: False),
+                other_hash)
+        self.assertTrue(dut.check_file(other_hash, "/other.bin"))
+        self.assertEqual(self.server.server.copied_parts, 0)
+        self.assertFalse(self._has_staged_files())
+
+    def test_copy_source(self):
+        """Copy sources name the bucket."""
+        dut = self._make_dut()
+        self.assertEqual(
+            dut._copy_source("/master/staging/a b"), "/master/staging/a%20b")
+        project_config = self._project_config()
+        project_config["remotes"]["unit_test_remote"]["bucket"] = "bucket"
+        dut = self._make_dut(project_config=project_config)
+        self.assertEqual(
+            dut._copy_source("/master/staging/x"),
+            "/bucket/master/staging/x")
+
+    def test_download_memory(self):
+        """Downloads should be streamed, so memory usage should not grow with
+        the size of the file."""
+        dut = self._make_dut()
+
+        def download(size):
+            digest = hashlib.sha512()
+            for chunk in MockHttp.generate(size):
+                digest.update(chunk)
+            hashsum = hashes.sha512.create(digest.hexdigest())
+            path = dut._object_path(hashsum)
+            self.server.server.generated[path] = size
+            output_file = f"{self.test_dir}/generated_{size}.bin"
+            written_hash = dut.download_file(hashsum, path, output_file)
+            self.assertEqual(written_hash, hashsum)
+            self.assertEqual(os.stat(output_file).st_size, size)
+            os.remove(output_file)
+
+        def peak_rss():
+            # Reported in KiB on Linux.
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+        download(8 << 20)
+        rss_before = peak_rss()
+        download(256 << 20)
+        self.assertLess(peak_rss() - rss_before, 32 << 20)
+
+    def _get_partial_path(self, dut, hashsum):
+        return dut._cache.get_partial_path(
+            hashsum, dut._get_partial_key(hashsum))
+
+    def test_resume_download(self):
+        """Interrupted downloads should resume from the partial file."""
+        project_config = self._project_config()
+        # Data is kept at the granularity of whole chunks.
+        project_config["remotes"]["unit_test_remote"][
+            "download_chunk_size"] = 4096
+        dut = self._make_dut(project_config=project_config)
+        filename, local_file, file_in_project = self._make_filename()
+        with open(local_file, 'wb') as test_data_file:
+            test_data_file.write(os.urandom(100000))
+        hashsum = hashes.sha512.compute(local_file)
+        dut.upload_file(hashsum, file_in_project, local_file)
+        os.remove(local_file)
+        partial_file = self._get_partial_path(dut, hashsum)
+        # Without retries, the partial file should be kept for later.
+        dut._download_retries = 0
+        self.server.server.drop_next_get_after = 30000
+        with self.assertRaises(RuntimeError):
+            dut.download_file(hashsum, file_in_project, local_file)
+        self.assertTrue(0 < os.stat(partial_file).st_size <= 30000)
+        self.assertFalse(os.path.exists(local_file))
+        # The next attempt should resume, and be interrupted again.
+        dut._download_retries = 1
+        self.server.server.drop_next_get_after = 20000
+        written_hash = dut.download_file(hashsum, file_in_project, local_file)
+        self.assertEqual(written_hash, hashsum)
+        self.assertEqual(hashes.sha512.compute(local_file), hashsum)
+        self.assertFalse(os.path.exists(partial_file))
+        # If the partial file is stale, the download should restart.
+        with open(partial_file, 'wb') as f:
+            f.write(b"x" * 1000)
+        dut._cache.write_partial_info(
+            hashsum, dut._get_partial_key(hashsum),
+            {"etag": '"stale"', "size": 100000})
+        os.remove(local_file)
+        written_hash = dut.download_file(hashsum, file_in_project, local_file)
+        self.assertEqual(written_hash, hashsum)
+        # If another process holds the partial file, it (and its info) should
+        # be left alone.
+        with open(partial_file, 'wb') as f:
+            f.write(b"x" * 1000)
+        os.remove(local_file)
+        dut._download_retries = 0
+        with util.FileLock(partial_file + ".lock"):
+            self.server.server.drop_next_get_after = 30000
+            with self.assertRaises(RuntimeError):
+                dut.download_file(hashsum, file_in_project, local_file)
+        self.assertIsNone(dut._cache.read_partial_info(
+            hashsum, dut._get_partial_key(hashsum)))
+        with open(partial_file, 'rb') as f:
+            self.assertEqual(f.read(), b"x" * 1000)
+        # Other remotes with the same file do not share partial downloads.
+        project_config["remotes"]["unit_test_remote"][
+            "folder_path"] = "/devel"
+        other = self._make_dut(project_config=project_config)
+        self.assertNotEqual(
+            self._get_partial_path(other, hashsum), partial_file)
+
+    def test_parallel_download(self):
+        """Large objects should be downloaded as concurrent ranges."""
+        project_config = self._project_config()
+        remote_config = project_config["remotes"]["unit_test_remote"]
+        remote_config["parallel_download_min_size"] = "1M"
+        remote_config["parallel_download_connections"] = 4
+        remote_config["download_chunk_size"] = 1 << 16
+        dut = self._make_dut(project_config=project_config)
+        filename, local_file, file_in_project = self._make_filename()
+        with open(local_file, 'wb') as test_data_file:
+            test_data_file.write(os.urandom((3 << 20) + 12345))
+        hashsum = hashes.sha512.compute(local_file)
+        dut.upload_file(hashsum, file_in_project, local_file)
+        os.remove(local_file)
+        del self.server.server.served_ranges[:]
+        # One part is interrupted, and should be resumed.
+        self.server.server.drop_next_get_after = 100000
+        written_hash = dut.download_file(hashsum, file_in_project, local_file)
+        # The assembled file is verified by the caller.
+        self.assertIsNone(written_hash)
+        self.assertEqual(hashes.sha512.compute(local_file), hashsum)
+        self.assertEqual(len(self.server.server.served_ranges), 5)
+        self.assertFalse(os.path.exists(self._get_partial_path(dut, hashsum)))
+        # Parts which keep ending early, without an error, should fail once
+        # out of retries.
+        os.remove(local_file)
+        remote_config["download_retries"] = 1
+        dut = self._make_dut(project_config=project_config)
+        self.server.server.truncate_ranges = 1000
+        try:
+            with self.assertRaises(util.DownloadError):
+                dut.download_file(hashsum, file_in_project, local_file)
+        finally:
+            self.server.server.truncate_ranges = None
+        self.assertFalse(os.path.exists(local_file))
+
+    def test_multipart_upload(self):
+        """Large files should be uploaded in parts, retrying failed parts."""
+        project_config = self._project_config()
+        remote_config = project_config["remotes"]["unit_test_remote"]
+        remote_config["multipart_upload"] = True
+        remote_config["multipart_part_size"] = "256K"
+        dut = self._make_dut(project_config=project_config)
+        filename, local_file, file_in_project = self._make_filename()
+        with open(local_file, 'wb') as test_data_file:
+            test_data_file.write(os.urandom((1 << 20) + 1000))
+        hashsum = hashes.sha512.compute(local_file)
+        self.server.server.fail_next_part[3] = 400
+        dut.upload_file(hashsum, file_in_project, local_file)
+        self.assertFalse(self.server.server.fail_next_part)
+        self.assertTrue(dut.check_file(hashsum, file_in_project))
+        os.remove(local_file)
+        dut.download_file(hashsum, file_in_project, local_file)
+        self.assertEqual(hashes.sha512.compute(local_file), hashsum)
+        # If a part keeps failing, the upload should be aborted.
+        remote_config["multipart_part_retries"] = 0
+        dut = self._make_dut(project_config=project_config)
+        other_file = f"{self.test_dir}/other.bin"
+        with open(other_file, 'wb') as test_data_file:
+            test_data_file.write(os.urandom(1 << 20))
+        other_hash = hashes.sha512.compute(other_file)
+        self.server.server.fail_next_part[2] = 400
+        with self.assertRaises(RuntimeError):
+            dut.upload_file(other_hash, "/other.bin", other_file)
+        self.assertFalse(dut.check_file(other_hash, "/other.bin"))
+        self.assertFalse(self.server.server.uploads)
+
+    def test_shared_session(self):
+        """Backends for the same host should share connections."""
+        project_config = self._project_config()
+        remote_config = project_config["remotes"]["unit_test_remote"]
+        first = self._make_dut(project_config=project_config)
+        first.check_file(hashes.sha512.create("0" * 128), None)
+        old_adapter = first._http.get_adapter(self.url_base)
+        self.assertTrue(old_adapter.poolmanager.pools)
+        remote_config["folder_path"] = "/devel"
+        remote_config["http_pool"] = {"pool_maxsize": 100}
+        second = self._make_dut(project_config=project_config)
+        self.assertIs(first._http, second._http)
+        # The pool should have grown for the second backend, closing the
+        # connections of the old one.
+        adapter = first._http.get_adapter(self.url_base)
+        self.assertEqual(adapter._pool_maxsize, 100)
+        self.assertFalse(old_adapter.poolmanager.pools)
+
+    def test_circuit_breaker(self):
+        """Once a host fails to connect repeatedly, requests fail fast."""
+        # Find a port with nothing listening on it.
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            dead_port = sock.getsockname()[1]
+        project_config = self._project_config()
+        remote_config = project_config["remotes"]["unit_test_remote"]
+        remote_config["url"] = f"http://127.0.0.1:{dead_port}"
+        remote_config["retry"] = {
+            "retries": 2, "session_retries": 0, "delay": 0.01,
+            "circuit_failures": 3, "circuit_reset_time": 60}
+        dut = self._make_dut(project_config=project_config)
+        hashsum = hashes.sha512.create("0" * 128)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            dut.check_file(hashsum, None)
+        start = time.time()
+        with self.assertRaises(retry.CircuitOpenError):
+            dut.download_file(hashsum, None, f"{self.test_dir}/dead.bin")
+        self.assertLess(time.time() - start, 0.1)
+
+    def test_stall(self):
+        """Streams below the minimum throughput should be abandoned."""
+        policy = retry.RetryPolicy(
+            {"min_throughput": 1000, "stall_window": 0.1})
+
+        def slow_chunks():
+            for _ in range(10):
+                time.sleep(0.05)
+                yield b"x"
+
+        with self.assertRaises(retry.StalledError):
+            list(policy.monitor(slow_chunks()))
+        policy.min_throughput = 1
+        self.assertEqual(len(list(policy.monitor(slow_chunks()))), 10)
+
+    def test_cancel_stalled(self):
+        """A download stalled mid-body should be interrupted once its
+        transfer is cancelled."""
+        project_config = self._project_config()
+        project_config["remotes"]["unit_test_remote"][
+            "download_chunk_size"] = 4096
+        dut = self._make_dut(project_config=project_config)
+        dut._download_retries = 0
+        filename, local_file, file_in_project = self._make_filename()
+        with open(local_file, 'wb') as test_data_file:
+            test_data_file.write(os.urandom(100000))
+        hashsum = hashes.sha512.compute(local_file)
+        dut.upload_file(hashsum, file_in_project, local_file)
+        os.remove(local_file)
+        self.server.server.stall_next_get_after = 30000
+        started = threading.Event()
+        progress = transfer.Progress(on_start=started.set)
+        errors = []
+
+        def download():
+            with transfer.track(progress):
+                try:
+                    dut.download_file(hashsum, file_in_project, local_file)
+                except Exception as e:
+                    errors.append(e)
+
+        thread = threading.Thread(target=download)
+        thread.start()
+        try:
+            self.assertTrue(started.wait(10))
+            progress.cancel()
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        finally:
+            self.server.server.release_stalled.set()
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], transfer.Cancelled)
 
     def test_repo_credentials(self):
         """Test that the dut still works when the repository credentials are
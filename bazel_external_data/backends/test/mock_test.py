@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from bazel_external_data import core, hashes
+from bazel_external_data.backends.mock import MockBackend
+
+
+class MockBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(
+            dir=os.environ.get("TEST_TEMPDIR", None))
+        os.makedirs(os.path.join(self.test_dir, "data"))
+        self.user = core.User({"core": {
+            "cache_dir": os.path.join(self.test_dir, "cache")}})
+        self.config = {"dir": "data", "upload_dir": "upload"}
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _add_file(self, name, contents):
+        filepath = os.path.join(self.test_dir, "data", name)
+        with open(filepath, 'w') as f:
+            f.write(contents)
+        return hashes.sha512.compute(filepath, use_memo=False)
+
+    def _make_backend(self):
+        return MockBackend(self.config, self.test_dir, self.user)
+
+    def test_index(self):
+        hash_a = self._add_file("a", "a")
+        # Nothing is hashed until needed.
+        backend = self._make_backend()
+        self.assertIsNone(backend._map)
+        self.assertTrue(backend.check_file(hash_a, "a"))
+        index_dir = os.path.join(self.user.state_dir, "mock_index")
+        self.assertEqual(len(os.listdir(index_dir)), 1)
+
+        # New and modified files are found by later instances.
+        hash_b = self._add_file("b", "b")
+        hash_a2 = self._add_file("a", "a2")
+        backend = self._make_backend()
+        self.assertEqual(
+            backend.check_files([hash_a, hash_a2, hash_b]),
+            {hash_a: False, hash_a2: True, hash_b: True})
+
+        # Uploads are visible immediately.
+        upload_file = os.path.join(self.test_dir, "c")
+        with open(upload_file, 'w') as f:
+            f.write("c")
+        hash_c = hashes.sha512.compute(upload_file)
+        backend.upload_file(hash_c, "c", upload_file)
+        self.assertTrue(backend.check_file(hash_c, "c"))
+        output_file = os.path.join(self.test_dir, "output")
+        backend.download_file(hash_c, "c", output_file)
+        self.assertTrue(hash_c.compare_file(output_file, do_throw=False))
+
+        # Removed directories are no longer indexed.
+        shutil.rmtree(os.path.join(self.test_dir, "upload"))
+        self.assertFalse(self._make_backend().check_file(hash_c, "c"))
+
+
+if __name__ == '__main__':
+    unittest.main()
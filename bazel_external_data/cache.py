@@ -0,0 +1,56 @@
+"""
+Inspects or garbage-collects the local download cache.
+"""
+
+import sys
+import yaml
+
+from bazel_external_data.util import parse_size
+
+
+def add_arguments(parser):
+    subparsers = parser.add_subparsers(dest="cache_command")
+    subparsers.required = True
+    subparsers.add_parser(
+        "stats", help="Print the size and usage of the cache.")
+    gc_parser = subparsers.add_parser(
+        "gc", help="Evict files unused for longer than the maximum age, " +
+                   "then least-recently-used files until the cache is " +
+                   "within the maximum size. Files still symlinked from " +
+                   "outputs are kept.")
+    gc_parser.add_argument(
+        '--max_size', type=str, default=None,
+        help='Maximum cache size (e.g. "20G"). Defaults to ' +
+             '`core.cache_max_size`.')
+    gc_parser.add_argument(
+        '--max_age', type=float, default=None,
+        help='Maximum time (in seconds) since a file was used. Defaults ' +
+             'to `core.cache_max_age`.')
+    gc_parser.add_argument(
+        '-n', '--dry_run', action='store_true',
+        help='Only print which files would be evicted.')
+
+
+def run(args, user):
+    cache = user.cache
+    if args.cache_command == "stats":
+        yaml.dump(cache.stats(), sys.stdout, default_flow_style=False)
+    elif args.cache_command == "gc":
+        max_size = args.max_size
+        if max_size is not None:
+            max_size = parse_size(max_size)
+        if max_size is None and args.max_age is None and (
+                cache.max_size is None and cache.max_age is None):
+            raise RuntimeError(
+                "No limits configured; specify `--max_size` or `--max_age`.")
+        evicted = cache.gc(
+            max_size=max_size, max_age=args.max_age, dry_run=args.dry_run)
+        for entry in evicted:
+            if args.verbose:
+                print("Evict: {}".format(entry.cache_path))
+        action = args.dry_run and "Would evict" or "Evicted"
+        print("{} {} files ({} bytes)".format(
+            action, len(evicted), sum(entry.size for entry in evicted)))
+    else:
+        assert False, "Bad switch"
+    return True
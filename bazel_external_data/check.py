@@ -13,13 +13,17 @@ from bazel_external_data.util import eprint
 
 def add_arguments(parser):
     parser.add_argument('input_files', type=str, nargs='+')
+    parser.add_argument(
+        '--refresh', action='store_true',
+        help='Query the remote even if it was recently found to have a ' +
+             'file (see `core.check_cache_ttl`).')
 
 
 def run(args, project):
     good = True
-    for input_file in args.input_files:
-        def action():
-            do_check(args, project, input_file)
+
+    def keep_going(action):
+        nonlocal good
         if args.keep_going:
             try:
                 action()
@@ -29,15 +33,28 @@ def run(args, project):
                 eprint("Continuing (--keep_going).")
         else:
             action()
+
+    # Group files by remote, so that each remote is queried in bulk.
+    infos = {}
+    for input_file in args.input_files:
+        def action():
+            info = project.get_file_info(os.path.abspath(input_file))
+            infos.setdefault(info.remote, []).append(info)
+        keep_going(action)
+    for remote, remote_infos in infos.items():
+        found = {}
+        keep_going(lambda: found.update(
+            remote.check_files(
+                (info.hash for info in remote_infos),
+                refresh=args.refresh)))
+        for info in remote_infos:
+            if info.hash in found:
+                keep_going(lambda: do_check(args, info, found[info.hash]))
     return good
 
 
-def do_check(args, project, filepath_in):
-    filepath = os.path.abspath(filepath_in)
-    info = project.get_file_info(filepath)
+def do_check(args, info, is_available):
     remote = info.remote
-    project_relpath = info.project_relpath
-    hash = info.hash
 
     def dump_remote_config():
         yaml.dump(info.debug_config(), sys.stdout, default_flow_style=False)
@@ -45,9 +62,9 @@ def do_check(args, project, filepath_in):
     if args.verbose:
         dump_remote_config()
 
-    if not remote.check_file(hash, project_relpath):
+    if not is_available:
         if not args.verbose:
             dump_remote_config()
         raise RuntimeError(
             "Remote '{}' does not have '{}' ({})".format(
-                remote.name, project_relpath, hash))
+                remote.name, info.project_relpath, info.hash))
@@ -6,8 +6,9 @@ import sys
 import traceback
 import yaml
 
-from bazel_external_data import config_helpers, download, upload, check, squash
-from bazel_external_data.core import load_project
+from bazel_external_data import (
+    config_helpers, download, upload, check, squash, cache)
+from bazel_external_data.core import load_project, load_user
 from bazel_external_data.util import eprint, in_bazel_runfiles
 
 assert __name__ == '__main__'
@@ -33,6 +34,7 @@ download.add_arguments(subparsers.add_parser("download", help=download.__doc__))
 upload.add_arguments(subparsers.add_parser("upload", help=upload.__doc__))
 check.add_arguments(subparsers.add_parser("check", help=check.__doc__))
 squash.add_arguments(subparsers.add_parser("squash", help=squash.__doc__))
+cache.add_arguments(subparsers.add_parser("cache", help=cache.__doc__))
 
 args = parser.parse_args()
 
@@ -51,16 +53,23 @@ if args.verbose:
     eprint("  argv[0]: {}".format(sys.argv[0]))
     eprint("  argv[1:]: {}".format(sys.argv[1:]))
 
-project = load_project(
-    os.path.abspath(args.project_root_guess),
-    user_config_file=args.user_config,
-    project_name=args.project_name)
+# The cache is managed per user, so does not require a project.
+if args.command == 'cache':
+    project = None
+    user = load_user(user_config_file=args.user_config)
+else:
+    project = load_project(
+        os.path.abspath(args.project_root_guess),
+        user_config_file=args.user_config,
+        project_name=args.project_name)
+    user = project.user
 
 if args.verbose:
-    yaml.dump({"user_config": project.user.config}, sys.stdout,
-              default_flow_style=False)
-    yaml.dump({"project_config": project.config}, sys.stdout,
+    yaml.dump({"user_config": user.config}, sys.stdout,
               default_flow_style=False)
+    if project is not None:
+        yaml.dump({"project_config": project.config}, sys.stdout,
+                  default_flow_style=False)
 
 # Execute command.
 status = False
@@ -73,6 +82,8 @@ try:
         status = check.run(args, project)
     elif args.command == "squash":
         status = squash.run(args, project)
+    elif args.command == "cache":
+        status = cache.run(args, user)
 except Exception as e:
     if args.verbose:
         # Full stack trace.
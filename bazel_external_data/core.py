@@ -1,10 +1,16 @@
+import atexit
+import functools
+import hashlib
+import json
 import os
-import shutil
 import stat
 import subprocess
+import threading
+import time
 import uuid
 
-from bazel_external_data import util, config_helpers, hashes
+from bazel_external_data import util, config_helpers, hashes, transfer
+from bazel_external_data.local_cache import LocalCache
 
 PROJECT_CONFIG_FILE = ".external_data.yml"
 USER_CONFIG_FILE_DEFAULT = os.path.expanduser(
@@ -12,6 +18,14 @@ USER_CONFIG_FILE_DEFAULT = os.path.expanduser(
 USER_CONFIG_DEFAULT = {
     "core": {
         "cache_dir": os.path.expanduser("~/.cache/bazel_external_data"),
+        # If None, defaults to "{cache_dir}_state". See `User.state_dir`.
+        "state_dir": None,
+        # Memoize hashsums of unchanged files under "{state_dir}/hash_memo".
+        "hash_memo": True,
+        # Bytes fed to the digest at a time when hashing files.
+        "hash_chunk_size": 1 << 20,
+        # Files at least this large are hashed through `mmap` (None: never).
+        "hash_mmap_min_size": 64 << 20,
     },
 }
 
@@ -28,14 +42,7 @@ def load_project(guess_filepath, project_name=None, user_config_file=None):
     @return A `Project` instance.
     @see test/bazel_external_data_config
     """
-    if user_config_file is None:
-        user_config_file = USER_CONFIG_FILE_DEFAULT
-    if os.path.exists(user_config_file):
-        user_config = config_helpers.parse_config_file(user_config_file)
-    else:
-        user_config = {}
-    user_config = config_helpers.merge_config(USER_CONFIG_DEFAULT, user_config)
-    user = User(user_config)
+    user = load_user(user_config_file)
     # Start guessing where the project lives.
     project_root, root_alternatives = config_helpers.find_project_root(
         guess_filepath, PROJECT_CONFIG_FILE, project_name)
@@ -55,6 +62,29 @@ def load_project(guess_filepath, project_name=None, user_config_file=None):
     return project
 
 
+def load_user(user_config_file=None):
+    """Loads user configuration, and configures hashing accordingly.
+    @param user_config_file
+        Overload for user configuration.
+    @return A `User` instance.
+    """
+    if user_config_file is None:
+        user_config_file = USER_CONFIG_FILE_DEFAULT
+    if os.path.exists(user_config_file):
+        user_config = config_helpers.parse_config_file(user_config_file)
+    else:
+        user_config = {}
+    user_config = config_helpers.merge_config(USER_CONFIG_DEFAULT, user_config)
+    user = User(user_config)
+    hashes.set_read_options(
+        user.config['core']['hash_chunk_size'],
+        user.config['core']['hash_mmap_min_size'])
+    if user.config['core']['hash_memo']:
+        hashes.set_memo(
+            hashes.HashMemo(os.path.join(user.state_dir, "hash_memo")))
+    return user
+
+
 class Project(object):
     """Specifies a project's structure, remotes, and determines the mapping
     between files and their remotes (for download / uploading). """
@@ -91,7 +121,7 @@ class Project(object):
         self._remote_is_loading.append(name)
         # Load remote.
         remote_config = self.config['remotes'][name]
-        remote = Remote(remote_config, name, self.user.cache_dir,
+        remote = Remote(remote_config, name, self.user.cache,
                         self._load_backend, self.get_remote)
         # Update.
         self._remote_is_loading.remove(name)
@@ -143,6 +173,13 @@ class User(object):
     def __init__(self, config):
         self.config = config
         self.cache_dir = os.path.expanduser(config['core']['cache_dir'])
+        # Bookkeeping (e.g. memoized hashsums) is stored apart from the
+        # cache so that the cache only ever contains files indexed by hash.
+        state_dir = config['core'].get('state_dir')
+        if state_dir is None:
+            state_dir = os.path.normpath(self.cache_dir) + "_state"
+        self.state_dir = os.path.expanduser(state_dir)
+        self.cache = LocalCache(self.cache_dir, self.state_dir, config['core'])
 
 
 class HashFileFrontend(object):
@@ -226,33 +263,293 @@ class FileInfo(object):
         }]
 
 
+# Temporary files of raced downloads, which may outlive their race (losers
+# finish on daemon threads), removed at exit if still present.
+_race_files = set()
+_race_files_lock = threading.Lock()
+
+
+def _add_race_file(path):
+    with _race_files_lock:
+        _race_files.add(path)
+
+
+def _remove_race_file(path):
+    with _race_files_lock:
+        _race_files.discard(path)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+@atexit.register
+def _remove_race_files():
+    with _race_files_lock:
+        paths = list(_race_files)
+    for path in paths:
+        _remove_race_file(path)
+
+
+def _get_config_key(value):
+    return hashlib.sha1(json.dumps(
+        value, sort_keys=True, default=str).encode("utf8")).hexdigest()
+
+
+class _Mirror(object):
+    """One of the equivalent backends of a remote. """
+    def __init__(self, backend, config):
+        self.backend = backend
+        # Identifies the mirror for its recorded stats, which are shared by
+        # all remotes using it.
+        self.key = _get_config_key(config)
+
+
 class Remote(object):
     """Provides cache- and hierarchy-friendly access to a backend. """
+    # Configuration which does not affect what is stored.
+    _remote_keys = ('overlay', 'hedge_delay', 'mirrors')
+    # Bytes below which transfers (dominated by latency) are not used to
+    # estimate throughput.
+    _min_throughput_sample = 64 << 10
+
     def __init__(self, config, name,
-                 cache_dir, load_backend, get_remote):
+                 cache, load_backend, get_remote):
         self.config = config
         self.name = name
-        self._cache_dir = cache_dir
+        self._cache = cache
         self._backend = load_backend(self.config['backend'], config)
+        storage_config = {key: value for key, value in config.items()
+                          if key not in self._remote_keys}
+        # Identifies this remote for remembered `check_file` results, which
+        # must not be shared with remotes of the same name in other projects.
+        self._key = _get_config_key([name, storage_config])
         self.overlay = None
         overlay_name = self.config.get('overlay')
         if overlay_name is not None:
             self.overlay = get_remote(overlay_name)
-
-    def check_file(self, hash, project_relpath, check_overlay=True):
-        """ Returns whether this remote (or its overlay) has a given SHA. """
-        if self._backend.check_file(hash, project_relpath):
+        # If set, the overlay (and other mirrors) are queried in parallel
+        # with this remote when it has not answered a check, or sent the
+        # first byte of a download, within this many seconds (@see
+        # transfer.race).
+        self._hedge_delay = self.config.get('hedge_delay')
+        # Copies of this remote's storage (e.g. regional servers), each given
+        # as overrides of this remote's configuration. Checks and downloads
+        # go to the mirror (including this remote's own backend) expected to
+        # be fastest, falling back to the others in rank order; uploads only
+        # go to this remote's own backend. @see LocalCache.rank_mirror
+        self._mirrors = [_Mirror(self._backend, storage_config)]
+        for mirror_config in self.config.get('mirrors', []):
+            mirror_config = dict(storage_config, **mirror_config)
+            self._mirrors.append(_Mirror(
+                load_backend(mirror_config['backend'], mirror_config),
+                mirror_config))
+
+    def check_file(self, hash, project_relpath, check_overlay=True,
+                   refresh=False):
+        """ Returns whether this remote (or its overlay) has a given SHA.
+        @param refresh
+            If true, ignore remembered results (@see
+            LocalCache.get_existence), and query the backend. """
+        exists = None if refresh else self._get_existence(hash)
+        if exists is None and self._is_hedged(check_overlay):
+            return self._check_file_hedged(hash, project_relpath, refresh)
+        if exists is None:
+            exists = self._check_file_backend(hash, project_relpath)
+            self._set_existence(hash, exists)
+        if exists:
             return True
         elif check_overlay and self.overlay:
-            return self.overlay.check_file(hash, project_relpath)
+            return self.overlay.check_file(
+                hash, project_relpath, refresh=refresh)
+
+    def check_files(self, hashes, check_overlay=True, refresh=False):
+        """ Checks many hashes at once; those missing from this remote are
+        then checked in bulk against the overlay.
+        @param refresh
+            @see check_file
+        @returns dict mapping each hash to whether it is available. """
+        hashes = list(set(hashes))
+        found = {}
+        if not refresh:
+            for hash in hashes:
+                exists = self._get_existence(hash)
+                if exists is not None:
+                    found[hash] = exists
+        to_check = [hash for hash in hashes if hash not in found]
+        if to_check:
+            checked = self._fall_back([
+                functools.partial(mirror.backend.check_files, to_check)
+                for mirror in self._get_ranked_mirrors()])
+            for hash, exists in checked.items():
+                self._set_existence(hash, exists)
+            found.update(checked)
+        missing = [hash for hash in hashes if not found[hash]]
+        if missing and check_overlay and self.overlay:
+            found.update(self.overlay.check_files(missing, refresh=refresh))
+        return found
+
+    def _is_hedged(self, check_overlay=True):
+        return (self._hedge_delay is not None and check_overlay and
+                self.overlay is not None)
+
+    def _check_file_hedged(self, hash, project_relpath, refresh):
+        def check():
+            exists = self._check_file_backend(hash, project_relpath)
+            self._set_existence(hash, exists)
+            return exists
+
+        def check_overlay():
+            return self.overlay.check_file(
+                hash, project_relpath, refresh=refresh)
+
+        return bool(transfer.race(
+            [check, check_overlay], self._hedge_delay, accept=bool))
+
+    def _get_existence(self, hash):
+        if not self._backend.remember_checks:
+            return None
+        return self._cache.get_existence(self._key, hash)
+
+    def _set_existence(self, hash, exists):
+        if self._backend.remember_checks:
+            self._cache.set_existence(self._key, hash, exists)
+
+    def _get_ranked_mirrors(self):
+        if len(self._mirrors) == 1:
+            return self._mirrors
+        ranks = {mirror: (self._cache.rank_mirror(mirror.key), index)
+                 for index, mirror in enumerate(self._mirrors)}
+        return sorted(self._mirrors, key=ranks.get)
+
+    def _measure(self, mirror, func, args, output_file=None):
+        # Calls `func(*args)`, recording the latency (until the first byte,
+        # if any is reported) and throughput of `mirror`.
+        if len(self._mirrors) == 1:
+            return func(*args)
+        start = time.monotonic()
+        first_byte = []
+        progress = transfer.Progress(
+            on_start=lambda: first_byte.append(time.monotonic()),
+            parent=transfer.get_progress())
+        try:
+            with transfer.track(progress):
+                result = func(*args)
+        except transfer.Cancelled:
+            raise
+        except Exception:
+            self._cache.update_mirror_stats(mirror.key, failed=True)
+            raise
+        end = time.monotonic()
+        first_byte = first_byte[0] if first_byte else end
+        num_bytes = progress.num_bytes
+        transfer_start = first_byte
+        if output_file is not None and not num_bytes:
+            # The backend did not stream the file (e.g. it copied it), so
+            # only the total time is known.
+            num_bytes = os.path.getsize(output_file)
+            transfer_start = start
+        throughput = None
+        if num_bytes >= self._min_throughput_sample and end > transfer_start:
+            throughput = num_bytes / (end - transfer_start)
+        self._cache.update_mirror_stats(
+            mirror.key, latency=first_byte - start, throughput=throughput)
+        return result
+
+    def _fall_back(self, funcs):
+        # Calls each of `funcs` (one per mirror, in rank order) until one
+        # succeeds.
+        for index, func in enumerate(funcs):
+            try:
+                return func()
+            except transfer.Cancelled:
+                raise
+            except Exception as e:
+                if index + 1 == len(funcs):
+                    raise
+                util.eprint("WARNING: A mirror of remote '{}' failed: {}"
+                            .format(self.name, e))
+                util.eprint("  Trying the next mirror.")
+
+    def _check_file_backend(self, hash, project_relpath):
+        # Checks the mirrors of this remote (but not its overlay).
+        funcs = [
+            functools.partial(
+                self._measure, mirror, mirror.backend.check_file,
+                (hash, project_relpath))
+            for mirror in self._get_ranked_mirrors()]
+        if self._hedge_delay is not None and len(funcs) > 1:
+            return transfer.race(funcs, self._hedge_delay)
+        return self._fall_back(funcs)
+
+    def _download_file_mirror(self, mirror, hash, project_relpath,
+                              output_file):
+        # Downloads a file from one mirror and checks the SHA.
+        try:
+            written_hash = self._measure(
+                mirror, mirror.backend.download_file,
+                (hash, project_relpath, output_file), output_file)
+            if written_hash is None:
+                # The backend did not hash while writing; read the file back.
+                hash.compare_file(output_file)
+            else:
+                hash.compare(written_hash)
+        except BaseException:
+            # Leave no partial file for the next mirror.
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            raise
+
+    def _download_file_backend(self, hash, project_relpath, output_file):
+        # Downloads a file from the mirrors of this remote (but not its
+        # overlay) and checks the SHA.
+        funcs = [
+            functools.partial(
+                self._download_file_mirror, mirror, hash, project_relpath)
+            for mirror in self._get_ranked_mirrors()]
+        if self._hedge_delay is not None and len(funcs) > 1:
+            self._race_downloads(funcs, output_file)
+        else:
+            self._fall_back([
+                functools.partial(func, output_file) for func in funcs])
+
+    def _race_downloads(self, funcs, output_file):
+        # Races `funcs`, each downloading to its own temporary file.
+        def download(func):
+            tmp_file = "{}.{}".format(output_file, uuid.uuid4())
+            _add_race_file(tmp_file)
+            try:
+                func(tmp_file)
+            except BaseException:
+                _remove_race_file(tmp_file)
+                raise
+            return tmp_file
+
+        tmp_file = transfer.race(
+            [functools.partial(download, func) for func in funcs],
+            self._hedge_delay, discard=_remove_race_file)
+        try:
+            os.rename(tmp_file, output_file)
+        finally:
+            # Only removes the file if it could not be renamed.
+            _remove_race_file(tmp_file)
+
+    def _download_file_hedged(self, hash, project_relpath, output_file):
+        # Races this remote against its overlay.
+        self._race_downloads(
+            [functools.partial(self._download_file_backend, hash,
+                               project_relpath),
+             functools.partial(self.overlay._download_file_direct, hash,
+                               project_relpath)],
+            output_file)
 
     def _download_file_direct(self, hash, project_relpath, output_file):
         # Downloads a file directly and checks the SHA.
         # @pre `output_file` should not exist.
         assert not os.path.exists(output_file)
+        if self._is_hedged():
+            self._download_file_hedged(hash, project_relpath, output_file)
+            return
         try:
-            self._backend.download_file(hash, project_relpath, output_file)
-            hash.compare_file(output_file)
+            self._download_file_backend(hash, project_relpath, output_file)
         except util.DownloadError as e:
             if self.overlay:
                 self.overlay._download_file_direct(
@@ -260,8 +557,164 @@ class Remote(object):
             else:
                 raise e
 
+    async def _download_file_direct_async(self, hash, project_relpath,
+                                          output_file):
+        # Same as `_download_file_direct`, awaiting the backend's
+        # `download_file_async`. Downloads which are raced or ranked across
+        # mirrors are coordinated between threads (@see transfer.race), so
+        # run on the transfer engine's thread pool instead.
+        engine = transfer.get_engine()
+        if self._is_hedged() or len(self._mirrors) > 1:
+            await engine.run_sync(
+                self._download_file_direct, hash, project_relpath,
+                output_file)
+            return
+        assert not os.path.exists(output_file)
+        try:
+            try:
+                written_hash = await self._backend.download_file_async(
+                    hash, project_relpath, output_file)
+                if written_hash is None:
+                    await engine.run_sync(hash.compare_file, output_file)
+                else:
+                    hash.compare(written_hash)
+            except BaseException:
+                if os.path.exists(output_file):
+                    os.remove(output_file)
+                raise
+        except util.DownloadError as e:
+            if self.overlay:
+                await self.overlay._download_file_direct_async(
+                    hash, project_relpath, output_file)
+            else:
+                raise e
+
+    def _download_file_to(self, hash, project_relpath, output_file):
+        # Downloads directly to `output_file`, via a temporary file.
+        tmp_file = self._get_download_tmp_file(output_file)
+        try:
+            self._download_file_direct(hash, project_relpath, tmp_file)
+        except util.DownloadError as e:
+            util.eprint("ERROR: For remote '{}'".format(self.name))
+            raise e
+        os.rename(tmp_file, output_file)
+
+    async def _download_file_to_async(self, hash, project_relpath,
+                                      output_file):
+        # Asynchronous variant of `_download_file_to`.
+        tmp_file = self._get_download_tmp_file(output_file)
+        try:
+            await self._download_file_direct_async(
+                hash, project_relpath, tmp_file)
+        except util.DownloadError as e:
+            util.eprint("ERROR: For remote '{}'".format(self.name))
+            raise e
+        os.rename(tmp_file, output_file)
+
+    def _get_download_tmp_file(self, output_file):
+        # Assuming we're on Unix (where `os.rename` is atomic), use a
+        # tempfile to avoid race conditions.
+        return os.path.join(os.path.dirname(output_file), str(uuid.uuid4()))
+
+    def _use_cached(self, hash, output_file, symlink, check_sha,
+                    verify_cache=False):
+        # Places the cache file of `hash` at `output_file`. If `check_sha`,
+        # the cache file is first verified, and removed (returning False) if
+        # it does not match.
+        cache_path = self._cache.get_path(hash)
+        if check_sha and (verify_cache or not self._cache.is_verified(hash)):
+            if hash.compare_file(cache_path, do_throw=False, use_memo=False):
+                self._cache.set_verified(hash)
+            else:
+                util.eprint("Hashsum mismatch. " +
+                            "Removing old cached file, re-downloading.")
+                os.remove(cache_path)
+                return False
+        # Can use cache. Copy to output path.
+        if symlink:
+            # Touch first, so that the entry is not evicted meanwhile.
+            self._cache.touch(hash, link_path=output_file)
+            os.symlink(cache_path, output_file)
+        else:
+            self._cache.touch(hash)
+            self._cache.materialize(hash, output_file)
+        return True
+
+    def _use_cached_fast(self, hash, output_file, symlink, verify_cache):
+        # Fast path: no need to wait on other processes. Touch the entry
+        # before checking it, as `gc` will then not evict it (@see
+        # LocalCache.gc).
+        if not os.path.isfile(self._cache.get_path(hash)) or verify_cache:
+            return False
+        self._cache.touch(hash)
+        if not self._cache.is_verified(hash):
+            return False
+        return self._use_cached(hash, output_file, symlink, False)
+
+    def _use_cached_locked(self, hash, output_file, symlink, verify_cache):
+        # @pre The cache lock for `hash` should be held.
+        # Returns False if neither the cache nor a secondary cache has a
+        # valid copy, in which case the file must be downloaded.
+        if (os.path.isfile(self._cache.get_path(hash)) and
+                self._use_cached(hash, output_file, symlink, True,
+                                 verify_cache)):
+            return True
+        return self._use_secondary_cached(hash, output_file, symlink)
+
+    def _use_secondary_cached(self, hash, output_file, symlink):
+        # Uses a file from a secondary cache, either placing it at
+        # `output_file` or promoting it to the cache. Returns False if no
+        # secondary cache has a valid copy.
+        secondary_path = self._cache.find_secondary(hash)
+        if secondary_path is None:
+            return False
+        if self._cache.secondary_mode == "symlink":
+            if not hash.compare_file(secondary_path, do_throw=False):
+                util.eprint("Hashsum mismatch in secondary cache, " +
+                            "ignoring: {}".format(secondary_path))
+                return False
+            if symlink:
+                os.symlink(secondary_path, output_file)
+            else:
+                self._cache.materialize(
+                    hash, output_file, src=secondary_path)
+            return True
+        # Promote. Verify the (local) copy, rather than the original.
+        cache_path = self._cache.get_path(hash)
+        tmp_file = os.path.join(
+            os.path.dirname(cache_path), str(uuid.uuid4()))
+        self._cache.materialize(hash, tmp_file, src=secondary_path)
+        if not hash.compare_file(tmp_file, do_throw=False):
+            util.eprint("Hashsum mismatch in secondary cache, " +
+                        "ignoring: {}".format(secondary_path))
+            os.remove(tmp_file)
+            return False
+        os.rename(tmp_file, cache_path)
+        self._add_to_cache(hash, output_file, symlink)
+        return True
+
+    def _add_to_cache(self, hash, output_file, symlink):
+        # @pre The cache file of `hash` has been checked against it.
+        # Make cache file read-only.
+        cache_path = self._cache.get_path(hash)
+        mode_write_all = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+        mode_original = os.stat(cache_path)[stat.ST_MODE]
+        if mode_original & mode_write_all:
+            # (Files hard-linked from a backend are already read-only, and
+            # must not be modified.)
+            os.chmod(cache_path, mode_original & ~mode_write_all)
+        self._cache.set_verified(hash)
+        self._use_cached(hash, output_file, symlink, False)
+        # Keep the cache within its limits now that it has grown.
+        self._cache.maybe_gc()
+
+    def _warn_lock_timeout(self, lock):
+        util.eprint(
+            "WARNING: Timed out waiting for lock: {}".format(lock.path))
+        util.eprint("  Downloading without the cache.")
+
     def download_file(self, hash, project_relpath, output_file,
-                      use_cache=True, symlink=True):
+                      use_cache=True, symlink=True, verify_cache=False):
         """Downloads a file.
         @param hash
             Comptued hashsum for the file.
@@ -272,108 +725,208 @@ class Remote(object):
         @param symlink
             If `use_cache` is true, this will place a symlink to the read-only
             cache file at `output_file`.
+        @param verify_cache
+            If true, always re-hash the cache file on a cache hit, even if it
+            is unchanged since it was last verified.
         @returns 'cache' if there was a cache hit, 'download' otherwise.
         """
         assert os.path.isabs(output_file)
         assert not os.path.exists(output_file)
-
-        # Helper functions.
-
-        def download_file_direct(output_file):
-            # Assuming we're on Unix (where `os.rename` is atomic), use a
-            # tempfile to avoid race conditions.
-            tmp_file = os.path.join(
-                os.path.dirname(output_file), str(uuid.uuid4()))
-            try:
-                self._download_file_direct(hash, project_relpath, tmp_file)
-            except util.DownloadError as e:
-                util.eprint("ERROR: For remote '{}'".format(self.name))
-                raise e
-            os.rename(tmp_file, output_file)
-
-        def get_cached(check_sha):
-            # Can use cache. Copy to output path.
-            if symlink:
-                os.symlink(cache_path, output_file)
-            else:
-                shutil.copy(cache_path, output_file)
-                # Ensure file is writeable.
-                mode_original = os.stat(output_file)[stat.ST_MODE]
-                os.chmod(output_file, mode_original | stat.S_IWUSR)
-            # On error, remove cached file, and re-download.
-            if check_sha:
-                if not hash.compare_file(output_file, do_throw=False):
-                    util.eprint("Hashsum mismatch. " +
-                                "Removing old cached file, re-downloading.")
-                    os.remove(cache_path)
-                    if os.path.islink(output_file):
-                        # In this situation, the cache was corrupted, and
-                        # Bazel recompilation, but the symlink is still in
-                        # Bazel-space. Remove the symlink, so that we do not
-                        # download into a symlink (which complicates the logic
-                        # in `download_and_cache`).
-                        os.remove(output_file)
-                    download_and_cache()
-
-        def download_and_cache():
-            # TODO(eric.cousineau): Consider locking the file.
-            download_file_direct(cache_path)
-            # Make cache file read-only.
-            mode_write_all = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
-            mode_original = os.stat(cache_path)[stat.ST_MODE]
-            os.chmod(cache_path, mode_original & ~mode_write_all)
-            # Use cached file since `get_download()` has already checked the
-            # hash.
-            get_cached(False)
-
-        # Actions.
-        if use_cache:
-            cache_path = _get_hash_cache_path(self._cache_dir, hash,
-                                              create_dir=True)
-            if os.path.isfile(cache_path):
-                get_cached(True)
+        if not use_cache:
+            self._download_file_to(hash, project_relpath, output_file)
+            return 'download'
+        self._cache.get_path(hash, create_dir=True)
+        if self._use_cached_fast(hash, output_file, symlink, verify_cache):
+            return 'cache'
+        # Only one process should check or download a given file at a time;
+        # others will wait, then use the cached file.
+        lock = self._cache.lock(hash)
+        if not lock.acquire():
+            # Do not touch the cache entry without its lock.
+            self._warn_lock_timeout(lock)
+            self._download_file_to(hash, project_relpath, output_file)
+            return 'download'
+        try:
+            if self._use_cached_locked(
+                    hash, output_file, symlink, verify_cache):
                 return 'cache'
-            else:
-                download_and_cache()
-                return 'download'
-        else:
-            download_file_direct(output_file)
+            self._download_file_to(
+                hash, project_relpath, self._cache.get_path(hash))
+            self._add_to_cache(hash, output_file, symlink)
+            return 'download'
+        finally:
+            lock.release()
+
+    async def download_file_async(self, hash, project_relpath, output_file,
+                                  use_cache=True, symlink=True,
+                                  verify_cache=False):
+        """Asynchronous variant of `download_file`, for transfer batches.
+        Work on the local cache (which may block, e.g. on its lock) runs on
+        the transfer engine's thread pool, while downloads await
+        `Backend.download_file_async`. """
+        assert os.path.isabs(output_file)
+        assert not os.path.exists(output_file)
+        engine = transfer.get_engine()
+        if not use_cache:
+            await self._download_file_to_async(
+                hash, project_relpath, output_file)
+            return 'download'
+        self._cache.get_path(hash, create_dir=True)
+        if await engine.run_sync(
+                self._use_cached_fast, hash, output_file, symlink,
+                verify_cache):
+            return 'cache'
+        lock = self._cache.lock(hash)
+        if not await engine.run_sync(lock.acquire):
+            self._warn_lock_timeout(lock)
+            await self._download_file_to_async(
+                hash, project_relpath, output_file)
             return 'download'
+        try:
+            if await engine.run_sync(
+                    self._use_cached_locked, hash, output_file, symlink,
+                    verify_cache):
+                return 'cache'
+            await self._download_file_to_async(
+                hash, project_relpath, self._cache.get_path(hash))
+            await engine.run_sync(
+                self._add_to_cache, hash, output_file, symlink)
+            return 'download'
+        finally:
+            lock.release()
 
     def upload_file(self, hash_type, project_relpath, filepath,
-                    check_overlay=True):
+                    check_overlay=True, hash=None):
         """
         Uploads a file.
         If `check_overlay` is True, the file will not be uploaded the this
         remote if the overlay already has it.
+        @param hash
+            (Optional) Hashsum already computed for `filepath`, to avoid
+            hashing the file again.
         """
         assert os.path.isabs(filepath)
-        hash = hash_type.compute(filepath)
-        if self.check_file(hash, project_relpath, check_overlay=check_overlay):
-            note = (
-                check_overlay and "checking overlay" or "ignoring overlay")
-            print("File already uploaded ({})".format(note))
+        if hash is None:
+            hash = hash_type.get_memoized(filepath)
+        if hash is None and self.supports_single_pass_upload():
+            return self._upload_file_single_pass(
+                hash_type, project_relpath, filepath, check_overlay)
+        if hash is None:
+            hash = hash_type.compute(filepath)
         else:
+            assert hash.hash_type == hash_type
+        if not self._is_uploaded(hash, project_relpath, check_overlay):
             self._backend.upload_file(hash, project_relpath, filepath)
+            self._set_existence(hash, True)
         return hash
 
+    async def upload_file_async(self, hash_type, project_relpath, filepath,
+                                check_overlay=True, hash=None):
+        """Asynchronous variant of `upload_file`, for transfer batches.
+        Hashing and checks run on the transfer engine's thread pool, while
+        uploads await `Backend.upload_file_async`. """
+        assert os.path.isabs(filepath)
+        engine = transfer.get_engine()
+        if hash is None:
+            hash = hash_type.get_memoized(filepath)
+        if hash is None and self.supports_single_pass_upload():
+            # The upload calls back into `is_uploaded` while reading the
+            # file, so stays on one thread.
+            return await engine.run_sync(
+                self._upload_file_single_pass, hash_type, project_relpath,
+                filepath, check_overlay)
+        if hash is None:
+            hash = await engine.run_sync(hash_type.compute, filepath)
+        else:
+            assert hash.hash_type == hash_type
+        if not await engine.run_sync(
+                self._is_uploaded, hash, project_relpath, check_overlay):
+            await self._backend.upload_file_async(
+                hash, project_relpath, filepath)
+            self._set_existence(hash, True)
+        return hash
+
+    def _is_uploaded(self, hash, project_relpath, check_overlay):
+        # Do not trust remembered results when deciding to upload.
+        if self.check_file(
+                hash, project_relpath, check_overlay=check_overlay,
+                refresh=True):
+            note = check_overlay and "checking overlay" or "ignoring overlay"
+            print("File already uploaded ({})".format(note))
+            return True
+        return False
+
+    def _upload_file_single_pass(self, hash_type, project_relpath, filepath,
+                                 check_overlay):
+        skipped = []
+
+        def is_uploaded(hash):
+            if self._is_uploaded(hash, project_relpath, check_overlay):
+                skipped.append(hash)
+                return True
+            return False
+
+        hash = self._backend.upload_file_single_pass(
+            hash_type, project_relpath, filepath, is_uploaded)
+        if not skipped:
+            self._set_existence(hash, True)
+        return hash
+
+    def supports_single_pass_upload(self):
+        """Returns whether `upload_file` can hash and upload a file with a
+        single read of the file (if its hash is not already known). """
+        return self._backend.supports_single_pass_upload()
+
 
 class Backend(object):
     """Checks, downloads, and uploads a file from a storage mechanism. """
+    # Whether `Remote` may remember the results of `check_file` across
+    # invocations (@see LocalCache.get_existence). Backends whose checks are
+    # local and cheap should not.
+    remember_checks = True
+
     def __init__(self, config, project_root, user):
-        pass
+        # Number of concurrent requests made by the default `check_files`.
+        self._check_jobs = config.get('check_jobs', 16)
 
     def check_file(self, hash, project_relpath):
         """ Determines if the storage mechanism has a given SHA. """
         raise NotImplemented()
 
+    def check_files(self, hashes):
+        """ Determines which of the given SHAs the storage mechanism has.
+        By default, awaits `check_file_async` concurrently; backends should
+        override this if they support batch queries.
+        @returns dict mapping each hash to a bool. """
+        hashes = list(hashes)
+        results = transfer.get_engine().map(
+            lambda hash: self.check_file_async(hash, None), hashes,
+            jobs=self._check_jobs)
+        return {hash: bool(result) for hash, result in zip(hashes, results)}
+
+    async def check_file_async(self, hash, project_relpath):
+        """ Asynchronous variant of `check_file`. By default, runs it on the
+        transfer engine's thread pool; backends with asynchronous I/O may
+        override this. """
+        return await transfer.get_engine().run_sync(
+            self.check_file, hash, project_relpath)
+
     def download_file(self, hash, project_relpath, output_path):
         """ Downloads a file from a given hash to a given output path.
         @param project_relpath
             File path relative to project.
+        @returns The hashsum of the data written (e.g. via
+            `hashes.HashWriter`), or None if not computed, in which case the
+            caller will read back `output_path` to verify it.
         """
         raise RuntimeError("Downloading not supported for this backend")
 
+    async def download_file_async(self, hash, project_relpath, output_path):
+        """ Asynchronous variant of `download_file`.
+        @see check_file_async """
+        return await transfer.get_engine().run_sync(
+            self.download_file, hash, project_relpath, output_path)
+
     def upload_file(self, hash, project_relpath, filepath):
         """ Uploads a file from an output path given a SHA.
         @param project_relpath
@@ -381,12 +934,24 @@ class Backend(object):
         @note This hash should be assumed to be valid. """
         raise RuntimeError("Uploading not supported for this backend")
 
-
-def _get_hash_cache_path(cache_dir, hash, create_dir=True):
-    # Gets the cache path for a given hash file.
-    hash_algo = hash.get_algo()
-    hash_value = hash.get_value()
-    out_dir = os.path.join(
-        cache_dir, hash_algo, hash_value[0:2], hash_value[2:4])
-    os.makedirs(out_dir, exist_ok=True)
-    return os.path.join(out_dir, hash_value)
+    async def upload_file_async(self, hash, project_relpath, filepath):
+        """ Asynchronous variant of `upload_file`.
+        @see check_file_async """
+        return await transfer.get_engine().run_sync(
+            self.upload_file, hash, project_relpath, filepath)
+
+    def supports_single_pass_upload(self):
+        """ Returns whether `upload_file_single_pass` is supported. """
+        return False
+
+    def upload_file_single_pass(self, hash_type, project_relpath, filepath,
+                                is_uploaded):
+        """ Uploads a file whose hash is not yet known, computing the hash
+        from the same read of the file that is uploaded (e.g. via
+        `hashes.HashReader`), then storing it under that hash.
+        @param is_uploaded
+            Callable taking the computed hash, returning True if the file
+            should not be stored (e.g. it is already present).
+        @returns The computed hash. """
+        raise RuntimeError(
+            "Single-pass uploading not supported for this backend")
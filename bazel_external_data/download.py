@@ -3,18 +3,18 @@ Downloads a file or a set of files for this project.
 """
 
 import os
+import shutil
 import stat
 import sys
+import uuid
 import yaml
 
-from bazel_external_data.util import eprint
+from bazel_external_data import transfer
 
 
 def add_arguments(parser):
     # TODO(eric.cousineau): Consider making this interpret inputs/outputs as
     # pairs.
-    # TODO(eric.cousineau): Make a `--quick` option to ignore checking SHAs, if
-    # performance is impacted.
     parser.add_argument(
         '-o', '--output', dest='output_file', type=str,
         help='Output destination. If specified, only one input file may ' +
@@ -29,6 +29,10 @@ def add_arguments(parser):
     parser.add_argument(
         '--no_cache', action='store_true',
         help='Always download, and do not cache the result.')
+    parser.add_argument(
+        '--verify_cache', action='store_true',
+        help='Re-hash cached files on a cache hit, even if they are ' +
+             'unchanged since they were last verified.')
     parser.add_argument(
         '--symlink', action='store_true',
         help='Use a symlink from the cache rather than copying the file.')
@@ -36,6 +40,9 @@ def add_arguments(parser):
         '--executable', action='store_true',
         help='Permit execution of downloaded artifact. Cannot be used with '
              '`--symlink`.')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='Number of files to download concurrently.')
 
 
 def run(args, project):
@@ -48,27 +55,21 @@ def run(args, project):
         input_file = os.path.abspath(args.input_files[0])
         info = project.get_file_info(input_file)
         output_file = os.path.abspath(args.output_file)
-        do_download(args, project, info, output_file)
+        transfer.get_engine().submit(
+            do_download(args, project, info, output_file)).result()
     else:
+        batch = transfer.get_engine().batch(
+            jobs=args.jobs, keep_going=args.keep_going)
         for input_file in args.input_files:
             input_file = os.path.abspath(input_file)
             info = project.get_file_info(input_file)
-            output_file = info.orig_filepath
-            def action():
-                do_download(args, project, info, output_file)
-            if args.keep_going:
-                try:
-                    action()
-                except RuntimeError as e:
-                    good = False
-                    eprint(e)
-                    eprint("Continuing (--keep_going).")
-            else:
-                action()
+            batch.add_async(
+                do_download, args, project, info, info.orig_filepath)
+        good = batch.wait()
     return good
 
 
-def do_download(args, project, info, output_file):
+async def do_download(args, project, info, output_file):
     project_relpath = info.project_relpath
     remote = info.remote
     hash = info.hash
@@ -84,13 +85,24 @@ def do_download(args, project, info, output_file):
                 "Output file already exists: {}".format(output_file) +
                 "\n  (Use `--keep_going` to ignore or `--force` to " +
                 "overwrite.)")
-    download_type = remote.download_file(
+    download_type = await remote.download_file_async(
         hash, project_relpath, output_file,
         use_cache=not args.no_cache,
-        symlink=args.symlink)
+        symlink=args.symlink,
+        verify_cache=args.verify_cache)
     if args.executable:
         if args.verbose:
             print("Mark as executable: {}".format(output_file))
-        assert not os.path.islink(output_file), output_file
-        mode = os.stat(output_file).st_mode
-        os.chmod(output_file, mode | stat.S_IXUSR)
+        await transfer.get_engine().run_sync(mark_executable, output_file)
+
+
+def mark_executable(output_file):
+    assert not os.path.islink(output_file), output_file
+    if os.stat(output_file).st_nlink > 1:
+        # Do not change the mode of a file hard-linked elsewhere (e.g. by a
+        # backend's store).
+        tmp_file = "{}.{}".format(output_file, uuid.uuid4())
+        shutil.copy2(output_file, tmp_file)
+        os.replace(tmp_file, output_file)
+    mode = os.stat(output_file).st_mode
+    os.chmod(output_file, mode | stat.S_IXUSR)
@@ -3,25 +3,278 @@
 Provides a Hash that can be propagated.
 """
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import hashlib
+import mmap
 import os
+import time
+
+from bazel_external_data import transfer, util
+
+# Memo store shared by all hash types. See `set_memo`.
+_memo = None
+# Options for reading files when hashing. See `set_read_options`.
+_chunk_size = 1 << 20
+_mmap_min_size = 64 << 20
+
+
+def set_memo(memo):
+    """Sets the `HashMemo` consulted by `_HashType.compute` (or None to
+    disable memoization). """
+    global _memo
+    _memo = memo
+
+
+def set_read_options(chunk_size, mmap_min_size):
+    """Sets how files are read when hashing.
+    @param chunk_size
+        Number of bytes fed to the digest at a time.
+    @param mmap_min_size
+        Files at least this large are hashed through `mmap` rather than read
+        into a buffer. If None, `mmap` is never used. """
+    global _chunk_size, _mmap_min_size
+    assert chunk_size > 0
+    _chunk_size = chunk_size
+    _mmap_min_size = mmap_min_size
+
+
+def update_digest_from_file(digest, filepath):
+    """Feeds the contents of `filepath` to `digest`, reading as configured by
+    `set_read_options`. """
+    _update_digest_from_file(digest, filepath, _chunk_size, _mmap_min_size)
+
+
+def _update_digest_from_file(digest, filepath, chunk_size, mmap_min_size):
+    # Avoids allocating a new object per chunk: either map the file directly,
+    # or read into a single reused buffer.
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if mmap_min_size is not None and 0 < size and mmap_min_size <= size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if hasattr(m, "madvise"):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(m) as view:
+                    for start in range(0, size, chunk_size):
+                        digest.update(view[start:start + chunk_size])
+        else:
+            # Do not allocate more than needed for small files.
+            buffer = bytearray(max(1, min(chunk_size, size)))
+            with memoryview(buffer) as view:
+                while True:
+                    count = f.readinto(buffer)
+                    if not count:
+                        break
+                    digest.update(view[:count])
+
+
+class HashMemo(object):
+    """Persistent memo of hashsums, keyed by file stat information.
+
+    Entries are keyed on (device, inode), and record the stat key of the file
+    when it was hashed (@see util.get_stat_key); any change to it invalidates
+    the entry. Each entry is a separate file that is replaced
+    atomically, so concurrent writers do not need locking.
+    """
+    # Files modified more recently than this (in seconds) are not memoized, as
+    # a subsequent write within the filesystem's timestamp granularity would
+    # not be detected.
+    racy_window = 2.
+
+    def __init__(self, memo_dir):
+        self.memo_dir = memo_dir
+
+    def _get_entry_path(self, algo, st):
+        return os.path.join(
+            self.memo_dir, algo, "{:x}".format(st.st_dev),
+            "{:02x}".format(st.st_ino & 0xff), "{:x}".format(st.st_ino))
+
+    def get(self, algo, st):
+        """Returns the memoized value for a file's stat result `st`, or None
+        if there is no valid entry. """
+        try:
+            with open(self._get_entry_path(algo, st)) as f:
+                pieces = f.read().split()
+        except OSError:
+            return None
+        key = [str(value) for value in util.get_stat_key(st)]
+        if len(pieces) != len(key) + 1 or pieces[:-1] != key:
+            return None
+        return pieces[-1]
+
+    def put(self, algo, filepath, st, value):
+        """Stores `value` for `filepath`, which had stat result `st` before it
+        was hashed. Does nothing if the file has since changed, or changed too
+        recently to be trusted. """
+        try:
+            st_after = os.stat(filepath)
+        except OSError:
+            return
+        key = util.get_stat_key(st)
+        if util.get_stat_key(st_after) != key:
+            return
+        if time.time() - st.st_mtime_ns / 1e9 < self.racy_window:
+            return
+        try:
+            util.write_atomic(
+                self._get_entry_path(algo, st),
+                " ".join(str(value) for value in key + [value]) + "\n")
+        except OSError:
+            # The memo is only an optimization; never fail hashing over it.
+            pass
+
+
+class HashWriter(object):
+    """Wraps a writeable binary file object, computing the hashsum of all
+    data written through it (e.g. to verify a download as it streams).
+    Writes are reported to the `transfer.Progress` tracking the creating
+    thread (if any), and raise `transfer.Cancelled` once it is cancelled. """
+    def __init__(self, hash_type, f):
+        self._hash_type = hash_type
+        self._file = f
+        self._digest = hash_type.new_digest()
+        self._progress = transfer.get_progress()
+
+    def write(self, data):
+        if self._progress is not None:
+            self._progress.update(len(data))
+        self._digest.update(data)
+        return self._file.write(data)
+
+    def include_file(self, filepath):
+        """Updates the digest with the contents of `filepath` without writing
+        them (e.g. the existing part of a resumed download). """
+        update_digest_from_file(self._digest, filepath)
+
+    def get_hash(self, filepath=None):
+        """Returns the hashsum of everything written so far. """
+        return self._hash_type.create(
+            self._digest.hexdigest(), filepath=filepath)
+
+
+class HashReader(object):
+    """Reads a file, computing the hashsum of all data read through it (e.g.
+    to hash a file in the same pass as uploading it). Rewinding to the start
+    resets the digest. """
+    def __init__(self, hash_type, filepath):
+        self._hash_type = hash_type
+        self._filepath = filepath
+        self._file = open(filepath, 'rb')
+        self._stat = os.fstat(self._file.fileno())
+        self._digest = hash_type.new_digest()
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._digest.update(data)
+        return data
+
+    def tell(self):
+        return self._file.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if offset != 0 or whence != os.SEEK_SET:
+            raise RuntimeError("HashReader can only be rewound to the start")
+        self._digest = self._hash_type.new_digest()
+        return self._file.seek(0)
+
+    def __len__(self):
+        return self._stat.st_size
+
+    def get_hash(self):
+        """Returns the hashsum of the file. The file must have been read
+        completely. """
+        assert self._file.tell() == self._stat.st_size, self._filepath
+        value = self._digest.hexdigest()
+        if _memo is not None:
+            _memo.put(self._hash_type.name, self._filepath, self._stat, value)
+        return self._hash_type.create(value, filepath=self._filepath)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 class _HashType(object):
     def __init__(self, name):
         self.name = name
 
-    def compute(self, filepath):
-        """Computes the hashsum for a given `filepath`. """
+    def compute(self, filepath, use_memo=True):
+        """Computes the hashsum for a given `filepath`.
+        @param use_memo
+            If true, use the memo store (if any) to avoid re-reading files
+            that have not changed since they were last hashed. """
         if not os.path.exists(filepath):
             raise RuntimeError("File does not exist: {}".format(filepath))
         assert os.path.isabs(filepath), filepath
-        value = self.do_compute(filepath)
+        memo = _memo if use_memo else None
+        if memo is None:
+            value = self.do_compute(filepath)
+        else:
+            st = os.stat(filepath)
+            value = memo.get(self.name, st)
+            if value is None:
+                value = self.do_compute(filepath)
+                memo.put(self.name, filepath, st, value)
+        return self.create(value, filepath)
+
+    def get_memoized(self, filepath):
+        """Returns the memoized hashsum for `filepath` if it is still valid,
+        or None, without reading the file. """
+        assert os.path.isabs(filepath), filepath
+        if _memo is None or not os.path.exists(filepath):
+            return None
+        value = _memo.get(self.name, os.stat(filepath))
+        if value is None:
+            return None
         return self.create(value, filepath)
 
+    def compute_many(self, filepaths, jobs=None, use_memo=True,
+                     do_throw=True):
+        """Computes hashsums for many files using a bounded thread pool.
+        Digest updates release the GIL, so this scales with the number of
+        cores (or disks).
+        @param jobs
+            Maximum number of files to hash concurrently. Defaults to the
+            number of CPUs.
+        @param do_throw
+            If false, the exception for a file that could not be hashed is
+            yielded in place of its hash.
+        @returns Iterator of `(filepath, hash)`, in order of completion. """
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        futures = {}
+        try:
+            for filepath in filepaths:
+                future = executor.submit(self.compute, filepath, use_memo)
+                futures[future] = filepath
+            for future in as_completed(futures):
+                try:
+                    hash = future.result()
+                except Exception as e:
+                    if do_throw:
+                        raise
+                    hash = e
+                yield futures[future], hash
+        finally:
+            # Do not finish hashing remaining files if the consumer stopped.
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
     def do_compute(self, filepath):
         """Implementation to compute a hashsum that is comparable via __eq__.
         """
+        digest = self.new_digest()
+        update_digest_from_file(digest, filepath)
+        return digest.hexdigest()
+
+    def new_digest(self):
+        """Creates an empty `hashlib`-style digest for this type. """
         raise NotImplemented
 
     def create(self, value, filepath=None):
@@ -44,9 +297,9 @@ class Hash(object):
         self.filepath = filepath
         self._value = value
 
-    def compute(self, filepath):
+    def compute(self, filepath, use_memo=True):
         """Computes hash for a filepath, using the same type as this hash. """
-        return self.hash_type.compute(filepath)
+        return self.hash_type.compute(filepath, use_memo=use_memo)
 
     def compare(self, other_hash, do_throw=True):
         """Compares against another hash. """
@@ -61,9 +314,10 @@ class Hash(object):
             else:
                 return False
 
-    def compare_file(self, filepath, do_throw=True):
+    def compare_file(self, filepath, do_throw=True, use_memo=True):
         """Compares against a file, using the same algorithm. """
-        return self.compare(self.compute(filepath), do_throw=do_throw)
+        return self.compare(
+            self.compute(filepath, use_memo=use_memo), do_throw=do_throw)
 
     def is_empty(self):
         return self._value is None
@@ -103,17 +357,9 @@ class _Sha512(_HashType):
     def __init__(self):
         _HashType.__init__(self, 'sha512')
 
-    def do_compute(self, filepath):
-        # From girder/plugins/hashsum_download/server/__init__.py
-        chunk_len = 65536
-        digest = hashlib.sha512()
-        with open(filepath, 'rb') as f:
-            while True:
-                chunk = f.read(chunk_len)
-                if not chunk:
-                    break
-                digest.update(chunk)
-        return digest.hexdigest()
+    def new_digest(self):
+        # Same as girder/plugins/hashsum_download/server/__init__.py
+        return hashlib.sha512()
 
 
 sha512 = _Sha512()
@@ -0,0 +1,534 @@
+"""
+@file
+Provides the local, content-addressed cache of downloaded files.
+"""
+
+import json
+import os
+import random
+import string
+import time
+
+from bazel_external_data import util
+
+
+class LocalCache(object):
+    """Stores downloaded files by hash, as
+    `{cache_dir}/{algo}/{hash[0:2]}/{hash[2:4]}/{hash}`.
+
+    Bookkeeping is kept under `{state_dir}/cache` so that the cache directory
+    only ever contains cached files. For each entry, this records:
+    * the stat information of the file when its hash was last verified, so
+      that cache hits need not re-read unchanged (read-only) files.
+    * when the entry was last used (as the record's mtime), and which
+      symlinks have been made to it, for least-recently-used eviction that
+      spares entries still linked from (e.g. Bazel) outputs.
+    """
+    # Entries used more recently than this (in seconds) are never evicted, as
+    # they may be in the middle of being linked or copied.
+    gc_grace_period = 60.
+    # Temporary files (e.g. of downloads or uploads, which may be stalled
+    # rather than abandoned) are only removed once older than this, as their
+    # owners do not lock them.
+    gc_temp_age = 24 * 3600.
+
+    def __init__(self, cache_dir, state_dir, config):
+        """
+        @param config
+            User `core` configuration. Uses:
+            `cache_trust_verified` (default: True) - If false, always re-hash
+                cache files on a cache hit.
+            `cache_reverify_age` (default: None) - Seconds after which a
+                verified entry is re-hashed anyway. None means never.
+            `cache_reverify_probability` (default: 0) - Probability of
+                re-hashing a verified entry on any given hit.
+            `cache_max_size` (default: None) - Maximum total size of the
+                cache, in bytes (or with a suffix, e.g. "20G").
+            `cache_max_age` (default: None) - Seconds after which an unused
+                entry is evicted.
+            `cache_gc_interval` (default: 3600) - Minimum seconds between
+                automatic collections after new files are cached.
+            `cache_materialize` (default: ["reflink", "copy_file_range",
+                "copy"]) - Strategies to try, in order, when copying cache
+                files to outputs. See `util.materialize_file`.
+            `secondary_cache_dirs` (default: []) - Read-only caches (e.g.
+                pre-seeded, shared over NFS) with the same layout, consulted
+                in order before downloading.
+            `secondary_cache_mode` (default: "promote") - On a hit in a
+                secondary cache, either "promote" the file by copying it into
+                this cache, or "symlink" outputs directly to it.
+            `cache_lock_timeout` (default: 3600) - Seconds to wait for
+                another process to finish downloading the same file before
+                downloading it independently, without caching it. None waits
+                indefinitely.
+            `cache_lock_break_stale` (default: False) - Break cache locks
+                held by processes on this host which no longer exist. Only
+                for filesystems which do not release `flock` locks of
+                crashed processes (@see util.FileLock).
+            `check_cache_ttl` (default: 604800) - Seconds for which a remote
+                having a file is remembered. None disables this.
+            `check_cache_negative_ttl` (default: 0) - Same, for a remote not
+                having a file.
+            `mirror_stats_weight` (default: 0.3) - Weight of each new sample
+                in the moving averages of mirror latency and throughput.
+            `mirror_reference_size` (default: "1M") - Size of the transfer
+                for which mirrors are ranked by their expected time.
+            `mirror_failure_penalty` (default: 600) - Seconds for which a
+                mirror which failed is ranked after those which did not.
+        """
+        self.cache_dir = cache_dir
+        self._state_dir = os.path.join(state_dir, "cache")
+        self._trust_verified = config.get('cache_trust_verified', True)
+        self._reverify_age = config.get('cache_reverify_age')
+        self._reverify_probability = config.get(
+            'cache_reverify_probability', 0.)
+        self.max_size = config.get('cache_max_size')
+        if self.max_size is not None:
+            self.max_size = util.parse_size(self.max_size)
+        self.max_age = config.get('cache_max_age')
+        self._gc_interval = config.get('cache_gc_interval', 3600)
+        self._lock_timeout = config.get('cache_lock_timeout', 3600)
+        self._lock_break_stale = config.get('cache_lock_break_stale', False)
+        self._materialize_strategies = config.get(
+            'cache_materialize', ["reflink", "copy_file_range", "copy"])
+        self._check_ttl = config.get('check_cache_ttl', 7 * 24 * 3600)
+        self._check_negative_ttl = config.get('check_cache_negative_ttl', 0)
+        self._mirror_weight = config.get('mirror_stats_weight', 0.3)
+        self._mirror_reference_size = util.parse_size(
+            config.get('mirror_reference_size', "1M"))
+        self._mirror_failure_penalty = config.get(
+            'mirror_failure_penalty', 600)
+        self._secondary_dirs = [
+            os.path.expanduser(path)
+            for path in config.get('secondary_cache_dirs', [])]
+        self.secondary_mode = config.get('secondary_cache_mode', "promote")
+        if self.secondary_mode not in ("promote", "symlink"):
+            raise RuntimeError(
+                "Invalid `secondary_cache_mode`: {}".format(
+                    self.secondary_mode))
+        for strategy in self._materialize_strategies:
+            if strategy not in util.MATERIALIZE_STRATEGIES:
+                raise RuntimeError(
+                    "Invalid `cache_materialize` strategy: {}".format(
+                        strategy))
+
+    def _get_relpath(self, hash):
+        hash_value = hash.get_value()
+        return os.path.join(
+            hash.get_algo(), hash_value[0:2], hash_value[2:4], hash_value)
+
+    def get_path(self, hash, create_dir=True):
+        """Gets the cache path for a given hash. """
+        path = os.path.join(self.cache_dir, self._get_relpath(hash))
+        if create_dir:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _get_state_path(self, kind, hash):
+        return os.path.join(self._state_dir, kind, self._get_relpath(hash))
+
+    def get_partial_path(self, hash, source_key):
+        """Gets the path where a backend may keep a partial download of
+        `hash` from the source identified by `source_key` (e.g. a hash of its
+        URL), to be resumed by later attempts. """
+        return "{}.{}.partial".format(
+            self.get_path(hash, create_dir=True), source_key)
+
+    def _get_partial_info_path(self, hash, source_key):
+        return self._get_state_path(os.path.join("partial", source_key), hash)
+
+    def read_partial_info(self, hash, source_key):
+        """Returns the dict stored by `write_partial_info` for `hash` and
+        `source_key`, or None. """
+        try:
+            with open(self._get_partial_info_path(hash, source_key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_partial_info(self, hash, source_key, info):
+        """Stores a dict describing the partial download of `hash` from the
+        source identified by `source_key` (e.g. to validate that the remote
+        object has not changed when resuming). If `info` is None, removes it.
+        Callers should hold the lock of the partial file. """
+        path = self._get_partial_info_path(hash, source_key)
+        if info is None:
+            if os.path.exists(path):
+                os.remove(path)
+        else:
+            util.write_atomic(path, json.dumps(info))
+
+    def find_secondary(self, hash):
+        """Returns the path of the file for `hash` in the first secondary
+        cache that has it, or None. """
+        relpath = self._get_relpath(hash)
+        for secondary_dir in self._secondary_dirs:
+            path = os.path.join(secondary_dir, relpath)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def materialize(self, hash, output_file, src=None):
+        """Places a copy of the cache file for `hash` (or of `src`, if given)
+        at `output_file` (as opposed to a symlink), using the cheapest
+        strategy available.
+        @returns The strategy used. """
+        strategies = self._materialize_strategies
+        if src is None:
+            src = self.get_path(hash, create_dir=False)
+        else:
+            # Files from elsewhere (e.g. secondary caches) may not be owned by
+            # the user, so do not share their inode.
+            strategies = [
+                strategy for strategy in strategies if strategy != "hardlink"]
+            strategies = strategies or ["copy"]
+        return util.materialize_file(src, output_file, strategies)
+
+    def lock(self, hash, timeout=-1):
+        """Returns a `util.FileLock` for the cache entry of `hash`, to be held
+        while it is checked or written.
+        @param timeout
+            Overrides `cache_lock_timeout` if not -1. """
+        if timeout == -1:
+            timeout = self._lock_timeout
+        return util.FileLock(
+            self.get_path(hash, create_dir=True) + ".lock", timeout=timeout,
+            break_stale=self._lock_break_stale)
+
+    def is_verified(self, hash):
+        """Returns whether the cache file for `hash` is unchanged since it
+        was last verified (and does not need to be re-hashed). """
+        if not self._trust_verified:
+            return False
+        record_path = self._get_state_path("verified", hash)
+        try:
+            with open(record_path) as f:
+                pieces = f.read().split()
+            st = os.stat(self.get_path(hash, create_dir=False))
+        except OSError:
+            return False
+        key = [str(value) for value in util.get_stat_key(st)]
+        if len(pieces) != len(key) + 1 or pieces[:-1] != key:
+            return False
+        if self._reverify_age is not None:
+            if time.time() - float(pieces[-1]) > self._reverify_age:
+                return False
+        if self._reverify_probability > 0:
+            if random.random() < self._reverify_probability:
+                return False
+        return True
+
+    def set_verified(self, hash):
+        """Records that the cache file for `hash` has just been verified. """
+        st = os.stat(self.get_path(hash, create_dir=False))
+        text = " ".join(
+            str(value) for value in util.get_stat_key(st) + [time.time()])
+        text += "\n"
+        util.write_atomic(self._get_state_path("verified", hash), text)
+
+    def get_existence(self, remote_key, hash):
+        """Returns whether the remote identified by `remote_key` was recently
+        found to have `hash` (@see set_existence), or None if unknown or
+        expired. """
+        try:
+            with open(self._get_state_path(
+                    os.path.join("exists", remote_key), hash)) as f:
+                exists, stamp = f.read().split()
+            exists = exists == "1"
+            age = time.time() - float(stamp)
+        except (OSError, ValueError):
+            return None
+        ttl = self._check_ttl if exists else self._check_negative_ttl
+        if ttl is None or age > ttl:
+            return None
+        return exists
+
+    def set_existence(self, remote_key, hash, exists):
+        """Records whether the remote identified by `remote_key` has
+        `hash`. """
+        ttl = self._check_ttl if exists else self._check_negative_ttl
+        path = self._get_state_path(os.path.join("exists", remote_key), hash)
+        if not ttl:
+            # Not remembered; drop any stale result of the other kind.
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        util.write_atomic(
+            path, "{} {}\n".format(int(bool(exists)), time.time()))
+
+    def _get_mirror_stats_path(self, mirror_key):
+        return os.path.join(self._state_dir, "mirrors", mirror_key + ".json")
+
+    def get_mirror_stats(self, mirror_key):
+        """Returns the stats recorded by `update_mirror_stats` for the mirror
+        identified by `mirror_key`, or None. """
+        try:
+            with open(self._get_mirror_stats_path(mirror_key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def update_mirror_stats(self, mirror_key, latency=None, throughput=None,
+                            failed=False):
+        """Updates the moving averages of a mirror's latency (in seconds) and
+        throughput (in bytes per second) with a new sample, or records that
+        it failed. Concurrent updates may be lost. """
+        stats = self.get_mirror_stats(mirror_key) or {
+            "latency": None, "throughput": None, "failed": None}
+
+        def average(old, new):
+            if new is None:
+                return old
+            if old is None:
+                return new
+            return old + self._mirror_weight * (new - old)
+
+        stats["latency"] = average(stats["latency"], latency)
+        stats["throughput"] = average(stats["throughput"], throughput)
+        stats["failed"] = time.time() if failed else None
+        util.write_atomic(
+            self._get_mirror_stats_path(mirror_key), json.dumps(stats))
+
+    def rank_mirror(self, mirror_key):
+        """Returns a sort key ranking the mirror identified by `mirror_key`
+        by its expected time to transfer `mirror_reference_size` bytes.
+        Mirrors without stats come first, so that they are measured. """
+        stats = self.get_mirror_stats(mirror_key)
+        if stats is None:
+            return (False, 0.)
+        failed = (stats["failed"] is not None and
+                  time.time() - stats["failed"] < self._mirror_failure_penalty)
+        expected = stats["latency"] or 0.
+        if stats["throughput"]:
+            expected += self._mirror_reference_size / stats["throughput"]
+        return (failed, expected)
+
+    def touch(self, hash, link_path=None):
+        """Records that the cache file for `hash` was just used.
+        @param link_path
+            (Optional) Path of a symlink made to the cache file. The entry
+            will not be evicted while this link exists.
+        """
+        record_path = self._get_state_path("access", hash)
+        os.makedirs(os.path.dirname(record_path), exist_ok=True)
+        line = None
+        if link_path is not None:
+            line = os.path.abspath(link_path) + "\n"
+            if os.path.exists(record_path):
+                with open(record_path) as f:
+                    if line in f:
+                        line = None
+        # Appending a single short line is atomic with respect to other
+        # writers.
+        with open(record_path, 'a') as f:
+            if line is not None:
+                f.write(line)
+        os.utime(record_path)
+
+    def _remove_entry(self, hash, cache_path):
+        for path in [cache_path,
+                     self._get_state_path("verified", hash),
+                     self._get_state_path("access", hash)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _list_entries(self, include_temp=False):
+        # Returns `CacheEntry`s for all files in the cache, and also (if
+        # `include_temp`) for partial downloads and temporary files.
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for algo in sorted(os.listdir(self.cache_dir)):
+            algo_dir = os.path.join(self.cache_dir, algo)
+            for root, _, files in os.walk(algo_dir):
+                for name in files:
+                    cache_path = os.path.join(root, name)
+                    hash = _CacheHash(algo, name)
+                    # Hash values are hexadecimal, unlike the names of
+                    # temporary files.
+                    if (all(c in string.hexdigits for c in name) and
+                            cache_path == self.get_path(
+                                hash, create_dir=False)):
+                        entries.append(self._get_entry(hash, cache_path))
+                    elif include_temp and not name.endswith(".lock"):
+                        entry = self._get_temp_entry(algo, cache_path)
+                        if entry is not None:
+                            entries.append(entry)
+        return entries
+
+    def _get_temp_entry(self, algo, path):
+        # Partial downloads are named `{hash}.{source_key}.partial` (@see
+        # get_partial_path); anything else is a temporary file (e.g. of an
+        # in-flight or interrupted download).
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return None  # Since completed.
+        name = os.path.basename(path)
+        if name.endswith(".partial"):
+            hash = _CacheHash(algo, name.split(".")[0])
+            return CacheEntry(hash, path, st.st_size, st.st_mtime, False,
+                              kind="partial")
+        return CacheEntry(None, path, st.st_size, st.st_mtime, False,
+                          kind="temp")
+
+    def _get_entry(self, hash, cache_path):
+        st = os.lstat(cache_path)
+        record_path = self._get_state_path("access", hash)
+        links = []
+        if os.path.exists(record_path):
+            last_access = os.stat(record_path).st_mtime
+            with open(record_path) as f:
+                links = f.read().split("\n")
+        else:
+            last_access = st.st_mtime
+        real_cache_path = os.path.realpath(cache_path)
+        pinned = False
+        for link in links:
+            if (link and os.path.islink(link) and
+                    os.path.realpath(link) == real_cache_path):
+                pinned = True
+                break
+        return CacheEntry(hash, cache_path, st.st_size, last_access, pinned)
+
+    def stats(self):
+        """Returns a dict summarizing the cache. """
+        entries = self._list_entries(include_temp=True)
+        temp_size = sum(
+            entry.size for entry in entries if entry.kind != "file")
+        entries = [entry for entry in entries if entry.kind == "file"]
+        now = time.time()
+        return {
+            "cache_dir": self.cache_dir,
+            "num_files": len(entries),
+            "total_size": sum(entry.size for entry in entries),
+            # Partial downloads and temporary files.
+            "temp_size": temp_size,
+            "num_pinned": sum(1 for entry in entries if entry.pinned),
+            "pinned_size": sum(
+                entry.size for entry in entries if entry.pinned),
+            "oldest_access_age": max(
+                [now - entry.last_access for entry in entries] or [0.]),
+            "max_size": self.max_size,
+            "max_age": self.max_age,
+        }
+
+    def gc(self, max_size=None, max_age=None, dry_run=False):
+        """Evicts entries unused for longer than `max_age` seconds, then
+        least-recently-used entries until the cache is no larger than
+        `max_size` bytes. Entries still linked from outputs (or used within
+        `gc_grace_period`, as checked again while holding their lock) are
+        kept. Partial downloads count towards the
+        size and are evicted likewise (unless in use), while temporary files
+        left by interrupted downloads are removed once older than
+        `gc_temp_age`.
+        @param max_size, max_age
+            Defaults to the configured values. If None, no limit is applied.
+        @returns List of evicted `CacheEntry`s. """
+        if max_size is None:
+            max_size = self.max_size
+        if max_age is None:
+            max_age = self.max_age
+        now = time.time()
+        entries = self._list_entries(include_temp=True)
+        total_size = sum(entry.size for entry in entries)
+        evicted = []
+        # Oldest first.
+        entries.sort(key=lambda entry: entry.last_access)
+        for entry in entries:
+            age = now - entry.last_access
+            if entry.pinned or age < self.gc_grace_period:
+                continue
+            if entry.kind == "temp" and age < self.gc_temp_age:
+                continue
+            too_old = max_age is not None and age > max_age
+            too_big = max_size is not None and total_size > max_size
+            if entry.kind != "temp" and not too_old and not too_big:
+                continue
+            # Skip entries that are being used.
+            if not dry_run and not self._evict(entry):
+                continue
+            total_size -= entry.size
+            evicted.append(entry)
+        if not dry_run:
+            util.write_atomic(
+                os.path.join(self._state_dir, "last_gc"), str(now))
+        return evicted
+
+    def _evict(self, entry):
+        # Removes `entry`, returning False if it is in use.
+        if entry.kind == "temp":
+            try:
+                os.remove(entry.cache_path)
+            except FileNotFoundError:
+                pass
+            return True
+        if entry.kind == "partial":
+            lock = util.FileLock(entry.cache_path + ".lock", timeout=0)
+        else:
+            lock = self.lock(entry.hash, timeout=0)
+        if not lock.acquire():
+            return False
+        try:
+            if entry.kind == "partial":
+                source_key = os.path.basename(entry.cache_path)[
+                    len(entry.hash.get_value()) + 1:-len(".partial")]
+                self.write_partial_info(entry.hash, source_key, None)
+                if os.path.exists(entry.cache_path):
+                    os.remove(entry.cache_path)
+                return True
+            # Hits do not take the lock, but touch the entry before using it;
+            # re-check that it has not been used since it was listed.
+            try:
+                entry = self._get_entry(entry.hash, entry.cache_path)
+            except FileNotFoundError:
+                return False
+            if (entry.pinned or
+                    time.time() - entry.last_access < self.gc_grace_period):
+                return False
+            self._remove_entry(entry.hash, entry.cache_path)
+        finally:
+            lock.release()
+        return True
+
+    def maybe_gc(self):
+        """Runs `gc` if limits are configured and it has not been run within
+        `cache_gc_interval` seconds. """
+        if self.max_size is None and self.max_age is None:
+            return
+        last_gc_path = os.path.join(self._state_dir, "last_gc")
+        if os.path.exists(last_gc_path):
+            if time.time() - os.stat(last_gc_path).st_mtime < \
+                    self._gc_interval:
+                return
+        self.gc()
+
+
+class _CacheHash(object):
+    # Minimal stand-in for `hashes.Hash` when listing the cache, where the
+    # hash type may not be known.
+    def __init__(self, algo, value):
+        self._algo = algo
+        self._value = value
+
+    def get_algo(self):
+        return self._algo
+
+    def get_value(self):
+        return self._value
+
+
+class CacheEntry(object):
+    """Information about a file in the cache. """
+    def __init__(self, hash, cache_path, size, last_access, pinned,
+                 kind="file"):
+        self.hash = hash
+        self.cache_path = cache_path
+        self.size = size
+        # Time (in seconds since epoch) the entry was last used.
+        self.last_access = last_access
+        # Whether the entry is still linked from an output.
+        self.pinned = pinned
+        # "file" for cached files, "partial" for partial downloads, or "temp"
+        # for other temporary files (whose `hash` is None).
+        self.kind = kind
@@ -8,13 +8,15 @@ files for `base`. These files are staged into `merge`.
 # TODO(eric.cousineau): Upstream this into `bazel_external_data` if it can ever
 # be generalized to be Girder-agnostic.
 
+import asyncio
+import collections
 import os
 import sys
 from tempfile import mkdtemp
 import yaml
 
+from bazel_external_data import transfer
 from bazel_external_data.core import load_project
-from bazel_external_data.util import eprint
 
 
 def add_arguments(parser):
@@ -29,6 +31,12 @@ def add_arguments(parser):
     parser.add_argument(
         "--files", type=str, nargs='*', default=None,
         help="Files to check. By default, checks all files in the project.")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="Number of files to transfer concurrently.")
+    parser.add_argument(
+        "--refresh", action='store_true',
+        help="Query `base` even for files it was recently found to have.")
 
 
 def run(args, project):
@@ -57,12 +65,12 @@ def run(args, project):
     else:
         files = [os.path.abspath(file) for file in args.files]
 
-    def do_squash(info):
+    async def do_squash(info, in_base):
         if args.verbose:
             yaml.dump(
                 info.debug_config(), sys.stdout, default_flow_style=False)
         # If the file already exists in `base`, no need to do anything.
-        if base.check_file(info.hash, info.project_relpath):
+        if in_base:
             print("- Skip: {}".format(info.project_relpath))
             return
         # File not already uploaded: download from `head` to `stage_dir`, then
@@ -70,26 +78,33 @@ def run(args, project):
         file_stage_abspath = os.path.join(stage_dir, info.project_relpath)
         file_stage_dir = os.path.dirname(file_stage_abspath)
         os.makedirs(file_stage_dir, exist_ok=True)
-        head.download_file(
+        await head.download_file_async(
             info.hash, info.project_relpath, file_stage_abspath, symlink=True)
         # Upload file to `merge`.
-        hash_merge = merge.upload_file(
-            info.hash.hash_type, info.project_relpath, file_stage_abspath)
+        # The staged file has already been checked against `info.hash`.
+        hash_merge = await merge.upload_file_async(
+            info.hash.hash_type, info.project_relpath, file_stage_abspath,
+            hash=info.hash)
         assert info.hash == hash_merge  # Sanity check
         print("Uploaded: {}".format(info.project_relpath))
 
-    good = True
-    for file_abspath in files:
-        info = project.get_file_info(file_abspath, needs_hash=True)
-        def action():
-            do_squash(info)
-        if args.keep_going:
-            try:
-                action()
-            except RuntimeError as e:
-                good = False
-                eprint(e)
-                eprint("Continuing (--keep_going)")
-        else:
-            action()
-    return good
+    infos = [project.get_file_info(file_abspath, needs_hash=True)
+             for file_abspath in files]
+    # Check which files `base` already has in one bulk query.
+    in_base = base.check_files(
+        (info.hash for info in infos), refresh=args.refresh)
+
+    # Files with the same contents are squashed one at a time, so that only
+    # the first is transferred.
+    # (The locks are created on the transfer engine's loop.)
+    squash_locks = collections.defaultdict(asyncio.Lock)
+
+    async def do_squash_locked(info):
+        async with squash_locks[info.hash]:
+            await do_squash(info, in_base[info.hash])
+
+    batch = transfer.get_engine().batch(
+        jobs=args.jobs, keep_going=args.keep_going)
+    for info in infos:
+        batch.add_async(do_squash_locked, info)
+    return batch.wait()
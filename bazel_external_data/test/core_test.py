@@ -0,0 +1,370 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from bazel_external_data import core, hashes, transfer, util
+from bazel_external_data.local_cache import LocalCache
+
+
+class _Backend(core.Backend):
+    # Serves files from local paths, keyed by hash value, counting checks and
+    # downloads.
+    def __init__(self, files):
+        core.Backend.__init__(self, {}, None, None)
+        self.files = files
+        self.checked = []
+        self.num_downloads = 0
+        # Seconds each download takes.
+        self.delay = 0
+        # Raised by each download, if set.
+        self.error = None
+        # Whether downloads stall (e.g. on an unresponsive connection) until
+        # cancelled.
+        self.stall = False
+
+    def check_file(self, hash, project_relpath):
+        self.checked.append(hash)
+        return hash.get_value() in self.files
+
+    def supports_single_pass_upload(self):
+        return True
+
+    def upload_file_single_pass(self, hash_type, project_relpath, filepath,
+                                is_uploaded):
+        hash = hash_type.compute(filepath, use_memo=False)
+        if not is_uploaded(hash):
+            self.files[hash.get_value()] = filepath
+        return hash
+
+    def download_file(self, hash, project_relpath, output_file):
+        self.num_downloads += 1
+        if self.error is not None:
+            raise self.error
+        if self.stall:
+            with open(output_file, 'w') as f:
+                f.write("Partial")
+            cancelled = threading.Event()
+            with transfer.on_cancel(cancelled.set):
+                cancelled.wait()
+            transfer.check_cancelled()
+        time.sleep(self.delay)
+        shutil.copy(self.files[hash.get_value()], output_file)
+
+
+class _AsyncBackend(_Backend):
+    # Records transfers awaited through the asynchronous variants.
+    def __init__(self, files):
+        _Backend.__init__(self, files)
+        self.awaited = []
+
+    def supports_single_pass_upload(self):
+        return False
+
+    def upload_file(self, hash, project_relpath, filepath):
+        self.files[hash.get_value()] = filepath
+
+    async def download_file_async(self, hash, project_relpath, output_path):
+        self.awaited.append("download")
+        return await _Backend.download_file_async(
+            self, hash, project_relpath, output_path)
+
+    async def upload_file_async(self, hash, project_relpath, filepath):
+        self.awaited.append("upload")
+        return await _Backend.upload_file_async(
+            self, hash, project_relpath, filepath)
+
+
+class RemoteTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(
+            dir=os.environ.get("TEST_TEMPDIR", None))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _make_file(self, name, contents):
+        filepath = os.path.join(self.test_dir, name)
+        with open(filepath, 'w') as f:
+            f.write(contents)
+        return filepath, hashes.sha512.compute(filepath, use_memo=False)
+
+    def _make_cache(self, config={}, name="cache"):
+        return LocalCache(
+            os.path.join(self.test_dir, name),
+            os.path.join(self.test_dir, "state"), config)
+
+    def _make_remote(self, backend, config={}, name="remote", cache=None,
+                     overlay=None):
+        return core.Remote(
+            dict(config, backend="test"), name, cache or self._make_cache(),
+            lambda *args: backend, overlay and (lambda name: overlay))
+
+
+class RemoteCacheTest(RemoteTest):
+    def test_coalesce_downloads(self):
+        source, hash = self._make_file("source.bin", "Contents")
+        backend = _Backend({hash.get_value(): source})
+        # Long enough for the downloads to overlap.
+        backend.delay = 0.5
+        remote = self._make_remote(backend)
+        results = []
+
+        def download(i):
+            output_file = os.path.join(
+                self.test_dir, "output_{}.bin".format(i))
+            results.append(
+                remote.download_file(hash, "source.bin", output_file))
+
+        threads = [
+            threading.Thread(target=download, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(backend.num_downloads, 1)
+        self.assertEqual(sorted(results), ['cache'] * 3 + ['download'])
+
+    def test_lock_timeout(self):
+        source, hash = self._make_file("source.bin", "Contents")
+        backend = _Backend({hash.get_value(): source})
+        cache = self._make_cache({"cache_lock_timeout": 0})
+        remote = self._make_remote(backend, cache=cache)
+        output_file = os.path.join(self.test_dir, "output.bin")
+        # Another process is downloading the file, and taking too long; the
+        # file should be downloaded without touching the cache.
+        with cache.lock(hash):
+            self.assertEqual(
+                remote.download_file(hash, "source.bin", output_file),
+                'download')
+        self.assertTrue(hash.compare_file(output_file, do_throw=False))
+        self.assertFalse(os.path.islink(output_file))
+        self.assertFalse(os.path.exists(cache.get_path(hash)))
+
+    def test_secondary_cache(self):
+        # Seed a secondary cache with one valid and one corrupt file.
+        secondary = self._make_cache(name="secondary")
+        backend = _Backend({})
+        hashes_by_name = {}
+        for name in ["good", "bad"]:
+            source, hash = self._make_file(name + ".bin", name)
+            shutil.copy(source, secondary.get_path(hash))
+            backend.files[hash.get_value()] = source
+            hashes_by_name[name] = hash
+        with open(secondary.get_path(hashes_by_name["bad"]), 'w') as f:
+            f.write("Corrupted")
+        for mode in ["promote", "symlink"]:
+            cache = self._make_cache(
+                {"secondary_cache_dirs": [secondary.cache_dir],
+                 "secondary_cache_mode": mode}, name=mode)
+            remote = self._make_remote(backend, cache=cache)
+            backend.num_downloads = 0
+            for name, hash in hashes_by_name.items():
+                output_file = os.path.join(self.test_dir, mode + name)
+                result = remote.download_file(hash, name, output_file)
+                self.assertEqual(hashes.sha512.compute(output_file), hash)
+                if name == "good":
+                    self.assertEqual(result, 'cache')
+                    self.assertEqual(
+                        os.path.exists(cache.get_path(hash)),
+                        mode == "promote")
+            # Only the corrupt file should have been downloaded.
+            self.assertEqual(backend.num_downloads, 1)
+
+
+    def test_download_async(self):
+        source, hash = self._make_file("source.bin", "Contents")
+        backend = _AsyncBackend({hash.get_value(): source})
+        remote = self._make_remote(backend)
+        engine = transfer.get_engine()
+        results = []
+        for i in range(2):
+            output_file = os.path.join(
+                self.test_dir, "output_{}.bin".format(i))
+            results.append(engine.submit(remote.download_file_async(
+                hash, "source.bin", output_file)).result())
+            self.assertTrue(hash.compare_file(output_file, do_throw=False))
+        self.assertEqual(results, ['download', 'cache'])
+        self.assertEqual(backend.awaited, ["download"])
+
+
+class RemoteCheckTest(RemoteTest):
+    def test_check_files_overlay(self):
+        hashes_by_name = {
+            name: self._make_file(name + ".bin", name)[1]
+            for name in ["base", "head", "neither"]}
+        base_backend = _Backend({hashes_by_name["base"].get_value(): None})
+        head_backend = _Backend({hashes_by_name["head"].get_value(): None})
+        cache = self._make_cache()
+        base = self._make_remote(base_backend, name="base", cache=cache)
+        head = self._make_remote(
+            head_backend, {"overlay": "base"}, name="head", cache=cache,
+            overlay=base)
+        found = head.check_files(hashes_by_name.values())
+        self.assertEqual(
+            {name: found[hash] for name, hash in hashes_by_name.items()},
+            {"base": True, "head": True, "neither": False})
+        # Only the misses should be propagated to the overlay.
+        self.assertEqual(len(head_backend.checked), 3)
+        self.assertEqual(
+            set(base_backend.checked),
+            {hashes_by_name["base"], hashes_by_name["neither"]})
+        self.assertEqual(
+            head.check_files(hashes_by_name.values(), check_overlay=False)[
+                hashes_by_name["base"]],
+            False)
+
+    def test_check_cache(self):
+        present = hashes.sha512.create("0" * 128)
+        absent = hashes.sha512.create("1" * 128)
+        backend = _Backend({present.get_value(): None})
+
+        def make_remote(config):
+            return self._make_remote(backend, cache=self._make_cache(config))
+
+        remote = make_remote({})
+        for _ in range(2):
+            self.assertTrue(remote.check_file(present, None))
+            self.assertFalse(remote.check_file(absent, None))
+        # Only positive results are remembered by default.
+        self.assertEqual(backend.checked, [present, absent, absent])
+        del backend.checked[:]
+        found = remote.check_files([present, absent])
+        self.assertEqual(found, {present: True, absent: False})
+        self.assertEqual(backend.checked, [absent])
+        del backend.checked[:]
+        self.assertTrue(remote.check_file(present, None, refresh=True))
+        self.assertEqual(backend.checked, [present])
+        # Negative results may be remembered too, and results expire.
+        del backend.checked[:]
+        remote = make_remote({"check_cache_negative_ttl": 3600})
+        remote.check_files([absent])
+        remote.check_files([absent])
+        self.assertEqual(backend.checked, [absent])
+        remote = make_remote({"check_cache_ttl": None})
+        remote.check_file(present, None)
+        self.assertEqual(backend.checked, [absent, present])
+
+
+class RemoteUploadTest(RemoteTest):
+    def test_single_pass_upload(self):
+        source, hash = self._make_file("source.bin", "Contents")
+        backend = _Backend({})
+        remote = self._make_remote(backend)
+        self.assertEqual(
+            remote.upload_file(hashes.sha512, "source.bin", source), hash)
+        # The upload is remembered, so is not checked again.
+        del backend.checked[:]
+        self.assertTrue(remote.check_file(hash, "source.bin"))
+        self.assertEqual(backend.checked, [])
+
+
+    def test_upload_async(self):
+        source, hash = self._make_file("source.bin", "Contents")
+        backend = _AsyncBackend({})
+        remote = self._make_remote(backend)
+        engine = transfer.get_engine()
+        for _ in range(2):
+            self.assertEqual(
+                engine.submit(remote.upload_file_async(
+                    hashes.sha512, "source.bin", source)).result(),
+                hash)
+        # The second upload finds the file already present.
+        self.assertEqual(backend.awaited, ["upload"])
+        self.assertEqual(backend.files, {hash.get_value(): source})
+
+
+class RemoteHedgeTest(RemoteTest):
+    def _join_races(self):
+        # Waits for losers, which finish on their own threads.
+        for thread in threading.enumerate():
+            if thread.name == "race":
+                thread.join(10)
+
+    def test_hedged_download(self):
+        source, hash = self._make_file("source.bin", "Contents")
+        # The primary stalls, so the overlay should win.
+        slow_backend = _Backend({hash.get_value(): source})
+        slow_backend.stall = True
+        fast_backend = _Backend({hash.get_value(): source})
+        cache = self._make_cache()
+        base = self._make_remote(fast_backend, name="base", cache=cache)
+        head = self._make_remote(
+            slow_backend, {"overlay": "base", "hedge_delay": 0},
+            name="head", cache=cache, overlay=base)
+        output_file = os.path.join(self.test_dir, "output.bin")
+        head.download_file(hash, None, output_file, use_cache=False)
+        self.assertTrue(hash.compare_file(output_file, do_throw=False))
+        # The stalled download is cancelled, and its file removed.
+        self._join_races()
+        self.assertEqual(slow_backend.num_downloads, 1)
+        self.assertEqual(
+            [name for name in os.listdir(self.test_dir)
+             if name.startswith("output.bin")],
+            ["output.bin"])
+        self.assertFalse(core._race_files)
+
+    def test_race_files_removed_at_exit(self):
+        # Losers may still be running on daemon threads at exit.
+        tmp_file, _ = self._make_file("output.bin.tmp", "Partial")
+        core._add_race_file(tmp_file)
+        core._remove_race_files()
+        self.assertFalse(os.path.exists(tmp_file))
+        self.assertFalse(core._race_files)
+
+
+class RemoteMirrorTest(RemoteTest):
+    def test_mirrors(self):
+        source, hash = self._make_file("source.bin", "Contents")
+        files = {hash.get_value(): source}
+        backends = {
+            "slow": _Backend(files),
+            "fast": _Backend(files),
+            "down": _Backend(files),
+        }
+        # Mirrors are ranked by their measured speed.
+        backends["slow"].delay = 0.5
+        backends["down"].error = util.DownloadError("Down")
+        config = {"backend": "test", "region": "slow", "mirrors": [
+            {"region": "down"}, {"region": "fast"}]}
+
+        def make_remote():
+            return core.Remote(
+                config, "remote", self._make_cache(),
+                lambda backend_type, config: backends[config["region"]],
+                None)
+
+        remote = make_remote()
+
+        def download():
+            output_file = os.path.join(self.test_dir, "output.bin")
+            remote.download_file(hash, None, output_file, use_cache=False)
+            self.assertTrue(hash.compare_file(output_file, do_throw=False))
+            os.remove(output_file)
+
+        # Unmeasured mirrors are tried in order, falling back on failure.
+        download()
+        self.assertEqual(
+            [backends[name].num_downloads for name in ["slow", "down"]],
+            [1, 0])
+        download()
+        self.assertEqual(
+            [backends[name].num_downloads for name in ["down", "fast"]],
+            [1, 1])
+        # Now the fastest is preferred, and the failed mirror is last.
+        for _ in range(2):
+            download()
+        self.assertEqual(
+            {name: backend.num_downloads
+             for name, backend in backends.items()},
+            {"slow": 1, "down": 1, "fast": 3})
+        # Stats are persisted.
+        remote = make_remote()
+        download()
+        self.assertEqual(backends["fast"].num_downloads, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Micro-benchmark for reading files when hashing, comparing the original
+`f.read()` loop against reading into a reused buffer and `mmap`, across file
+and chunk sizes.
+
+    $ bazel run //bazel_external_data:hashes_benchmark -- --sizes 1M 64M 1G
+
+Files are read once before timing, so this measures throughput from the page
+cache (i.e. the cost of hashing itself rather than the disk).
+"""
+
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+
+from bazel_external_data import hashes
+from bazel_external_data.util import parse_size
+
+
+def read_loop(digest, filepath, chunk_size):
+    # Original implementation, allocating a new `bytes` for each chunk.
+    with open(filepath, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+
+def readinto(digest, filepath, chunk_size):
+    hashes._update_digest_from_file(digest, filepath, chunk_size, None)
+
+
+def mmap_(digest, filepath, chunk_size):
+    hashes._update_digest_from_file(digest, filepath, chunk_size, 0)
+
+
+methods = [
+    ("read", read_loop),
+    ("readinto", readinto),
+    ("mmap", mmap_),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes", type=str, nargs='+', default=["64K", "1M", "16M", "256M"])
+    parser.add_argument(
+        "--chunk_sizes", type=str, nargs='+', default=["64K", "1M", "8M"])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(dir=os.environ.get("TEST_TMPDIR", None))
+    print("{:>8} {:>8} {:>10} {:>10}".format(
+        "size", "chunk", "method", "MB/s"))
+    for size_text in args.sizes:
+        size = parse_size(size_text)
+        filepath = os.path.join(tmp_dir, "bench.bin")
+        with open(filepath, 'wb') as f:
+            f.write(os.urandom(size))
+        # Warm the page cache.
+        read_loop(hashlib.sha512(), filepath, 1 << 20)
+        for chunk_text in args.chunk_sizes:
+            chunk_size = parse_size(chunk_text)
+            for name, method in methods:
+                best = None
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    method(hashlib.sha512(), filepath, chunk_size)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                print("{:>8} {:>8} {:>10} {:>10.1f}".format(
+                    size_text, chunk_text, name, size / best / 1e6))
+        os.remove(filepath)
+    os.rmdir(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import time
+import unittest
+
+from bazel_external_data import hashes
+
+
+class HashMemoTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(
+            dir=os.environ.get("TEST_TEMPDIR", None))
+        self.memo = hashes.HashMemo(os.path.join(self.test_dir, "memo"))
+        hashes.set_memo(self.memo)
+        self.num_computes = 0
+        do_compute_original = hashes.sha512.do_compute
+
+        def do_compute(filepath):
+            self.num_computes += 1
+            return do_compute_original(filepath)
+
+        hashes.sha512.do_compute = do_compute
+
+    def tearDown(self):
+        del hashes.sha512.do_compute
+        hashes.set_memo(None)
+
+    def _write_file(self, contents, age=10.):
+        filepath = os.path.join(self.test_dir, "file.bin")
+        with open(filepath, 'w') as f:
+            f.write(contents)
+        # Backdate the file so that it is outside of the racy window.
+        stamp = time.time() - age
+        os.utime(filepath, (stamp, stamp))
+        return filepath
+
+    def test_memo(self):
+        filepath = self._write_file("Contents")
+        first = hashes.sha512.compute(filepath)
+        self.assertEqual(self.num_computes, 1)
+        # Unchanged file should come from the memo.
+        self.assertEqual(hashes.sha512.compute(filepath), first)
+        self.assertEqual(self.num_computes, 1)
+        # Bypassing the memo should re-read the file.
+        self.assertEqual(
+            hashes.sha512.compute(filepath, use_memo=False), first)
+        self.assertEqual(self.num_computes, 2)
+        # Changing the file should invalidate the entry.
+        self._write_file("New contents")
+        second = hashes.sha512.compute(filepath)
+        self.assertEqual(self.num_computes, 3)
+        self.assertNotEqual(first, second)
+        self.assertEqual(
+            second, hashes.sha512.compute(filepath, use_memo=False))
+
+    def test_racy_file(self):
+        # Recently modified files should not be memoized.
+        filepath = self._write_file("Contents", age=0.)
+        hashes.sha512.compute(filepath)
+        hashes.sha512.compute(filepath)
+        self.assertEqual(self.num_computes, 2)
+
+
+class ComputeManyTest(unittest.TestCase):
+    def test_compute_many(self):
+        test_dir = tempfile.mkdtemp(dir=os.environ.get("TEST_TEMPDIR", None))
+        filepaths = []
+        for i in range(10):
+            filepath = os.path.join(test_dir, "file_{}.bin".format(i))
+            with open(filepath, 'w') as f:
+                f.write("Contents {}".format(i))
+            filepaths.append(filepath)
+        missing = os.path.join(test_dir, "missing.bin")
+        results = dict(hashes.sha512.compute_many(
+            filepaths + [missing], jobs=4, do_throw=False))
+        self.assertEqual(set(results), set(filepaths + [missing]))
+        for filepath in filepaths:
+            self.assertEqual(
+                results[filepath], hashes.sha512.compute(filepath))
+        self.assertIsInstance(results[missing], RuntimeError)
+        with self.assertRaises(RuntimeError):
+            list(hashes.sha512.compute_many([missing]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+import os
+import socket
+import tempfile
+import time
+import unittest
+
+from bazel_external_data import hashes, util
+from bazel_external_data.local_cache import LocalCache
+
+
+class LocalCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(
+            dir=os.environ.get("TEST_TEMPDIR", None))
+        self.cache_dir = os.path.join(self.test_dir, "cache")
+        self.state_dir = os.path.join(self.test_dir, "state")
+
+    def _make_cache(self, config={}):
+        return LocalCache(self.cache_dir, self.state_dir, config)
+
+    def _add_file(self, cache, contents):
+        tmp_file = os.path.join(self.test_dir, "tmp.bin")
+        with open(tmp_file, 'w') as f:
+            f.write(contents)
+        hash = hashes.sha512.compute(tmp_file)
+        cache_path = cache.get_path(hash)
+        os.rename(tmp_file, cache_path)
+        return hash, cache_path
+
+    def test_verified(self):
+        cache = self._make_cache()
+        hash, cache_path = self._add_file(cache, "Contents")
+        self.assertTrue(cache_path.startswith(self.cache_dir))
+        self.assertFalse(cache.is_verified(hash))
+        cache.set_verified(hash)
+        self.assertTrue(cache.is_verified(hash))
+        # Modifying the file should invalidate the record.
+        with open(cache_path, 'a') as f:
+            f.write("Corrupted")
+        self.assertFalse(cache.is_verified(hash))
+        # Bookkeeping should not be stored in the cache directory.
+        cache_files = []
+        for root, _, files in os.walk(self.cache_dir):
+            cache_files += files
+        self.assertEqual(cache_files, [hash.get_value()])
+
+    def test_reverify(self):
+        for config in [
+                {'cache_trust_verified': False},
+                {'cache_reverify_age': -1},
+                {'cache_reverify_probability': 1.}]:
+            cache = self._make_cache(config)
+            hash, _ = self._add_file(cache, str(config))
+            cache.set_verified(hash)
+            self.assertFalse(cache.is_verified(hash), config)
+
+    def test_materialize(self):
+        hash = None
+        for strategies in [
+                ["reflink", "copy"],
+                ["copy_file_range", "copy"],
+                ["hardlink", "copy"],
+                ["copy"]]:
+            cache = self._make_cache({'cache_materialize': strategies})
+            if hash is None:
+                hash, cache_path = self._add_file(cache, "Contents")
+            output_file = os.path.join(self.test_dir, "output.bin")
+            strategy = cache.materialize(hash, output_file)
+            self.assertIn(strategy, strategies)
+            self.assertEqual(hashes.sha512.compute(output_file), hash)
+            # Copies should be writeable, and distinct from the cache file.
+            self.assertNotEqual(
+                os.stat(output_file).st_ino, os.stat(cache_path).st_ino)
+            self.assertTrue(os.access(output_file, os.W_OK))
+            os.remove(output_file)
+        # Read-only cache files may be hard linked.
+        os.chmod(cache_path, 0o444)
+        cache = self._make_cache({'cache_materialize': ["hardlink"]})
+        self.assertEqual(cache.materialize(hash, output_file), "hardlink")
+        self.assertEqual(
+            os.stat(output_file).st_ino, os.stat(cache_path).st_ino)
+        with self.assertRaises(RuntimeError):
+            self._make_cache({'cache_materialize': ["bad"]})
+
+    def test_gc(self):
+        cache = self._make_cache()
+        now = time.time()
+        entries = {}
+        for i, name in enumerate(["old", "linked", "recent", "new"]):
+            hash, cache_path = self._add_file(cache, name[0] * 100)
+            if name == "linked":
+                link_path = os.path.join(self.test_dir, "link.bin")
+                os.symlink(cache_path, link_path)
+                cache.touch(hash, link_path=link_path)
+            else:
+                cache.touch(hash)
+            # Backdate accesses, oldest first; "new" stays within the grace
+            # period.
+            if name != "new":
+                stamp = now - 3600 * (4 - i)
+                record_path = cache._get_state_path("access", hash)
+                os.utime(record_path, (stamp, stamp))
+            entries[name] = hash
+        self.assertEqual(cache.stats()["num_files"], 4)
+        self.assertEqual(cache.stats()["num_pinned"], 1)
+        # Nothing to do within limits.
+        self.assertEqual(cache.gc(max_size=400), [])
+        # Evict least-recently-used first, sparing linked and new entries.
+        evicted = cache.gc(max_size=300, dry_run=True)
+        self.assertEqual([entry.hash.get_value() for entry in evicted],
+                         [entries["old"].get_value()])
+        self.assertEqual(cache.stats()["num_files"], 4)
+        evicted = cache.gc(max_size=0)
+        self.assertEqual(
+            [entry.hash.get_value() for entry in evicted],
+            [entries["old"].get_value(), entries["recent"].get_value()])
+        self.assertFalse(os.path.exists(cache.get_path(entries["old"])))
+        self.assertTrue(os.path.exists(cache.get_path(entries["linked"])))
+        # Entries used since being listed (e.g. by a cache hit, which does
+        # not take the lock) are kept.
+        [entry] = [entry for entry in cache._list_entries()
+                   if entry.hash.get_value() == entries["new"].get_value()]
+        entry.last_access = 0.
+        self.assertFalse(cache._evict(entry))
+        self.assertTrue(os.path.exists(cache.get_path(entries["new"])))
+        # Once the link is removed, the entry may be evicted by age.
+        os.remove(os.path.join(self.test_dir, "link.bin"))
+        evicted = cache.gc(max_age=60)
+        self.assertEqual([entry.hash.get_value() for entry in evicted],
+                         [entries["linked"].get_value()])
+        self.assertEqual(cache.stats()["num_files"], 1)
+
+    def test_gc_temp_files(self):
+        cache = self._make_cache()
+        hash, cache_path = self._add_file(cache, "x" * 100)
+        cache.touch(hash)
+        stamp = time.time() - 3600
+        partial_path = cache.get_partial_path(hash, "source")
+        cache.write_partial_info(hash, "source", {"size": 200})
+        temp_path = os.path.join(os.path.dirname(cache_path), "tmp-1234")
+        # Possibly still in use (e.g. by a stalled download).
+        new_temp_path = os.path.join(os.path.dirname(cache_path), "tmp-5678")
+        old_stamp = time.time() - 2 * 24 * 3600
+        for path, mtime in [(partial_path, stamp), (temp_path, old_stamp),
+                            (new_temp_path, stamp)]:
+            with open(path, 'w') as f:
+                f.write("y" * 100)
+            os.utime(path, (mtime, mtime))
+        self.assertEqual(cache.stats()["num_files"], 1)
+        self.assertEqual(cache.stats()["temp_size"], 300)
+        # Old temporary files are removed regardless of limits, while
+        # partial downloads count towards them.
+        evicted = cache.gc(max_size=400)
+        self.assertEqual([entry.cache_path for entry in evicted], [temp_path])
+        self.assertTrue(os.path.exists(new_temp_path))
+        evicted = cache.gc(max_size=200)
+        self.assertEqual(
+            [entry.cache_path for entry in evicted], [partial_path])
+        self.assertIsNone(cache.read_partial_info(hash, "source"))
+        # Partial downloads in progress are kept.
+        with open(partial_path, 'w') as f:
+            f.write("y" * 100)
+        os.utime(partial_path, (stamp, stamp))
+        with util.FileLock(partial_path + ".lock"):
+            self.assertEqual(cache.gc(max_size=0), [])
+        self.assertTrue(os.path.exists(cache_path))
+
+
+class FileLockTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(
+            dir=os.environ.get("TEST_TEMPDIR", None))
+        self.lock_path = os.path.join(self.test_dir, "file.lock")
+
+    def test_exclusive(self):
+        holder = util.FileLock(self.lock_path)
+        self.assertTrue(holder.acquire())
+        waiter = util.FileLock(self.lock_path, timeout=0.3)
+        self.assertFalse(waiter.acquire())
+        with self.assertRaises(util.LockTimeoutError):
+            with waiter:
+                pass
+        holder.release()
+        self.assertFalse(os.path.exists(self.lock_path))
+        self.assertTrue(waiter.acquire())
+        waiter.release()
+
+    def _write_dead_holder(self):
+        # Writes the lock file of a process which no longer exists.
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        with open(self.lock_path, 'w') as f:
+            f.write("{} {}\n".format(socket.gethostname(), pid))
+
+    def test_leftover(self):
+        # A lock file left by a crashed holder is not locked, so is re-used.
+        self._write_dead_holder()
+        waiter = util.FileLock(self.lock_path, timeout=0)
+        self.assertTrue(waiter.acquire())
+        waiter.release()
+
+    def test_stale(self):
+        holder = util.FileLock(self.lock_path)
+        self.assertTrue(holder.acquire())
+        # A new holder may not have written its pid yet; its lock must not
+        # be broken.
+        self._write_dead_holder()
+        waiter = util.FileLock(self.lock_path, timeout=0.3)
+        self.assertFalse(waiter.acquire())
+        self.assertTrue(os.path.exists(self.lock_path))
+        # Where `flock` may outlive its holder, stale locks may be broken.
+        waiter = util.FileLock(self.lock_path, timeout=5, break_stale=True)
+        self.assertTrue(waiter.acquire())
+        waiter.release()
+        holder.release()
+
+
+if __name__ == '__main__':
+    unittest.main()
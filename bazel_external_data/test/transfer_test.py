@@ -0,0 +1,166 @@
+import asyncio
+import io
+import threading
+import time
+import unittest
+
+from bazel_external_data import core, hashes, transfer
+
+
+class _Backend(core.Backend):
+    # Checks files slowly, tracking how many checks run at once.
+    def __init__(self, config):
+        core.Backend.__init__(self, config, None, None)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def check_file(self, hash, project_relpath):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.1)
+        with self.lock:
+            self.active -= 1
+        return hash % 2 == 0
+
+
+class TransferEngineTest(unittest.TestCase):
+    def test_check_files(self):
+        backend = _Backend({"check_jobs": 4})
+        start = time.time()
+        found = backend.check_files(range(12))
+        self.assertEqual(found, {i: i % 2 == 0 for i in range(12)})
+        self.assertEqual(backend.max_active, 4)
+        self.assertLess(time.time() - start, 1.)
+
+    def test_map_async(self):
+        async def double(x):
+            await asyncio.sleep(0.01)
+            return 2 * x
+        engine = transfer.get_engine()
+        self.assertEqual(engine.map(double, range(100), jobs=100),
+                         [2 * x for x in range(100)])
+
+    def test_keep_going(self):
+        started = []
+
+        def action(i):
+            started.append(i)
+            if i == 0:
+                raise RuntimeError("Failed")
+
+        engine = transfer.get_engine()
+        batch = engine.batch(jobs=1, keep_going=True)
+        for i in range(3):
+            batch.add(action, i)
+        self.assertFalse(batch.wait())
+        self.assertEqual(sorted(started), [0, 1, 2])
+        # Without `keep_going`, transfers not yet started are skipped.
+        del started[:]
+        batch = engine.batch(jobs=1, keep_going=False)
+        for i in range(3):
+            batch.add(action, i)
+        with self.assertRaises(RuntimeError):
+            batch.wait()
+        self.assertEqual(started, [0])
+
+
+class RaceTest(unittest.TestCase):
+    def _stream(self, count, log, start=None, done=None):
+        # Writes `count` chunks through a `HashWriter`, once `start` is set.
+        def func():
+            try:
+                writer = hashes.HashWriter(hashes.sha512, io.BytesIO())
+                if start is not None:
+                    start.wait()
+                for _ in range(count):
+                    writer.write(b"x")
+            except transfer.Cancelled:
+                log.append("cancelled")
+                raise
+            finally:
+                if done is not None:
+                    done.set()
+            return count
+        return func
+
+    def _race_on_thread(self, funcs, delay):
+        # Returns the result of the race, failing if it is not over soon (as
+        # when waiting for a long `delay`).
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(transfer.race(funcs, delay)),
+            daemon=True)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        return results[0]
+
+    def test_hedge(self):
+        log = []
+        start = threading.Event()
+        done = threading.Event()
+        # The primary sends nothing within the delay, so the hedge starts and
+        # wins; the primary is cancelled as soon as it writes.
+        result = transfer.race(
+            [self._stream(100, log, start, done), self._stream(10, log)],
+            0.01)
+        self.assertEqual(result, 10)
+        start.set()
+        self.assertTrue(done.wait(10))
+        self.assertEqual(log, ["cancelled"])
+        # A primary which finishes first is not hedged.
+        del log[:]
+        result = self._race_on_thread(
+            [self._stream(20, log), self._stream(10, log)], 3600)
+        self.assertEqual(result, 20)
+        self.assertEqual(log, [])
+
+    def test_cancel_blocked(self):
+        # Losers blocked without progress are interrupted, rather than left
+        # running; the resulting error is reported as a cancellation.
+        unblocked = threading.Event()
+        done = threading.Event()
+        errors = []
+
+        def blocked():
+            try:
+                with transfer.on_cancel(unblocked.set):
+                    unblocked.wait()
+                    raise RuntimeError("Interrupted")
+            except Exception as e:
+                errors.append(e)
+                raise
+            finally:
+                done.set()
+
+        self.assertEqual(transfer.race([blocked, lambda: 1], 0), 1)
+        self.assertTrue(done.wait(10))
+        self.assertIsInstance(errors[0], transfer.Cancelled)
+        # Cancellation also reaches nested transfers.
+        parent = transfer.Progress()
+        child = transfer.Progress(parent=parent)
+        parent.cancel()
+        with self.assertRaises(transfer.Cancelled):
+            child.update(1)
+        late = []
+        child.add_cancel_callback(lambda: late.append(True))
+        self.assertEqual(late, [True])
+
+    def test_fallback(self):
+        def fail():
+            raise RuntimeError("Failed")
+        # Failures start the next function without waiting for the delay.
+        self.assertEqual(self._race_on_thread([fail, lambda: 1], 3600), 1)
+        with self.assertRaises(RuntimeError):
+            transfer.race([fail, fail], 10)
+        # Unaccepted results count as failures, but are returned if all are.
+        self.assertTrue(
+            transfer.race([lambda: False, lambda: True], 10, accept=bool))
+        self.assertFalse(
+            transfer.race([lambda: False, lambda: 0], 10, accept=bool))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from bazel_external_data import backends, core, hashes, transfer, upload
+
+
+class UploadTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(
+            dir=os.environ.get("TEST_TEMPDIR", None))
+        os.makedirs(os.path.join(self.test_dir, "data"))
+        os.makedirs(os.path.join(self.test_dir, "mock"))
+        self.user = core.User({"core": {
+            "cache_dir": os.path.join(self.test_dir, "cache")}})
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _make_project(self, remote_config):
+        config = {
+            "project": "upload_test",
+            "root": self.test_dir,
+            "remote": "main",
+            "remotes": {"main": remote_config},
+        }
+        return core.Project(
+            config, self.user, backends.get_default_backends())
+
+    def _run(self, project, filepaths, *argv):
+        parser = argparse.ArgumentParser()
+        upload.add_arguments(parser)
+        args = parser.parse_args(list(argv) + filepaths)
+        args.keep_going = False
+        args.verbose = False
+        return upload.run(args, project)
+
+    def _add_file(self, name, contents):
+        filepath = os.path.join(self.test_dir, "data", name)
+        with open(filepath, 'w') as f:
+            f.write(contents)
+        return filepath, hashes.sha512.compute(filepath, use_memo=False)
+
+    def _check_uploaded(self, project, filepath, hash):
+        with open(filepath + ".sha512") as f:
+            self.assertEqual(f.read().strip(), hash.get_value())
+        self.assertTrue(project.get_remote("main").check_file(hash, None))
+
+    def test_upload(self):
+        # Remotes which hash while uploading, and those which do not.
+        remote_configs = [
+            {"backend": "fs", "path": "store"},
+            {"backend": "mock", "dir": "mock", "upload_dir": "upload"},
+        ]
+        for remote_config in remote_configs:
+            project = self._make_project(remote_config)
+            files = [self._add_file("a.bin", "a" + str(remote_config)),
+                     self._add_file("b.bin", "b" + str(remote_config))]
+            self.assertTrue(self._run(
+                project, [filepath for filepath, _ in files]))
+            for filepath, hash in files:
+                self._check_uploaded(project, filepath, hash)
+
+    def test_hash_error(self):
+        project = self._make_project(
+            {"backend": "mock", "dir": "mock", "upload_dir": "upload"})
+        files = [self._add_file("a.bin", "a"), self._add_file("b.bin", "b")]
+        compute_many = hashes.sha512.compute_many
+        do_upload = upload.do_upload
+        failed = threading.Event()
+
+        def compute_many_then_fail(*args, **kwargs):
+            yield next(iter(compute_many(*args, **kwargs)))
+            failed.set()
+            raise KeyboardInterrupt()
+
+        async def do_upload_after_failure(*args):
+            await transfer.get_engine().run_sync(failed.wait)
+            await do_upload(*args)
+
+        # Uploads already started are waited on, and the hashing error is
+        # raised.
+        with mock.patch.object(
+                hashes.sha512, "compute_many", compute_many_then_fail), \
+                mock.patch.object(
+                    upload, "do_upload", do_upload_after_failure):
+            with self.assertRaises(KeyboardInterrupt):
+                self._run(project, [filepath for filepath, _ in files])
+        uploaded = [filepath for filepath, _ in files
+                    if os.path.exists(filepath + ".sha512")]
+        self.assertEqual(len(uploaded), 1)
+        for filepath, hash in files:
+            if filepath in uploaded:
+                self._check_uploaded(project, filepath, hash)
+
+    def test_local_only(self):
+        project = self._make_project({"backend": "fs", "path": "store"})
+        filepath, hash = self._add_file("a.bin", "local")
+        self.assertTrue(self._run(project, [filepath], "--local_only"))
+        with open(filepath + ".sha512") as f:
+            self.assertEqual(f.read().strip(), hash.get_value())
+        self.assertFalse(project.get_remote("main").check_file(hash, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,344 @@
+"""
+@file
+Runs many transfers (checks, downloads, uploads) concurrently on one shared
+event loop, so that commands are not bound by per-file latency.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import functools
+import threading
+import time
+
+from bazel_external_data.util import eprint
+
+# Maximum number of synchronous calls (e.g. `requests`-based backends) run at
+# once, across all batches.
+MAX_THREADS = 64
+# Default number of concurrent transfers in a batch.
+DEFAULT_JOBS = 8
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Returns the process-wide transfer engine, starting it if needed. """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = TransferEngine()
+        return _engine
+
+
+class TransferEngine(object):
+    """Runs coroutines on an event loop owned by a background thread.
+    Synchronous calls are adapted with `run_sync`, which runs them on a
+    shared thread pool. All methods other than `run_sync` are to be called
+    from outside of the event loop. """
+    def __init__(self, max_threads=MAX_THREADS):
+        self._executor = ThreadPoolExecutor(
+            max_threads, thread_name_prefix="transfer")
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="transfer_loop", daemon=True)
+        self._thread.start()
+
+    async def run_sync(self, func, *args, **kwargs):
+        """Awaits a synchronous call, run on the shared thread pool. """
+        return await self._loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs))
+
+    def submit(self, coro):
+        """Schedules a coroutine, returning a `concurrent.futures.Future`. """
+        assert threading.current_thread() is not self._thread, (
+            "Cannot block on the transfer loop from within it")
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def map(self, func, items, jobs=DEFAULT_JOBS):
+        """Awaits the coroutine function `func` on each of `items`, with at
+        most `jobs` running at once.
+        @returns The results, in the order of `items`. The first error (if
+        any) is raised once all items are finished. """
+        batch = self.batch(jobs=jobs, keep_going=True)
+        futures = [batch.add_async(func, item) for item in items]
+        batch.wait(report=False)
+        return [future.result() for future in futures]
+
+    def map_sync(self, func, items, jobs=DEFAULT_JOBS):
+        """Same as `map`, for a synchronous function. """
+        return self.map(
+            lambda item: self.run_sync(func, item), items, jobs=jobs)
+
+    def batch(self, jobs=None, keep_going=False):
+        """Creates a `Batch` of transfers run by this engine. """
+        return Batch(self, jobs or DEFAULT_JOBS, keep_going)
+
+
+class Batch(object):
+    """A set of transfers run concurrently, with at most `jobs` at a time,
+    following the semantics of `--keep_going`: if false, transfers which
+    have not yet started once one fails are skipped. """
+    def __init__(self, engine, jobs, keep_going):
+        self._engine = engine
+        self._jobs = jobs
+        self._keep_going = keep_going
+        self._semaphore = None
+        self._failed = False
+        self._futures = []
+
+    async def _run(self, func, *args):
+        if self._semaphore is None:
+            # Bound to the engine's loop on creation.
+            self._semaphore = asyncio.Semaphore(self._jobs)
+        async with self._semaphore:
+            if self._failed and not self._keep_going:
+                return None
+            try:
+                return await func(*args)
+            except BaseException:
+                self._failed = True
+                raise
+
+    def add_async(self, func, *args):
+        """Adds a transfer which awaits `func(*args)`.
+        @returns A `concurrent.futures.Future` of its result. """
+        future = self._engine.submit(self._run(func, *args))
+        self._futures.append(future)
+        return future
+
+    def add(self, func, *args):
+        """Adds a transfer which calls the synchronous `func(*args)`. """
+        return self.add_async(self._engine.run_sync, func, *args)
+
+    def wait(self, report=True):
+        """Waits for all transfers.
+        If `keep_going` and `report` are set, a `RuntimeError` from a
+        transfer is printed rather than raised. Otherwise, the first error
+        (in order of addition) is raised.
+        @returns True if all transfers succeeded. """
+        good = True
+        first_error = None
+        for future in self._futures:
+            try:
+                future.result()
+            except RuntimeError as e:
+                good = False
+                if self._keep_going and report:
+                    eprint(e)
+                    eprint("Continuing (--keep_going).")
+                elif first_error is None:
+                    first_error = e
+            except BaseException as e:
+                good = False
+                if first_error is None:
+                    first_error = e
+        self._futures = []
+        if first_error is not None:
+            raise first_error
+        return good
+
+
+class Cancelled(Exception):
+    """Raised within a transfer which has been cancelled (e.g. having lost a
+    race, @see race). """
+    pass
+
+
+class Progress(object):
+    """Observes the bytes received by a transfer, and allows it to be
+    cancelled cooperatively: the transfer raises `Cancelled` the next time it
+    reports progress. Transfers which may block without progress (e.g. on a
+    stalled connection) should also abort on cancellation (@see on_cancel).
+    """
+    def __init__(self, on_start=None, parent=None):
+        # @param on_start Called when the first byte is received.
+        # @param parent Progress of an enclosing transfer, also updated, and
+        #   whose cancellation cancels this.
+        self._on_start = on_start
+        self._parent = parent
+        self._lock = threading.Lock()
+        self._cancel_callbacks = []
+        self.started = False
+        self.cancelled = False
+        self.num_bytes = 0
+        if parent is not None:
+            parent.add_cancel_callback(self.cancel)
+
+    def update(self, num_bytes):
+        if self.cancelled:
+            raise Cancelled()
+        if self._parent is not None:
+            self._parent.update(num_bytes)
+        self.num_bytes += num_bytes
+        if num_bytes and not self.started:
+            self.started = True
+            if self._on_start:
+                self._on_start()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            callbacks = list(self._cancel_callbacks)
+        for callback in callbacks:
+            callback()
+
+    def add_cancel_callback(self, callback):
+        """Calls `callback` once cancelled (immediately, if already). """
+        with self._lock:
+            if not self.cancelled:
+                self._cancel_callbacks.append(callback)
+                return
+        callback()
+
+    def remove_cancel_callback(self, callback):
+        with self._lock:
+            if callback in self._cancel_callbacks:
+                self._cancel_callbacks.remove(callback)
+
+
+_local = threading.local()
+
+
+def get_progress():
+    """Returns the `Progress` tracking transfers on the current thread, or
+    None. Writers which hand off work to other threads should capture it
+    first. """
+    return getattr(_local, "progress", None)
+
+
+@contextlib.contextmanager
+def track(progress):
+    """Reports transfers on the current thread to `progress` (@see
+    hashes.HashWriter). """
+    prev = get_progress()
+    _local.progress = progress
+    try:
+        yield progress
+    finally:
+        _local.progress = prev
+
+
+def check_cancelled():
+    """Raises `Cancelled` if the transfer tracked on the current thread has
+    been cancelled (e.g. before retrying a request). """
+    progress = get_progress()
+    if progress is not None and progress.cancelled:
+        raise Cancelled()
+
+
+@contextlib.contextmanager
+def on_cancel(callback, progress=None):
+    """Calls `callback` (e.g. to shut down a connection blocked on a read) if
+    the transfer is cancelled while within this context. Errors raised as a
+    consequence are replaced by `Cancelled`.
+    @param progress
+        Defaults to the `Progress` tracking the current thread. """
+    if progress is None:
+        progress = get_progress()
+    if progress is None:
+        yield
+        return
+    progress.add_cancel_callback(callback)
+    try:
+        yield
+    except Exception as e:
+        if progress.cancelled and not isinstance(e, Cancelled):
+            raise Cancelled() from e
+        raise
+    finally:
+        progress.remove_cancel_callback(callback)
+
+
+class _Racer(object):
+    def __init__(self, func, on_start, parent):
+        self.func = func
+        self.progress = Progress(on_start, parent)
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+def race(funcs, delay, accept=None, discard=None):
+    """Calls `funcs` in order, each on its own thread, as a hedge against
+    the slowness of those before: the next is started if none of those
+    running has received its first byte (or finished) within `delay`
+    seconds, or once all of those started have failed. The first accepted
+    result wins, and the others are cancelled.
+    @param accept
+        Returns whether a result wins (default: any result).
+        Unaccepted results count as failures.
+    @param discard
+        Called on results which arrive after the winner (e.g. to remove
+        files), on their own thread.
+    @returns The winning result. If there is none, the error of the last
+        function to raise one is raised, or else the last result is
+        returned. """
+    cond = threading.Condition()
+    racers = []
+    pending = list(funcs)
+    state = {"winner": None}
+    # Races may be nested (e.g. within one of `funcs`).
+    parent = get_progress()
+
+    def notify():
+        with cond:
+            cond.notify_all()
+
+    def run(racer):
+        result = error = None
+        with track(racer.progress):
+            try:
+                result = racer.func()
+            except BaseException as e:
+                error = e
+        with cond:
+            racer.result, racer.error, racer.done = result, error, True
+            late = state["winner"] is not None
+            cond.notify_all()
+        if late and error is None and discard is not None:
+            discard(result)
+
+    def start():
+        racer = _Racer(pending.pop(0), notify, parent)
+        racers.append(racer)
+        threading.Thread(
+            target=run, args=(racer,), name="race", daemon=True).start()
+        return time.monotonic()
+
+    def wins(racer):
+        return (racer.done and racer.error is None and
+                (accept is None or accept(racer.result)))
+
+    with cond:
+        last_start = start()
+        while True:
+            winner = next(filter(wins, racers), None)
+            if winner is not None:
+                state["winner"] = winner
+                break
+            running = [racer for racer in racers if not racer.done]
+            stalled = not any(racer.progress.started for racer in running)
+            now = time.monotonic()
+            if pending and (not running or (
+                    stalled and now - last_start >= delay)):
+                last_start = start()
+                continue
+            if not running:
+                break
+            timeout = None
+            if pending and stalled:
+                timeout = last_start + delay - now
+            cond.wait(timeout)
+        for racer in racers:
+            if racer is not winner:
+                racer.progress.cancel()
+                if racer.done and racer.error is None and discard:
+                    discard(racer.result)
+    if winner is not None:
+        return winner.result
+    errors = [racer.error for racer in racers if racer.error is not None]
+    if errors:
+        raise errors[-1]
+    return racers[-1].result
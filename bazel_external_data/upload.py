@@ -2,10 +2,13 @@
 Uploads a file or set of files for this project.
 """
 
+import asyncio
+import collections
 import os
 import sys
 import yaml
 
+from bazel_external_data import transfer
 from bazel_external_data.util import (
     eprint,
     is_archive,
@@ -30,13 +33,17 @@ def add_arguments(parser):
               "the manifest will always be generated. If `infer`, the "
               "manifest will be regenerated if it already exists. If `none`, "
               "no manifest will be generated."))
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help="Number of files to hash or upload concurrently. Defaults to " +
+             "the number of CPUs for hashing.")
 
 
 def run(args, project):
     good = True
-    for filepath in args.filepaths:
-        def action():
-            do_upload(args, project, filepath)
+
+    def keep_going(action):
+        nonlocal good
         if args.keep_going:
             try:
                 action()
@@ -46,13 +53,70 @@ def run(args, project):
                 eprint("Continuing (--keep_going).")
         else:
             action()
+
+    infos = {}
+    for filepath in args.filepaths:
+        def action():
+            info = project.get_file_info(
+                os.path.abspath(filepath), needs_hash=False)
+            infos[info.orig_filepath] = info
+        keep_going(action)
+    batch = transfer.get_engine().batch(
+        jobs=args.jobs, keep_going=args.keep_going)
+    # Remotes which can hash a file while uploading it only need one read of
+    # the file.
+    to_hash = {}
+    for orig_filepath, info in infos.items():
+        if (not args.local_only and
+                info.remote.supports_single_pass_upload()):
+            batch.add_async(
+                do_upload, args, project, info, info.hash.hash_type, None)
+        else:
+            to_hash[orig_filepath] = info
+    # Hash all other files concurrently, uploading each as soon as its hash
+    # is available. Files with the same contents are uploaded one at a time,
+    # so that only the first is transferred.
+    upload_locks = collections.defaultdict(asyncio.Lock)
+    hash_types = set(info.hash.hash_type for info in to_hash.values())
+    try:
+        for hash_type in hash_types:
+            filepaths = [
+                orig_filepath for orig_filepath, info in to_hash.items()
+                if info.hash.hash_type == hash_type]
+            results = hash_type.compute_many(
+                filepaths, jobs=args.jobs, do_throw=False)
+            for orig_filepath, hash in results:
+                def action():
+                    if isinstance(hash, Exception):
+                        raise hash
+                    batch.add_async(
+                        do_upload_locked, upload_locks, args, project,
+                        infos[orig_filepath], hash_type, hash)
+                keep_going(action)
+    except BaseException:
+        # Still wait for the uploads already started, but raise the error
+        # which stopped hashing, rather than theirs.
+        try:
+            batch.wait()
+        except Exception as e:
+            eprint(e)
+        raise
+    if not batch.wait():
+        good = False
     return good
 
 
-def do_upload(args, project, filepath):
-    info = project.get_file_info(os.path.abspath(filepath), needs_hash=False)
+async def do_upload_locked(locks, *args):
+    # @param locks Locks by hash, created on the transfer engine's loop.
+    hash = args[-1]
+    async with locks[hash]:
+        await do_upload(*args)
+
+
+async def do_upload(args, project, info, hash_type, hash):
+    # @param hash The computed hash of the file, or None if it should be
+    # computed (as `hash_type`) while uploading.
     remote = info.remote
-    hash = info.hash
     project_relpath = info.project_relpath
     orig_filepath = info.orig_filepath
 
@@ -60,13 +124,12 @@ def do_upload(args, project, filepath):
         yaml.dump(info.debug_config(), sys.stdout, default_flow_style=False)
 
     if not args.local_only:
-        hash = remote.upload_file(
-            hash.hash_type, project_relpath, orig_filepath,
-            check_overlay=not args.ignore_overlay)
-    else:
-        hash = hash.compute(orig_filepath)
-    project.update_file_info(info, hash)
-    handle_manifest(args, info)
+        hash = await remote.upload_file_async(
+            hash_type, project_relpath, orig_filepath,
+            check_overlay=not args.ignore_overlay, hash=hash)
+    engine = transfer.get_engine()
+    await engine.run_sync(project.update_file_info, info, hash)
+    await engine.run_sync(handle_manifest, args, info)
 
 
 def handle_manifest(args, info):
@@ -1,9 +1,15 @@
 from __future__ import print_function
 
+import fcntl
 import os
+import shutil
+import socket
+import stat
 import subprocess
 import sys
 import tarfile
+import time
+import uuid
 
 
 def is_child_path(child_path, parent_path, require_abs=True):
@@ -42,6 +48,188 @@ class DownloadError(RuntimeError):
     pass
 
 
+class LockTimeoutError(RuntimeError):
+    """Raised when a `FileLock` used as a context manager times out. """
+    pass
+
+
+class FileLock(object):
+    """Advisory, cross-process lock using `flock` on a lock file, which is
+    removed on release.
+
+    The holder's host and pid are written to the lock file. `flock` locks are
+    released by the kernel if the holder crashes, so a lock file left behind
+    is simply re-used, and a lock file which is locked is never removed.
+    """
+    poll_interval = 0.2
+
+    def __init__(self, path, timeout=None, break_stale=False):
+        """
+        @param timeout
+            Seconds to wait for the lock before giving up, or None to wait
+            indefinitely.
+        @param break_stale
+            Where `flock` locks may outlive their holder (e.g. some network
+            filesystems), break a lock held by a process on this host which
+            no longer exists. Only enable this on such filesystems: otherwise,
+            a new holder which has yet to write its pid may be mistaken for
+            the crashed holder whose lock file it re-used.
+        """
+        self.path = path
+        self.timeout = timeout
+        self.break_stale = break_stale
+        self._fd = None
+
+    def is_held(self):
+        return self._fd is not None
+
+    def acquire(self):
+        """Acquires the lock, returning False if `timeout` elapsed. """
+        assert self._fd is None
+        start = time.time()
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                if self.break_stale and self._is_stale():
+                    eprint("Breaking stale lock: {}".format(self.path))
+                    self._remove()
+                    continue
+                if (self.timeout is not None and
+                        time.time() - start >= self.timeout):
+                    return False
+                time.sleep(self.poll_interval)
+                continue
+            # The previous holder may have removed the file we locked upon
+            # release; if so, try again with the new file.
+            try:
+                is_current = os.stat(self.path).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                is_current = False
+            if not is_current:
+                os.close(fd)
+                continue
+            os.ftruncate(fd, 0)
+            os.write(fd, "{} {}\n".format(
+                socket.gethostname(), os.getpid()).encode("utf8"))
+            self._fd = fd
+            return True
+
+    def release(self):
+        """Releases the lock, if held. """
+        if self._fd is None:
+            return
+        # Remove the file while still holding the lock, so that waiters
+        # detect that they must re-open it.
+        self._remove()
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    def _remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _is_stale(self):
+        try:
+            with open(self.path) as f:
+                host, pid = f.read().split()
+            pid = int(pid)
+        except (OSError, ValueError):
+            return False
+        if host != socket.gethostname():
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockTimeoutError(
+                "Timed out waiting for lock: {}".format(self.path))
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+MATERIALIZE_STRATEGIES = ("reflink", "hardlink", "copy_file_range", "copy")
+
+
+def _reflink(src, dst):
+    # Copy-on-write clone (e.g. btrfs, xfs); O(1) regardless of size.
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+
+
+def _copy_file_range(src, dst):
+    # In-kernel copy, which may also be offloaded by the filesystem.
+    if not hasattr(os, "copy_file_range"):
+        raise OSError("os.copy_file_range not available")
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            count = os.copy_file_range(
+                fsrc.fileno(), fdst.fileno(), min(remaining, 1 << 30))
+            if count == 0:
+                raise OSError("copy_file_range stopped early")
+            remaining -= count
+
+
+def materialize_file(src, dst, strategies=("reflink", "copy")):
+    """Creates `dst` as a writeable copy of `src`, trying each strategy in
+    order until one is supported.
+    @param strategies
+        Any of `MATERIALIZE_STRATEGIES`:
+        "reflink" - Copy-on-write clone via FICLONE.
+        "hardlink" - Hard link to `src`. As a guard against modifying `src`
+            through `dst`, `dst` is left read-only (and shares its mode with
+            `src`), so this should only be used if `src` is read-only.
+        "copy_file_range" - In-kernel copy.
+        "copy" - Plain copy.
+    @returns The strategy used. """
+    assert not os.path.exists(dst), dst
+    for strategy in strategies:
+        try:
+            if strategy == "hardlink":
+                src_mode = os.stat(src).st_mode
+                if src_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+                    # Writes through `dst` would corrupt `src`.
+                    continue
+                os.link(src, dst)
+                return strategy
+            elif strategy == "reflink":
+                _reflink(src, dst)
+            elif strategy == "copy_file_range":
+                _copy_file_range(src, dst)
+            elif strategy == "copy":
+                shutil.copyfile(src, dst)
+            else:
+                raise RuntimeError(
+                    "Unknown materialize strategy: {}".format(strategy))
+        except OSError:
+            if os.path.lexists(dst):
+                os.remove(dst)
+            continue
+        shutil.copymode(src, dst)
+        # Ensure file is writeable.
+        os.chmod(dst, os.stat(dst).st_mode | stat.S_IWUSR)
+        return strategy
+    raise RuntimeError("Could not materialize {} from {} using {}".format(
+        dst, src, strategies))
+
+
 def get_chain(value, key_chain, default=None):
     """Gets a value in a chain of nested dictionaries, with a default if any
     point in the chain does not exist. """
@@ -98,6 +286,46 @@ def eprint(*args):
     print(*args, file=sys.stderr)
 
 
+def parse_size(value):
+    """Parses a size in bytes, either as a number or a string with an
+    optional binary suffix (e.g. "512K", "20G"). """
+    if isinstance(value, (int, float)):
+        return int(value)
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    text = value.strip().upper()
+    if text.endswith("B"):
+        text = text[:-1]
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def get_stat_key(st):
+    """Returns the stat data of a file (size, mtime, ctime and inode) which
+    change whenever its contents may have, e.g. to detect whether a result
+    memoized for the file is still valid. """
+    return [st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino]
+
+
+def write_atomic(path, text, mode=0o666):
+    """Writes `text` to `path` (creating its directory if needed) via a
+    temporary file which is then renamed into place, so that concurrent
+    readers and writers are safe.
+    @param mode
+        Permissions of the new file, before the umask is applied. """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "{}.{}".format(path, uuid.uuid4())
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
 def is_archive(filepath):
     """Determines if a filepath indicates that it's an archive."""
     exts = [